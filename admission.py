@@ -0,0 +1,265 @@
+import asyncio
+import json
+import logging
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+# Request priorities
+HIGH = "high"
+NORMAL = "normal"
+LOW = "low"
+
+# Longest a request may queue for a concurrency slot before it is shed, in seconds
+QUEUE_BUDGETS: Dict[str, float] = {HIGH: 2.0, NORMAL: 0.5, LOW: 0.1}
+# Fraction of max_in_flight above which new requests of a priority are shed without queueing
+SHED_THRESHOLDS: Dict[str, float] = {HIGH: 1.0, NORMAL: 0.85, LOW: 0.5}
+
+
+class BucketStore(ABC):
+    """Token bucket state keyed by client.
+
+    ``take`` returns 0 when the request may proceed, otherwise the number of
+    seconds until enough tokens are available. Stores that do network I/O set
+    ``blocking`` so the middleware calls them off the event loop.
+    """
+
+    blocking = False
+
+    @abstractmethod
+    def take(self, key: str, rate: float, burst: float, cost: float = 1.0) -> float:
+        ...
+
+
+class InMemoryBucketStore(BucketStore):
+    """Per-process buckets; the least recently seen keys are evicted past ``max_keys``."""
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: float, cost: float = 1.0) -> float:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            if tokens >= cost:
+                tokens -= cost
+                wait = 0.0
+            else:
+                wait = (cost - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class RedisBucketStore(BucketStore):
+    """Buckets shared by every worker and host through a Redis-compatible client.
+
+    Any object with a redis-py style ``eval(script, numkeys, *keys_and_args)``
+    works, so a local stand-in can replace the server in development.
+    """
+
+    blocking = True
+
+    SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local rate, burst, cost, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+    def __init__(self, client, prefix: str = "ratelimit:"):
+        self.client = client
+        self.prefix = prefix
+
+    def take(self, key: str, rate: float, burst: float, cost: float = 1.0) -> float:
+        return float(self.client.eval(self.SCRIPT, 1, self.prefix + key, rate, burst, cost, time.time()))
+
+
+class RouteLimit:
+    """Caps concurrent requests under a path prefix (optionally only for some methods)."""
+
+    def __init__(self, prefix: str, max_concurrent: int, priority: str = NORMAL,
+                 methods: Optional[Sequence[str]] = None):
+        self.prefix = prefix
+        self.max_concurrent = max_concurrent
+        self.priority = priority
+        self.methods = {method.upper() for method in methods} if methods else None
+        self.in_flight = 0
+        self.shed = 0
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def matches(self, path: str, method: str) -> bool:
+        return path.startswith(self.prefix) and (self.methods is None or method in self.methods)
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # Created lazily so it belongs to the serving event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        return self._semaphore
+
+
+class AdmissionMiddleware:
+    """ASGI middleware that decides, before any handler or DB work, whether to take a request.
+
+    1. Per-IP and per-user (``X-User-Id``) token buckets answer 429 with Retry-After.
+    2. Low-priority requests are shed early once the process is busy.
+    3. Each request waits for a slot in its route's concurrency limit for at most
+       its priority's queue budget, and is answered 503 with Retry-After otherwise.
+    """
+
+    def __init__(self, app, route_limits: List[RouteLimit], store: Optional[BucketStore] = None,
+                 ip_rate: float = 20.0, ip_burst: float = 40, user_rate: float = 10.0, user_burst: float = 20,
+                 max_in_flight: int = 64, retry_after: float = 1.0, user_header: str = "x-user-id",
+                 trust_forwarded: bool = False, exempt_prefixes: Sequence[str] = ("/docs", "/redoc", "/openapi.json")):
+        self.app = app
+        # Most specific prefix wins
+        self.route_limits = sorted(route_limits, key=lambda limit: len(limit.prefix), reverse=True)
+        self.store = store or InMemoryBucketStore()
+        self.ip_rate = ip_rate
+        self.ip_burst = ip_burst
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self.user_header = user_header.lower().encode()
+        self.trust_forwarded = trust_forwarded
+        self.exempt_prefixes = tuple(exempt_prefixes)
+        self.in_flight = 0
+        self.rate_limited = 0
+        self.shed = 0
+        metrics_registry.append(self)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.exempt_prefixes):
+            await self.app(scope, receive, send)
+            return
+        wait = await self._take_tokens(scope)
+        if wait > 0:
+            self.rate_limited += 1
+            await _reject(send, 429, "Rate limit exceeded", wait)
+            return
+        route_limit = self._route_limit(scope["path"], scope["method"])
+        priority = route_limit.priority if route_limit is not None else NORMAL
+        if self.in_flight >= self.max_in_flight * SHED_THRESHOLDS[priority]:
+            await self._shed(send, route_limit)
+            return
+        if route_limit is not None:
+            try:
+                await asyncio.wait_for(route_limit.semaphore.acquire(), QUEUE_BUDGETS[priority])
+            except asyncio.TimeoutError:
+                await self._shed(send, route_limit)
+                return
+            route_limit.in_flight += 1
+        self.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+            if route_limit is not None:
+                route_limit.in_flight -= 1
+                route_limit.semaphore.release()
+
+    def _route_limit(self, path: str, method: str) -> Optional[RouteLimit]:
+        for route_limit in self.route_limits:
+            if route_limit.matches(path, method):
+                return route_limit
+        return None
+
+    def _client_ip(self, scope) -> str:
+        if self.trust_forwarded:
+            for name, value in scope["headers"]:
+                if name == b"x-forwarded-for":
+                    return value.decode("latin-1").split(",")[0].strip()
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    def _user_id(self, scope) -> Optional[str]:
+        for name, value in scope["headers"]:
+            if name == self.user_header:
+                return value.decode("latin-1")[:64]
+        return None
+
+    async def _take_tokens(self, scope) -> float:
+        checks = [(f"ip:{self._client_ip(scope)}", self.ip_rate, self.ip_burst)]
+        user_id = self._user_id(scope)
+        if user_id:
+            checks.append((f"user:{user_id}", self.user_rate, self.user_burst))
+        wait = 0.0
+        for key, rate, burst in checks:
+            try:
+                if self.store.blocking:
+                    wait = max(wait, await run_in_threadpool(self.store.take, key, rate, burst))
+                else:
+                    wait = max(wait, self.store.take(key, rate, burst))
+            except Exception:
+                # Fail open: an unavailable shared store must not take the API down with it
+                logger.exception("Rate limit store error")
+        return wait
+
+    async def _shed(self, send, route_limit: Optional[RouteLimit]):
+        self.shed += 1
+        if route_limit is not None:
+            route_limit.shed += 1
+        await _reject(send, 503, "Server busy, please retry", self.retry_after)
+
+    def metrics(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "rate_limited": self.rate_limited,
+            "shed": self.shed,
+            "routes": [
+                {
+                    "prefix": route_limit.prefix,
+                    "priority": route_limit.priority,
+                    "max_concurrent": route_limit.max_concurrent,
+                    "in_flight": route_limit.in_flight,
+                    "shed": route_limit.shed,
+                }
+                for route_limit in self.route_limits
+            ],
+        }
+
+
+# Middleware instances are built by Starlette when the app starts; they register here for metrics
+metrics_registry: List[AdmissionMiddleware] = []
+
+
+async def _reject(send, status: int, detail: str, retry_after: float):
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def current_metrics() -> dict:
+    return metrics_registry[-1].metrics() if metrics_registry else {}
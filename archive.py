@@ -0,0 +1,139 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional
+
+from sqlalchemy import and_, delete, insert, or_, select
+from sqlalchemy.orm import Session
+
+import jobs
+import models
+
+logger = logging.getLogger(__name__)
+
+# (hot model, archive model) pairs for rows that belong to an ad, in copy order
+AD_DEPENDENTS = [
+    (models.AdImage, models.ArchivedAdImage),
+    (models.Favorite, models.ArchivedFavorite),
+    (models.Message, models.ArchivedMessage),
+    (models.Report, models.ArchivedReport),
+    (models.Transaction, models.ArchivedTransaction),
+]
+# Derived rows that are dropped rather than archived
+AD_DERIVED = [models.ModerationQueueEntry, models.SavedSearchMatch, models.AdLshBucket]
+
+ARCHIVE_JOB = "archive"
+# Keeps a second run in this process from starting; progress is shared through job_runs
+_run_lock = threading.Lock()
+
+
+def _move(db: Session, hot, archive, condition):
+    columns = [column.name for column in hot.__table__.columns]
+    db.execute(
+        insert(archive.__table__).from_select(
+            columns, select(*[hot.__table__.c[name] for name in columns]).where(condition)
+        )
+    )
+    return db.execute(delete(hot.__table__).where(condition)).rowcount
+
+
+def _archivable_ads(db: Session, sold_before: datetime, expired_before: Optional[datetime], limit: int) -> List[int]:
+    condition = and_(models.Ad.is_sold.is_(True), models.Ad.updated_at < sold_before)
+    if expired_before is not None:
+        condition = or_(condition, models.Ad.created_at < expired_before)
+    # Soft-deleted ads are left to the purge worker, and ads with an open reservation stay hot
+    # so the transaction can still be completed or cancelled
+    pending = select(models.Transaction.transaction_id).where(
+        and_(
+            models.Transaction.ad_id == models.Ad.ad_id,
+            models.Transaction.status == models.TransactionStatusEnum.PENDING
+        )
+    ).exists()
+    condition = and_(condition, models.Ad.deleted_at.is_(None), ~pending)
+    return [
+        ad_id for (ad_id,) in db.query(models.Ad.ad_id).filter(condition)
+        .order_by(models.Ad.ad_id).limit(limit).with_for_update(skip_locked=True).all()
+    ]
+
+
+def archive_ads_chunk(db: Session, sold_before: datetime, expired_before: Optional[datetime], chunk_size: int) -> int:
+    ad_ids = _archivable_ads(db, sold_before, expired_before, chunk_size)
+    if not ad_ids:
+        db.rollback()
+        return 0
+    for hot, archive in AD_DEPENDENTS:
+        _move(db, hot, archive, hot.__table__.c.ad_id.in_(ad_ids))
+    for derived in AD_DERIVED:
+        db.execute(delete(derived.__table__).where(derived.__table__.c.ad_id.in_(ad_ids)))
+    moved = _move(db, models.Ad, models.ArchivedAd, models.Ad.__table__.c.ad_id.in_(ad_ids))
+    db.commit()
+    return moved
+
+
+def archive_messages_chunk(db: Session, sent_before: datetime, chunk_size: int) -> int:
+    message_ids = [
+        message_id for (message_id,) in db.query(models.Message.message_id)
+        .filter(models.Message.sent_at < sent_before)
+        .order_by(models.Message.message_id).limit(chunk_size).with_for_update(skip_locked=True).all()
+    ]
+    if not message_ids:
+        db.rollback()
+        return 0
+    moved = _move(db, models.Message, models.ArchivedMessage, models.Message.__table__.c.message_id.in_(message_ids))
+    db.commit()
+    return moved
+
+
+def run_archival(session_factory: Callable, sold_after_days: int = 30, expire_after_days: Optional[int] = None,
+                 message_after_days: Optional[int] = 365, chunk_size: int = 500, max_chunks: Optional[int] = None):
+    """Move cold rows into the *_archive tables in short, separately committed chunks.
+
+    Each chunk holds its row locks only briefly, so live traffic on the hot
+    tables is never blocked for long. Safe to interrupt and rerun.
+    """
+    if not _run_lock.acquire(blocking=False):
+        logger.info("Archival already running")
+        return None
+    now = datetime.now()
+    sold_before = now - timedelta(days=sold_after_days)
+    expired_before = now - timedelta(days=expire_after_days) if expire_after_days is not None else None
+    progress = {"ads": 0, "messages": 0}
+    status, error = jobs.FAILED, None
+    db = session_factory()
+    try:
+        jobs.save(db, ARCHIVE_JOB, jobs.RUNNING, now, progress)
+        chunks = 0
+        while max_chunks is None or chunks < max_chunks:
+            moved = archive_ads_chunk(db, sold_before, expired_before, chunk_size)
+            if not moved:
+                break
+            progress["ads"] += moved
+            jobs.save(db, ARCHIVE_JOB, jobs.RUNNING, now, progress)
+            chunks += 1
+        if message_after_days is not None:
+            sent_before = now - timedelta(days=message_after_days)
+            while max_chunks is None or chunks < max_chunks:
+                moved = archive_messages_chunk(db, sent_before, chunk_size)
+                if not moved:
+                    break
+                progress["messages"] += moved
+                jobs.save(db, ARCHIVE_JOB, jobs.RUNNING, now, progress)
+                chunks += 1
+        status = jobs.COMPLETED
+    except Exception as e:
+        db.rollback()
+        logger.exception("Archival failed")
+        error = str(e)
+    finally:
+        try:
+            jobs.save(db, ARCHIVE_JOB, status, now, progress, finished_at=datetime.now(), error=error)
+        finally:
+            db.close()
+            _run_lock.release()
+    return {"status": status, **progress}
+
+
+if __name__ == "__main__":
+    from main import SessionLocal
+
+    print(run_archival(SessionLocal))
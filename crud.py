@@ -1,10 +1,34 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session, selectinload, contains_eager, joinedload, noload
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import and_, or_, func, literal, select, union_all, Date
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from typing import List, Optional
+import re
+import json
+from datetime import date, datetime
+from decimal import Decimal
 import models
 import schemas
+import dedupe
+import outbox
 from passlib.context import CryptContext
 
+# Outbox events (written in the caller's transaction, handled later by the outbox dispatcher)
+AD_CREATED = "ad.created"
+AD_UPDATED = "ad.updated"
+AD_DELETED = "ad.deleted"
+FAVORITE_CREATED = "favorite.created"
+FAVORITE_DELETED = "favorite.deleted"
+MESSAGE_CREATED = "message.created"
+TRANSACTION_ROLLUP = "transaction.rollup"
+
+def _emit(db: Session, event_type: str, aggregate_id: int, **data):
+    db.add(models.OutboxEvent(
+        event_type=event_type,
+        aggregate_id=aggregate_id,
+        payload=json.dumps(data) if data else None
+    ))
+
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -29,17 +53,29 @@ def create_user(db: Session, user: schemas.UserCreate):
     db.refresh(db_user)
     return db_user
 
+def _users_query(db: Session):
+    # Soft-deleted users stay hidden until the purge worker removes them
+    return db.query(models.User).filter(models.User.deleted_at.is_(None))
+
 def get_user(db: Session, user_id: int):
-    return db.query(models.User).filter(models.User.user_id == user_id).first()
+    return _users_query(db).filter(models.User.user_id == user_id).first()
 
 def get_user_by_email(db: Session, email: str):
-    return db.query(models.User).filter(models.User.email == email).first()
+    return _users_query(db).filter(models.User.email == email).first()
 
 def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.User).offset(skip).limit(limit).all()
+    return _users_query(db).offset(skip).limit(limit).all()
+
+def _live_users(*columns):
+    # Hides rows that reference a soft-deleted user; that set only lives until the purge, so it stays small
+    deleted = select(models.User.user_id).where(models.User.deleted_at.isnot(None))
+    return and_(*[column.notin_(deleted) for column in columns])
+
+def _join_live_ad(query, ad_id_column):
+    return query.join(models.Ad, models.Ad.ad_id == ad_id_column).filter(models.Ad.deleted_at.is_(None))
 
 def update_user(db: Session, user_id: int, user_update: schemas.UserUpdate):
-    db_user = db.query(models.User).filter(models.User.user_id == user_id).first()
+    db_user = get_user(db, user_id=user_id)
     if db_user:
         update_data = user_update.dict(exclude_unset=True)
         if "password" in update_data:
@@ -50,12 +86,32 @@ def update_user(db: Session, user_id: int, user_update: schemas.UserUpdate):
         db.refresh(db_user)
     return db_user
 
+def _deleted_email(user_id: int) -> str:
+    return f"deleted-{user_id}@deleted.invalid"
+
 def delete_user(db: Session, user_id: int):
-    db_user = db.query(models.User).filter(models.User.user_id == user_id).first()
-    if db_user:
-        db.delete(db_user)
-        db.commit()
-    return db_user
+    # Soft delete: hide the user and their ads now, remove the rows later in bounded batches
+    db_user = get_user(db, user_id=user_id)
+    if db_user is None:
+        return None
+    deleted_at = datetime.now()
+    db_user.deleted_at = deleted_at
+    # users.email is unique; free the address now so it can sign up again before the purge runs
+    db_user.email = _deleted_email(user_id)
+    ad_ids = [ad_id for ad_id, in db.query(models.Ad.ad_id).filter(
+        and_(models.Ad.user_id == user_id, models.Ad.deleted_at.is_(None))
+    ).with_for_update()]
+    if ad_ids:
+        db.query(models.Ad).filter(models.Ad.ad_id.in_(ad_ids)).update(
+            {models.Ad.deleted_at: deleted_at}, synchronize_session=False
+        )
+    # Same events as deleting each ad on its own, so every ad.deleted consumer sees them go
+    for ad_id in ad_ids:
+        _emit(db, AD_DELETED, ad_id)
+    purge_job = _enqueue_purge(db, PURGE_USER, user_id)
+    db.commit()
+    db.refresh(purge_job)
+    return purge_job
 
 # Location CRUD operations
 def create_location(db: Session, location: schemas.LocationCreate):
@@ -126,81 +182,339 @@ def delete_category(db: Session, category_id: int):
     return db_category
 
 # Ad CRUD operations
-def create_ad(db: Session, ad: schemas.AdCreate):
+class DuplicateAdError(Exception):
+    def __init__(self, duplicate_of: int, similarity: float):
+        super().__init__(f"Ad is a near-duplicate of ad {duplicate_of}")
+        self.duplicate_of = duplicate_of
+        self.similarity = similarity
+
+def _check_duplicate(db: Session, db_ad: models.Ad, reject_duplicates: bool, title: str, description: str,
+                     user_id: int, category_id: int, exclude_ad_id: Optional[int] = None):
+    signature = dedupe.signature(title, description)
+    duplicate = dedupe.find_duplicate(db, user_id, category_id, signature, exclude_ad_id=exclude_ad_id)
+    if duplicate is not None and reject_duplicates:
+        raise DuplicateAdError(*duplicate)
+    db_ad.duplicate_of = duplicate[0] if duplicate is not None else None
+    return signature
+
+def create_ad(db: Session, ad: schemas.AdCreate, reject_duplicates: bool = False):
     db_ad = models.Ad(**ad.dict())
+    signature = _check_duplicate(db, db_ad, reject_duplicates, ad.title, ad.description, ad.user_id, ad.category_id)
     db.add(db_ad)
+    db.flush()
+    dedupe.index_ad(db, db_ad, signature)
+    _emit(db, AD_CREATED, db_ad.ad_id)
     db.commit()
     db.refresh(db_ad)
     return db_ad
 
+def _ads_query(db: Session):
+    # Listing pages serialize images for every ad; load them with one IN query instead of one per ad
+    return db.query(models.Ad).options(selectinload(models.Ad.images)).filter(models.Ad.deleted_at.is_(None))
+
 def get_ad(db: Session, ad_id: int):
-    return db.query(models.Ad).filter(models.Ad.ad_id == ad_id).first()
+    return db.query(models.Ad).filter(and_(models.Ad.ad_id == ad_id, models.Ad.deleted_at.is_(None))).first()
 
 def get_ads(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Ad).offset(skip).limit(limit).all()
+    return _ads_query(db).offset(skip).limit(limit).all()
 
-def get_ads_by_user(db: Session, user_id: int, skip: int = 0, limit: int = 100):
-    return db.query(models.Ad).filter(models.Ad.user_id == user_id).offset(skip).limit(limit).all()
+def get_duplicate_ads(db: Session, skip: int = 0, limit: int = 100):
+    return _ads_query(db).filter(models.Ad.duplicate_of.isnot(None)).order_by(
+        models.Ad.ad_id.desc()
+    ).offset(skip).limit(limit).all()
+
+def get_archived_ad(db: Session, ad_id: int):
+    return db.query(models.ArchivedAd).filter(models.ArchivedAd.ad_id == ad_id).first()
+
+def get_ads_by_user(db: Session, user_id: int, skip: int = 0, limit: int = 100, include_archived: bool = False):
+    ads = _ads_query(db).filter(models.Ad.user_id == user_id).offset(skip).limit(limit).all()
+    if include_archived and len(ads) < limit:
+        # Archived ads are paged after all live ones; the archive is only touched once live rows run out
+        if ads:
+            hot_total = skip + len(ads)
+        else:
+            hot_total = db.query(func.count(models.Ad.ad_id)).filter(
+                and_(models.Ad.user_id == user_id, models.Ad.deleted_at.is_(None))
+            ).scalar()
+        ads += db.query(models.ArchivedAd).options(selectinload(models.ArchivedAd.images)).filter(
+            models.ArchivedAd.user_id == user_id
+        ).order_by(models.ArchivedAd.ad_id).offset(max(skip - hot_total, 0)).limit(limit - len(ads)).all()
+    return ads
 
 def get_ads_by_category(db: Session, category_id: int, skip: int = 0, limit: int = 100):
-    return db.query(models.Ad).filter(models.Ad.category_id == category_id).offset(skip).limit(limit).all()
+    return _ads_query(db).filter(models.Ad.category_id == category_id).offset(skip).limit(limit).all()
 
 def get_ads_by_location(db: Session, location_id: int, skip: int = 0, limit: int = 100):
-    return db.query(models.Ad).filter(models.Ad.location_id == location_id).offset(skip).limit(limit).all()
+    return _ads_query(db).filter(models.Ad.location_id == location_id).offset(skip).limit(limit).all()
 
 def search_ads(db: Session, query: str, skip: int = 0, limit: int = 100):
-    return db.query(models.Ad).filter(
+    return _ads_query(db).filter(
         or_(
             models.Ad.title.contains(query),
             models.Ad.description.contains(query)
         )
     ).offset(skip).limit(limit).all()
 
-def update_ad(db: Session, ad_id: int, ad_update: schemas.AdUpdate):
-    db_ad = db.query(models.Ad).filter(models.Ad.ad_id == ad_id).first()
+def get_ad_for_page(db: Session, ad_id: int, with_seller: bool = True, with_images: bool = True):
+    # Relationships that were not requested are noload-ed so serialization never triggers lazy loads
+    return db.query(models.Ad).options(
+        joinedload(models.Ad.category),
+        joinedload(models.Ad.location),
+        joinedload(models.Ad.user) if with_seller else noload(models.Ad.user),
+        selectinload(models.Ad.images) if with_images else noload(models.Ad.images)
+    ).filter(and_(models.Ad.ad_id == ad_id, models.Ad.deleted_at.is_(None))).first()
+
+def get_more_ads_from_seller(db: Session, ad_id: int, limit: int = 6):
+    # The seller is resolved in a subquery so this can run concurrently with the ad lookup
+    seller_id = select(models.Ad.user_id).where(models.Ad.ad_id == ad_id).scalar_subquery()
+    return db.query(models.Ad).filter(
+        and_(
+            models.Ad.user_id == seller_id,
+            models.Ad.ad_id != ad_id,
+            models.Ad.is_sold.is_(False),
+            models.Ad.deleted_at.is_(None)
+        )
+    ).order_by(models.Ad.created_at.desc()).limit(limit).all()
+
+def update_ad(db: Session, ad_id: int, ad_update: schemas.AdUpdate, reject_duplicates: bool = False):
+    db_ad = get_ad(db, ad_id=ad_id)
     if db_ad:
         update_data = ad_update.dict(exclude_unset=True)
+        if update_data.keys() & {"title", "description", "category_id"}:
+            signature = _check_duplicate(
+                db, db_ad, reject_duplicates,
+                update_data.get("title", db_ad.title),
+                update_data.get("description", db_ad.description),
+                db_ad.user_id,
+                update_data.get("category_id", db_ad.category_id),
+                exclude_ad_id=db_ad.ad_id
+            )
+        else:
+            signature = None
         for field, value in update_data.items():
             setattr(db_ad, field, value)
+        if signature is not None:
+            dedupe.index_ad(db, db_ad, signature)
+        _emit(db, AD_UPDATED, db_ad.ad_id)
         db.commit()
         db.refresh(db_ad)
     return db_ad
 
 def delete_ad(db: Session, ad_id: int):
-    db_ad = db.query(models.Ad).filter(models.Ad.ad_id == ad_id).first()
-    if db_ad:
-        db.delete(db_ad)
-        db.commit()
-    return db_ad
+    db_ad = get_ad(db, ad_id=ad_id)
+    if db_ad is None:
+        return None
+    db_ad.deleted_at = datetime.now()
+    purge_job = _enqueue_purge(db, PURGE_AD, ad_id)
+    _emit(db, AD_DELETED, ad_id)
+    db.commit()
+    db.refresh(purge_job)
+    return purge_job
 
 # Ad Image CRUD operations
-def create_ad_image(db: Session, ad_image: schemas.AdImageCreate):
-    db_ad_image = models.AdImage(**ad_image.dict())
+def _primary_image_url(db_image: models.AdImage):
+    return db_image.thumbnail_url or db_image.image_url
+
+def _add_ad_image(db: Session, db_ad_image: models.AdImage):
+    # Lock the ad row so concurrent uploads agree on positions and the primary image
+    db_ad = db.query(models.Ad).filter(models.Ad.ad_id == db_ad_image.ad_id).with_for_update().first()
+    last_position = db.query(func.max(models.AdImage.position)).filter(
+        models.AdImage.ad_id == db_ad_image.ad_id
+    ).scalar()
+    db_ad_image.position = 0 if last_position is None else last_position + 1
+    if db_ad is not None and db_ad.primary_image_url is None:
+        db_ad_image.is_primary = True
+        db_ad.primary_image_url = _primary_image_url(db_ad_image)
     db.add(db_ad_image)
     db.commit()
     db.refresh(db_ad_image)
     return db_ad_image
 
+def create_ad_image(db: Session, ad_image: schemas.AdImageCreate):
+    db_ad_image = models.AdImage(**ad_image.dict())
+    return _add_ad_image(db, db_ad_image)
+
+def create_uploaded_ad_image(db: Session, ad_id: int, image_url: str, content_hash: str):
+    # Reuse renditions already produced for identical content on another ad
+    rendered = db.query(models.AdImage).filter(
+        models.AdImage.content_hash == content_hash,
+        models.AdImage.thumbnail_url.isnot(None)
+    ).first()
+    db_ad_image = models.AdImage(
+        ad_id=ad_id,
+        image_url=image_url,
+        content_hash=content_hash,
+        thumbnail_url=rendered.thumbnail_url if rendered else None,
+        medium_url=rendered.medium_url if rendered else None
+    )
+    return _add_ad_image(db, db_ad_image)
+
+def get_ad_image_by_hash(db: Session, ad_id: int, content_hash: str):
+    return db.query(models.AdImage).filter(
+        and_(models.AdImage.ad_id == ad_id, models.AdImage.content_hash == content_hash)
+    ).first()
+
+def update_ad_image_renditions(db: Session, image_id: int, thumbnail_url: Optional[str], medium_url: Optional[str]):
+    db_image = db.query(models.AdImage).filter(models.AdImage.image_id == image_id).first()
+    if db_image:
+        db_image.thumbnail_url = thumbnail_url
+        db_image.medium_url = medium_url
+        if db_image.is_primary:
+            db.query(models.Ad).filter(models.Ad.ad_id == db_image.ad_id).update(
+                {models.Ad.primary_image_url: _primary_image_url(db_image)}, synchronize_session=False
+            )
+        db.commit()
+        db.refresh(db_image)
+    return db_image
+
+def set_primary_ad_image(db: Session, image_id: int):
+    db_image = db.query(models.AdImage).filter(models.AdImage.image_id == image_id).first()
+    if db_image:
+        db_ad = db.query(models.Ad).filter(models.Ad.ad_id == db_image.ad_id).with_for_update().first()
+        db.query(models.AdImage).filter(
+            and_(
+                models.AdImage.ad_id == db_image.ad_id,
+                models.AdImage.image_id != db_image.image_id,
+                models.AdImage.is_primary.is_(True)
+            )
+        ).update({models.AdImage.is_primary: False}, synchronize_session=False)
+        db_image.is_primary = True
+        if db_ad is not None:
+            db_ad.primary_image_url = _primary_image_url(db_image)
+        db.commit()
+        db.refresh(db_image)
+    return db_image
+
 def get_ad_images(db: Session, ad_id: int):
-    return db.query(models.AdImage).filter(models.AdImage.ad_id == ad_id).all()
+    return _join_live_ad(db.query(models.AdImage), models.AdImage.ad_id).filter(
+        models.AdImage.ad_id == ad_id
+    ).order_by(models.AdImage.position).all()
+
+def get_images_for_ads(db: Session, ad_ids: List[int], primary_only: bool = False):
+    if not ad_ids:
+        return []
+    query = _join_live_ad(db.query(models.AdImage), models.AdImage.ad_id).filter(models.AdImage.ad_id.in_(ad_ids))
+    if primary_only:
+        query = query.filter(models.AdImage.is_primary.is_(True))
+    return query.order_by(models.AdImage.ad_id, models.AdImage.position).all()
 
 def delete_ad_image(db: Session, image_id: int):
     db_image = db.query(models.AdImage).filter(models.AdImage.image_id == image_id).first()
     if db_image:
+        if db_image.is_primary:
+            db_ad = db.query(models.Ad).filter(models.Ad.ad_id == db_image.ad_id).with_for_update().first()
+            next_image = db.query(models.AdImage).filter(
+                and_(models.AdImage.ad_id == db_image.ad_id, models.AdImage.image_id != db_image.image_id)
+            ).order_by(models.AdImage.position).first()
+            if next_image is not None:
+                next_image.is_primary = True
+            if db_ad is not None:
+                db_ad.primary_image_url = _primary_image_url(next_image) if next_image is not None else None
         db.delete(db_image)
         db.commit()
     return db_image
 
+# Saved search operations
+def tokenize(text: Optional[str]):
+    return re.findall(r"[a-z0-9]+", (text or "").lower())
+
+def _saved_search_key(search: models.SavedSearch) -> str:
+    terms = tokenize(search.keywords)
+    if terms:
+        # Every term must match, so filing under one is enough; longer terms tend to be rarer
+        return "t:" + max(terms, key=len)[:118]
+    if search.category_id is not None:
+        return f"c:{search.category_id}"
+    return f"l:{search.location_id}"
+
+def _saved_search_matches(search: models.SavedSearch, db_ad: models.Ad, ad_terms: set) -> bool:
+    if search.user_id == db_ad.user_id:
+        return False
+    if search.category_id is not None and search.category_id != db_ad.category_id:
+        return False
+    if search.location_id is not None and search.location_id != db_ad.location_id:
+        return False
+    if search.min_price is not None and db_ad.price < search.min_price:
+        return False
+    if search.max_price is not None and db_ad.price > search.max_price:
+        return False
+    return all(term in ad_terms for term in tokenize(search.keywords))
+
+def create_saved_search(db: Session, saved_search: schemas.SavedSearchCreate):
+    db_search = models.SavedSearch(**saved_search.dict())
+    db.add(db_search)
+    db.flush()
+    db.add(models.SavedSearchKey(key=_saved_search_key(db_search), search_id=db_search.search_id))
+    db.commit()
+    db.refresh(db_search)
+    return db_search
+
+def get_user_saved_searches(db: Session, user_id: int):
+    return db.query(models.SavedSearch).filter(models.SavedSearch.user_id == user_id).all()
+
+def delete_saved_search(db: Session, search_id: int):
+    db_search = db.query(models.SavedSearch).filter(models.SavedSearch.search_id == search_id).first()
+    if db_search:
+        db.query(models.SavedSearchKey).filter(models.SavedSearchKey.search_id == search_id).delete(synchronize_session=False)
+        db.query(models.SavedSearchMatch).filter(models.SavedSearchMatch.search_id == search_id).delete(synchronize_session=False)
+        db.delete(db_search)
+        db.commit()
+    return db_search
+
+def match_saved_searches(db: Session, db_ad: models.Ad):
+    # Only searches filed under one of the ad's keys are candidates, so the cost
+    # follows the number of plausible searches rather than all saved searches
+    ad_terms = set(tokenize(db_ad.title)) | set(tokenize(db_ad.description))
+    keys = [f"c:{db_ad.category_id}"] + [f"t:{term[:118]}" for term in ad_terms]
+    if db_ad.location_id is not None:
+        keys.append(f"l:{db_ad.location_id}")
+    candidates = db.query(models.SavedSearch).join(
+        models.SavedSearchKey, models.SavedSearchKey.search_id == models.SavedSearch.search_id
+    ).filter(models.SavedSearchKey.key.in_(keys)).all()
+    # Safe to run twice for the same ad (outbox delivery is at least once)
+    already_matched = {
+        search_id for (search_id,) in db.query(models.SavedSearchMatch.search_id).filter(
+            models.SavedSearchMatch.ad_id == db_ad.ad_id
+        )
+    }
+    matches = [
+        models.SavedSearchMatch(search_id=search.search_id, ad_id=db_ad.ad_id, user_id=search.user_id)
+        for search in candidates
+        if search.search_id not in already_matched and _saved_search_matches(search, db_ad, ad_terms)
+    ]
+    db.add_all(matches)
+    return len(matches)
+
+def get_search_feed(db: Session, user_id: int, unseen_only: bool = False, skip: int = 0, limit: int = 100):
+    query = db.query(models.SavedSearchMatch).join(models.SavedSearchMatch.ad).options(
+        contains_eager(models.SavedSearchMatch.ad)
+    ).filter(
+        and_(models.SavedSearchMatch.user_id == user_id, models.Ad.deleted_at.is_(None))
+    )
+    if unseen_only:
+        query = query.filter(models.SavedSearchMatch.is_seen.is_(False))
+    return query.order_by(models.SavedSearchMatch.matched_at.desc()).offset(skip).limit(limit).all()
+
+def mark_search_feed_seen(db: Session, user_id: int):
+    updated = db.query(models.SavedSearchMatch).filter(
+        and_(models.SavedSearchMatch.user_id == user_id, models.SavedSearchMatch.is_seen.is_(False))
+    ).update({models.SavedSearchMatch.is_seen: True}, synchronize_session=False)
+    db.commit()
+    return updated
+
 # Favorite CRUD operations
 def create_favorite(db: Session, favorite: schemas.FavoriteCreate):
     db_favorite = models.Favorite(**favorite.dict())
     db.add(db_favorite)
+    _emit(db, FAVORITE_CREATED, favorite.ad_id, user_id=favorite.user_id)
     db.commit()
     db.refresh(db_favorite)
     return db_favorite
 
 def get_user_favorites(db: Session, user_id: int, skip: int = 0, limit: int = 100):
-    return db.query(models.Favorite).filter(models.Favorite.user_id == user_id).offset(skip).limit(limit).all()
+    return _join_live_ad(db.query(models.Favorite), models.Favorite.ad_id).filter(
+        and_(models.Favorite.user_id == user_id, _live_users(models.Favorite.user_id))
+    ).offset(skip).limit(limit).all()
 
 def delete_favorite(db: Session, user_id: int, ad_id: int):
     db_favorite = db.query(models.Favorite).filter(
@@ -208,6 +522,7 @@ def delete_favorite(db: Session, user_id: int, ad_id: int):
     ).first()
     if db_favorite:
         db.delete(db_favorite)
+        _emit(db, FAVORITE_DELETED, ad_id, user_id=user_id)
         db.commit()
     return db_favorite
 
@@ -220,26 +535,52 @@ def is_favorite(db: Session, user_id: int, ad_id: int):
 def create_message(db: Session, message: schemas.MessageCreate):
     db_message = models.Message(**message.dict())
     db.add(db_message)
+    db.flush()
+    _emit(db, MESSAGE_CREATED, message.ad_id, message_id=db_message.message_id, sender_id=message.sender_id)
     db.commit()
     db.refresh(db_message)
     return db_message
 
+def _messages_query(db: Session):
+    return _join_live_ad(db.query(models.Message), models.Message.ad_id).filter(
+        _live_users(models.Message.sender_id, models.Message.receiver_id)
+    )
+
 def get_messages_for_ad(db: Session, ad_id: int, skip: int = 0, limit: int = 100):
-    return db.query(models.Message).filter(models.Message.ad_id == ad_id).offset(skip).limit(limit).all()
+    return _messages_query(db).filter(models.Message.ad_id == ad_id).offset(skip).limit(limit).all()
 
-def get_conversation(db: Session, user1_id: int, user2_id: int, ad_id: int, skip: int = 0, limit: int = 100):
-    return db.query(models.Message).filter(
-        and_(
-            models.Message.ad_id == ad_id,
-            or_(
-                and_(models.Message.sender_id == user1_id, models.Message.receiver_id == user2_id),
-                and_(models.Message.sender_id == user2_id, models.Message.receiver_id == user1_id)
-            )
+def _conversation_filter(messages, user1_id: int, user2_id: int, ad_id: int):
+    return and_(
+        messages.ad_id == ad_id,
+        or_(
+            and_(messages.sender_id == user1_id, messages.receiver_id == user2_id),
+            and_(messages.sender_id == user2_id, messages.receiver_id == user1_id)
         )
-    ).order_by(models.Message.sent_at).offset(skip).limit(limit).all()
+    )
+
+def get_conversation(db: Session, user1_id: int, user2_id: int, ad_id: int, skip: int = 0, limit: int = 100, include_archived: bool = False):
+    deleted = db.query(models.User.user_id).filter(
+        and_(models.User.user_id.in_([user1_id, user2_id]), models.User.deleted_at.isnot(None))
+    ).first() or db.query(models.Ad.ad_id).filter(
+        and_(models.Ad.ad_id == ad_id, models.Ad.deleted_at.isnot(None))
+    ).first()
+    if deleted is not None:
+        return []
+    if not include_archived:
+        return db.query(models.Message).filter(
+            _conversation_filter(models.Message, user1_id, user2_id, ad_id)
+        ).order_by(models.Message.sent_at).offset(skip).limit(limit).all()
+    hot = models.Message.__table__
+    archived = models.ArchivedMessage.__table__
+    columns = [column.name for column in hot.columns]
+    messages = union_all(
+        select(*[hot.c[name] for name in columns]).where(_conversation_filter(hot.c, user1_id, user2_id, ad_id)),
+        select(*[archived.c[name] for name in columns]).where(_conversation_filter(archived.c, user1_id, user2_id, ad_id))
+    ).subquery()
+    return db.execute(select(messages).order_by(messages.c.sent_at).offset(skip).limit(limit)).all()
 
 def get_user_messages(db: Session, user_id: int, skip: int = 0, limit: int = 100):
-    return db.query(models.Message).filter(
+    return _messages_query(db).filter(
         or_(models.Message.sender_id == user_id, models.Message.receiver_id == user_id)
     ).offset(skip).limit(limit).all()
 
@@ -261,52 +602,301 @@ def delete_message(db: Session, message_id: int):
     return db_message
 
 # Report CRUD operations
+
+# Reason keywords -> weight of a single report in the moderation queue score
+REPORT_REASON_WEIGHTS = {
+    "fraud": 5.0,
+    "scam": 5.0,
+    "fake": 3.0,
+    "offensive": 3.0,
+    "prohibited": 3.0,
+    "misleading": 2.0,
+    "duplicate": 1.5,
+}
+DEFAULT_REPORT_WEIGHT = 1.0
+
+def report_weight(reason: Optional[str]) -> float:
+    reason = (reason or "").lower()
+    return max(
+        [weight for keyword, weight in REPORT_REASON_WEIGHTS.items() if keyword in reason],
+        default=DEFAULT_REPORT_WEIGHT
+    )
+
 def create_report(db: Session, report: schemas.ReportCreate):
     db_report = models.Report(**report.dict())
     db.add(db_report)
+    db.flush()
+    if db_report.ad_id is not None:
+        # Single-statement upsert, so concurrent first reports on an ad cannot race into a duplicate key
+        queue = models.ModerationQueueEntry.__table__
+        insert = mysql_insert(queue).values(
+            ad_id=db_report.ad_id,
+            report_count=1,
+            score=report_weight(db_report.reason),
+            last_reported_at=db_report.reported_at
+        )
+        db.execute(insert.on_duplicate_key_update(
+            report_count=queue.c.report_count + 1,
+            score=queue.c.score + insert.inserted.score,
+            last_reported_at=insert.inserted.last_reported_at
+        ))
     db.commit()
     db.refresh(db_report)
     return db_report
 
+def _reports_query(db: Session):
+    return _join_live_ad(db.query(models.Report), models.Report.ad_id).filter(_live_users(models.Report.reported_by))
+
 def get_reports(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Report).offset(skip).limit(limit).all()
+    return _reports_query(db).offset(skip).limit(limit).all()
 
 def get_reports_for_ad(db: Session, ad_id: int):
-    return db.query(models.Report).filter(models.Report.ad_id == ad_id).all()
+    return _reports_query(db).filter(models.Report.ad_id == ad_id).all()
+
+def _unqueue_report(db: Session, ad_id: Optional[int], reason: Optional[str]):
+    # Removes an already deleted report's contribution from the moderation queue
+    if ad_id is None:
+        return
+    entry = db.query(models.ModerationQueueEntry).filter(
+        models.ModerationQueueEntry.ad_id == ad_id
+    ).with_for_update().first()
+    if entry is None:
+        return
+    if entry.report_count <= 1:
+        db.delete(entry)
+    else:
+        entry.report_count -= 1
+        entry.score = max(entry.score - report_weight(reason), 0)
+        # Served by the (ad_id, reported_at) index
+        entry.last_reported_at = db.query(func.max(models.Report.reported_at)).filter(
+            models.Report.ad_id == ad_id
+        ).scalar()
 
 def delete_report(db: Session, report_id: int):
     db_report = db.query(models.Report).filter(models.Report.report_id == report_id).first()
     if db_report:
+        ad_id, reason = db_report.ad_id, db_report.reason
         db.delete(db_report)
+        db.flush()
+        _unqueue_report(db, ad_id, reason)
         db.commit()
     return db_report
 
+# Purge jobs
+PURGE_USER = "user"
+PURGE_AD = "ad"
+
+PURGE_PENDING = "pending"
+PURGE_RUNNING = "running"
+PURGE_COMPLETED = "completed"
+PURGE_FAILED = "failed"
+
+def _enqueue_purge(db: Session, target_type: str, target_id: int):
+    purge_job = models.PurgeJob(target_type=target_type, target_id=target_id, status=PURGE_PENDING)
+    db.add(purge_job)
+    return purge_job
+
+def get_purge_job(db: Session, job_id: int):
+    return db.query(models.PurgeJob).filter(models.PurgeJob.job_id == job_id).first()
+
+def get_purge_jobs(db: Session, status: Optional[str] = None, skip: int = 0, limit: int = 100):
+    query = db.query(models.PurgeJob)
+    if status is not None:
+        query = query.filter(models.PurgeJob.status == status)
+    return query.order_by(models.PurgeJob.job_id.desc()).offset(skip).limit(limit).all()
+
+# Moderation queue
+def get_moderation_queue(db: Session, skip: int = 0, limit: int = 100):
+    return db.query(models.ModerationQueueEntry).join(models.ModerationQueueEntry.ad).options(
+        contains_eager(models.ModerationQueueEntry.ad)
+    ).filter(models.Ad.deleted_at.is_(None)).order_by(
+        models.ModerationQueueEntry.score.desc(),
+        models.ModerationQueueEntry.last_reported_at.desc()
+    ).offset(skip).limit(limit).all()
+
+def rebuild_moderation_queue(db: Session):
+    rows = db.query(
+        models.Report.ad_id,
+        models.Report.reason,
+        func.count(models.Report.report_id),
+        func.max(models.Report.reported_at)
+    ).filter(models.Report.ad_id.isnot(None)).group_by(models.Report.ad_id, models.Report.reason).all()
+    entries = {}
+    for ad_id, reason, count, last_reported_at in rows:
+        entry = entries.setdefault(ad_id, models.ModerationQueueEntry(ad_id=ad_id, report_count=0, score=0))
+        entry.report_count += count
+        entry.score += count * report_weight(reason)
+        if entry.last_reported_at is None or last_reported_at > entry.last_reported_at:
+            entry.last_reported_at = last_reported_at
+    db.query(models.ModerationQueueEntry).delete(synchronize_session=False)
+    db.add_all(entries.values())
+    db.commit()
+    return len(entries)
+
 # Transaction CRUD operations
-def create_transaction(db: Session, transaction: schemas.TransactionCreate):
-    db_transaction = models.Transaction(**transaction.dict())
+class TransactionStateError(Exception):
+    pass
+
+PENDING = models.TransactionStatusEnum.PENDING.value
+COMPLETED = models.TransactionStatusEnum.COMPLETED.value
+CANCELLED = models.TransactionStatusEnum.CANCELLED.value
+
+# Allowed status changes. Moving to the current status is a no-op, so client retries are safe.
+TRANSACTION_TRANSITIONS = {
+    PENDING: {COMPLETED, CANCELLED},
+    COMPLETED: set(),
+    CANCELLED: set(),
+}
+
+def _lock_ad(db: Session, ad_id: Optional[int]):
+    # Row lock on the ad serializes workflow steps for one ad without blocking other ads.
+    # Locks are always taken ad first, then transaction, to avoid deadlocks.
+    if ad_id is None:
+        return None
+    return db.query(models.Ad).filter(
+        and_(models.Ad.ad_id == ad_id, models.Ad.deleted_at.is_(None))
+    ).with_for_update().populate_existing().first()
+
+def _lock_transaction(db: Session, transaction_id: int):
+    db_transaction = get_transaction(db, transaction_id=transaction_id)
+    if db_transaction is None:
+        return None, None
+    db_ad = _lock_ad(db, db_transaction.ad_id)
+    db_transaction = db.query(models.Transaction).filter(
+        models.Transaction.transaction_id == transaction_id
+    ).with_for_update().populate_existing().first()
+    return db_transaction, db_ad
+
+def _transition_transaction(db: Session, db_transaction: models.Transaction, db_ad: Optional[models.Ad], status):
+    current = _enum_value(db_transaction.status) or PENDING
+    target = _enum_value(status)
+    if current == target:
+        return
+    if target not in TRANSACTION_TRANSITIONS[current]:
+        raise TransactionStateError(f"Cannot change transaction status from {current} to {target}")
+    if target == COMPLETED:
+        if db_ad is None:
+            raise TransactionStateError("Ad is no longer available")
+        if db_ad.is_sold:
+            raise TransactionStateError("Ad is already sold")
+        db_ad.is_sold = True
+    _apply_transaction_rollup(db, db_transaction, sign=-1)
+    db_transaction.status = models.TransactionStatusEnum(target)
+    _apply_transaction_rollup(db, db_transaction, sign=1)
+
+def get_transaction_by_idempotency_key(db: Session, idempotency_key: str):
+    return db.query(models.Transaction).filter(
+        models.Transaction.idempotency_key == idempotency_key
+    ).with_for_update().first()
+
+def create_transaction(db: Session, transaction: schemas.TransactionCreate, idempotency_key: Optional[str] = None):
+    # Reserves the ad: creates a pending transaction unless the ad is sold or already reserved
+    db_ad = _lock_ad(db, transaction.ad_id)
+    if db_ad is None:
+        return None
+    if idempotency_key:
+        existing = get_transaction_by_idempotency_key(db, idempotency_key)
+        if existing is not None:
+            if (existing.ad_id, existing.buyer_id) != (transaction.ad_id, transaction.buyer_id):
+                raise TransactionStateError("Idempotency-Key was already used for a different transaction")
+            db.commit()
+            return existing
+    if db_ad.is_sold:
+        raise TransactionStateError("Ad is already sold")
+    if transaction.seller_id != db_ad.user_id:
+        raise TransactionStateError("Seller does not own this ad")
+    if transaction.buyer_id == db_ad.user_id:
+        raise TransactionStateError("Sellers cannot buy their own ads")
+    reserved = db.query(models.Transaction.transaction_id).filter(
+        and_(
+            models.Transaction.ad_id == transaction.ad_id,
+            models.Transaction.status == models.TransactionStatusEnum.PENDING
+        )
+    ).with_for_update().first()
+    if reserved is not None:
+        raise TransactionStateError("Ad is already reserved")
+    db_transaction = models.Transaction(
+        **transaction.dict(),
+        status=models.TransactionStatusEnum.PENDING,
+        idempotency_key=idempotency_key
+    )
     db.add(db_transaction)
-    db.commit()
+    try:
+        db.flush()
+        _apply_transaction_rollup(db, db_transaction, sign=1)
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        existing = get_transaction_by_idempotency_key(db, idempotency_key) if idempotency_key else None
+        if existing is None:
+            raise
+        db.commit()
+        return existing
     db.refresh(db_transaction)
     return db_transaction
 
 def get_transaction(db: Session, transaction_id: int):
     return db.query(models.Transaction).filter(models.Transaction.transaction_id == transaction_id).first()
 
+def _transactions_query(db: Session):
+    return _join_live_ad(db.query(models.Transaction), models.Transaction.ad_id).filter(
+        _live_users(models.Transaction.buyer_id, models.Transaction.seller_id)
+    )
+
 def get_transactions(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Transaction).offset(skip).limit(limit).all()
+    return _transactions_query(db).offset(skip).limit(limit).all()
+
+def _get_user_transactions(db: Session, role: str, user_id: int, skip: int, limit: int, include_archived: bool):
+    user_column = getattr(models.Transaction, role)
+    transactions = _transactions_query(db).filter(user_column == user_id).offset(skip).limit(limit).all()
+    if include_archived and len(transactions) < limit:
+        # Archived transactions are paged after all live ones, like get_ads_by_user
+        if transactions:
+            hot_total = skip + len(transactions)
+        else:
+            hot_total = _transactions_query(db).filter(user_column == user_id).with_entities(
+                func.count(models.Transaction.transaction_id)
+            ).scalar()
+        archived = models.ArchivedTransaction
+        transactions += db.query(archived).filter(
+            and_(getattr(archived, role) == user_id, _live_users(archived.buyer_id, archived.seller_id))
+        ).order_by(archived.transaction_id).offset(max(skip - hot_total, 0)).limit(limit - len(transactions)).all()
+    return transactions
 
-def get_user_transactions_as_buyer(db: Session, user_id: int, skip: int = 0, limit: int = 100):
-    return db.query(models.Transaction).filter(models.Transaction.buyer_id == user_id).offset(skip).limit(limit).all()
+def get_user_transactions_as_buyer(db: Session, user_id: int, skip: int = 0, limit: int = 100, include_archived: bool = False):
+    return _get_user_transactions(db, "buyer_id", user_id, skip, limit, include_archived)
 
-def get_user_transactions_as_seller(db: Session, user_id: int, skip: int = 0, limit: int = 100):
-    return db.query(models.Transaction).filter(models.Transaction.seller_id == user_id).offset(skip).limit(limit).all()
+def get_user_transactions_as_seller(db: Session, user_id: int, skip: int = 0, limit: int = 100, include_archived: bool = False):
+    return _get_user_transactions(db, "seller_id", user_id, skip, limit, include_archived)
 
 def update_transaction(db: Session, transaction_id: int, transaction_update: schemas.TransactionUpdate):
-    db_transaction = db.query(models.Transaction).filter(models.Transaction.transaction_id == transaction_id).first()
+    db_transaction, db_ad = _lock_transaction(db, transaction_id)
     if db_transaction:
         update_data = transaction_update.dict(exclude_unset=True)
-        for field, value in update_data.items():
-            setattr(db_transaction, field, value)
+        if "amount" in update_data and update_data["amount"] != db_transaction.amount:
+            if _enum_value(db_transaction.status) != PENDING:
+                raise TransactionStateError("Only pending transactions can change amount")
+            _apply_transaction_rollup(db, db_transaction, sign=-1)
+            db_transaction.amount = update_data["amount"]
+            _apply_transaction_rollup(db, db_transaction, sign=1)
+        if update_data.get("status") is not None:
+            _transition_transaction(db, db_transaction, db_ad, update_data["status"])
+        db.commit()
+        db.refresh(db_transaction)
+    return db_transaction
+
+def complete_transaction(db: Session, transaction_id: int):
+    db_transaction, db_ad = _lock_transaction(db, transaction_id)
+    if db_transaction:
+        _transition_transaction(db, db_transaction, db_ad, COMPLETED)
+        db.commit()
+        db.refresh(db_transaction)
+    return db_transaction
+
+def cancel_transaction(db: Session, transaction_id: int):
+    db_transaction, db_ad = _lock_transaction(db, transaction_id)
+    if db_transaction:
+        _transition_transaction(db, db_transaction, db_ad, CANCELLED)
         db.commit()
         db.refresh(db_transaction)
     return db_transaction
@@ -314,6 +904,163 @@ def update_transaction(db: Session, transaction_id: int, transaction_update: sch
 def delete_transaction(db: Session, transaction_id: int):
     db_transaction = db.query(models.Transaction).filter(models.Transaction.transaction_id == transaction_id).first()
     if db_transaction:
+        _apply_transaction_rollup(db, db_transaction, sign=-1)
         db.delete(db_transaction)
         db.commit()
-    return db_transaction 
\ No newline at end of file
+    return db_transaction
+
+# Transaction analytics rollups
+ROLLUP_SELLER = "seller"
+ROLLUP_CATEGORY = "category"
+ROLLUP_LOCATION = "location"
+ROLLUP_MARKETPLACE = "marketplace"
+
+def _enum_value(value):
+    return getattr(value, "value", value)
+
+def _rollup_deltas(status, amount, count: int):
+    # Rollup changes for `count` transactions in `status` whose amounts sum to `amount`
+    status = _enum_value(status) or PENDING
+    if status == COMPLETED:
+        return {"gmv": Decimal(amount or 0), "completed_count": count}
+    if status == CANCELLED:
+        return {"cancelled_count": count}
+    return {"pending_count": count}
+
+def _increment_rollup(db: Session, dimension: str, dimension_id: int, day: date, deltas: dict):
+    # Single-statement upsert, so concurrent first writes of a day cannot race into a duplicate key
+    rollup = models.TransactionDailyRollup.__table__
+    insert = mysql_insert(rollup).values(dimension=dimension, dimension_id=dimension_id, day=day, **deltas)
+    db.execute(insert.on_duplicate_key_update({field: rollup.c[field] + insert.inserted[field] for field in deltas}))
+
+def apply_rollup_event(db: Session, event: models.OutboxEvent):
+    # Runs in the outbox dispatcher's transaction, which also marks the event dispatched,
+    # so each event is counted exactly once
+    data = event.data
+    deltas = {field: Decimal(delta) if field == "gmv" else delta for field, delta in data["deltas"].items()}
+    for dimension, dimension_id in data["keys"]:
+        _increment_rollup(db, dimension, dimension_id, date.fromisoformat(data["day"]), deltas)
+
+def _apply_transaction_rollup(db: Session, db_transaction: models.Transaction, sign: int):
+    # Queues adding (sign=1) or removing (sign=-1) a transaction's contribution to every rollup it
+    # belongs to. The increments are applied by the outbox dispatcher rather than in the request,
+    # so hot rows like the marketplace total do not serialize transaction writes.
+    ad = db.query(models.Ad.category_id, models.Ad.location_id).filter(
+        models.Ad.ad_id == db_transaction.ad_id
+    ).first()
+    if ad is None:
+        # Archived transactions (removed by a purge) usually belong to an archived ad
+        ad = db.query(models.ArchivedAd.category_id, models.ArchivedAd.location_id).filter(
+            models.ArchivedAd.ad_id == db_transaction.ad_id
+        ).first()
+    keys = [(ROLLUP_MARKETPLACE, 0)]
+    if db_transaction.seller_id is not None:
+        keys.append((ROLLUP_SELLER, db_transaction.seller_id))
+    if ad is not None and ad.category_id is not None:
+        keys.append((ROLLUP_CATEGORY, ad.category_id))
+    if ad is not None and ad.location_id is not None:
+        keys.append((ROLLUP_LOCATION, ad.location_id))
+    deltas = _rollup_deltas(db_transaction.status, sign * Decimal(db_transaction.amount or 0), sign)
+    if "gmv" in deltas:
+        deltas["gmv"] = str(deltas["gmv"])
+    _emit(db, TRANSACTION_ROLLUP, db_transaction.transaction_id,
+          day=db_transaction.transaction_date.date().isoformat(), keys=keys, deltas=deltas)
+
+def get_daily_rollups(db: Session, dimension: str, dimension_id: int, start: date, end: date):
+    rollup = models.TransactionDailyRollup
+    return db.query(rollup).filter(
+        and_(
+            rollup.dimension == dimension,
+            rollup.dimension_id == dimension_id,
+            rollup.day >= start,
+            rollup.day <= end
+        )
+    ).order_by(rollup.day).all()
+
+def get_rollup_summary(db: Session, dimension: str, dimension_id: int, start: date, end: date):
+    rollup = models.TransactionDailyRollup
+    row = db.query(
+        func.coalesce(func.sum(rollup.gmv), 0),
+        func.coalesce(func.sum(rollup.completed_count), 0),
+        func.coalesce(func.sum(rollup.cancelled_count), 0),
+        func.coalesce(func.sum(rollup.pending_count), 0)
+    ).filter(
+        and_(
+            rollup.dimension == dimension,
+            rollup.dimension_id == dimension_id,
+            rollup.day >= start,
+            rollup.day <= end
+        )
+    ).one()
+    gmv, completed_count, cancelled_count, pending_count = row
+    return {
+        "gmv": gmv,
+        "completed_count": completed_count,
+        "cancelled_count": cancelled_count,
+        "pending_count": pending_count,
+        "average_price": round(Decimal(gmv) / completed_count, 2) if completed_count else None
+    }
+
+def _transactions_with_ads():
+    # Hot and archived transactions with their ad's category and location; archived
+    # transactions always moved together with their (archived) ad
+    def part(transactions, ads):
+        return select(
+            transactions.c.transaction_id, transactions.c.seller_id, transactions.c.amount,
+            transactions.c.status, transactions.c.transaction_date, ads.c.category_id, ads.c.location_id
+        ).select_from(transactions.outerjoin(ads, ads.c.ad_id == transactions.c.ad_id))
+    return union_all(
+        part(models.Transaction.__table__, models.Ad.__table__),
+        part(models.ArchivedTransaction.__table__, models.ArchivedAd.__table__)
+    ).subquery()
+
+def rebuild_transaction_rollups(db: Session):
+    rollup = models.TransactionDailyRollup
+    transaction = _transactions_with_ads()
+    day = func.date(transaction.c.transaction_date, type_=Date)
+    dimensions = [
+        (ROLLUP_MARKETPLACE, None),
+        (ROLLUP_SELLER, transaction.c.seller_id),
+        (ROLLUP_CATEGORY, transaction.c.category_id),
+        (ROLLUP_LOCATION, transaction.c.location_id),
+    ]
+    # This first read fixes the snapshot the recount below uses, so the events pending in it are exactly
+    # the increments the recount already includes; applying them afterwards would count them twice
+    pending_ids = [event_id for event_id, in db.query(models.OutboxEvent.event_id).filter(
+        and_(models.OutboxEvent.event_type == TRANSACTION_ROLLUP, models.OutboxEvent.status == outbox.PENDING)
+    )]
+    if pending_ids:
+        # The lock waits for a dispatcher applying one of them right now; those it finished are left alone,
+        # their increment is deleted with the rollup rows and recounted like the rest
+        taken_over = [event_id for event_id, in db.query(models.OutboxEvent.event_id).filter(
+            and_(models.OutboxEvent.event_id.in_(pending_ids), models.OutboxEvent.status == outbox.PENDING)
+        ).with_for_update()]
+        if taken_over:
+            db.query(models.OutboxEvent).filter(models.OutboxEvent.event_id.in_(taken_over)).update(
+                {models.OutboxEvent.status: outbox.DISPATCHED, models.OutboxEvent.dispatched_at: datetime.now()},
+                synchronize_session=False
+            )
+    db.query(rollup).delete(synchronize_session=False)
+    totals = {}
+    for dimension, column in dimensions:
+        key_column = column if column is not None else literal(0)
+        query = db.query(
+            key_column, day, transaction.c.status, func.count(transaction.c.transaction_id), func.sum(transaction.c.amount)
+        ).select_from(transaction)
+        if column is not None:
+            query = query.filter(column.isnot(None)).group_by(column, day, transaction.c.status)
+        else:
+            query = query.group_by(day, transaction.c.status)
+        for dimension_id, rollup_day, status, count, amount in query.all():
+            entry = totals.setdefault(
+                (dimension, dimension_id, rollup_day),
+                {"gmv": Decimal(0), "completed_count": 0, "cancelled_count": 0, "pending_count": 0}
+            )
+            for field, delta in _rollup_deltas(status, amount, count).items():
+                entry[field] += delta
+    db.add_all(
+        rollup(dimension=dimension, dimension_id=dimension_id, day=rollup_day, **fields)
+        for (dimension, dimension_id, rollup_day), fields in totals.items()
+    )
+    db.commit()
+    return len(totals)
@@ -9,7 +9,8 @@ CREATE TABLE users (
     phone VARCHAR(20),
     password VARCHAR(255) NOT NULL,
     profile_picture VARCHAR(255),
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    deleted_at TIMESTAMP NULL
 );
 
 -- 2. LOCATIONS TABLE
@@ -39,11 +40,16 @@ CREATE TABLE ads (
     price DECIMAL(10, 2) NOT NULL,
     `condition` ENUM('New', 'Used') NOT NULL,
     is_sold BOOLEAN DEFAULT FALSE,
+    primary_image_url VARCHAR(255),
+    minhash BLOB,
+    duplicate_of INT,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    deleted_at TIMESTAMP NULL,
     FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
     FOREIGN KEY (category_id) REFERENCES categories(category_id),
-    FOREIGN KEY (location_id) REFERENCES locations(location_id)
+    FOREIGN KEY (location_id) REFERENCES locations(location_id),
+    FOREIGN KEY (duplicate_of) REFERENCES ads(ad_id) ON DELETE SET NULL
 );
 
 -- 5. IMAGES FOR ADS
@@ -51,6 +57,13 @@ CREATE TABLE ad_images (
     image_id INT PRIMARY KEY AUTO_INCREMENT,
     ad_id INT,
     image_url VARCHAR(255),
+    content_hash CHAR(64),
+    thumbnail_url VARCHAR(255),
+    medium_url VARCHAR(255),
+    position INT NOT NULL DEFAULT 0,
+    is_primary BOOLEAN NOT NULL DEFAULT FALSE,
+    INDEX ix_ad_images_content_hash (content_hash),
+    INDEX ix_ad_images_ad_id_position (ad_id, position),
     FOREIGN KEY (ad_id) REFERENCES ads(ad_id) ON DELETE CASCADE
 );
 
@@ -83,6 +96,7 @@ CREATE TABLE reports (
     reported_by INT,
     reason TEXT,
     reported_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX ix_reports_ad_id_reported_at (ad_id, reported_at),
     FOREIGN KEY (ad_id) REFERENCES ads(ad_id),
     FOREIGN KEY (reported_by) REFERENCES users(user_id)
 );
@@ -96,11 +110,230 @@ CREATE TABLE transactions (
     amount DECIMAL(10, 2),
     status ENUM('Pending', 'Completed', 'Cancelled') DEFAULT 'Pending',
     transaction_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    idempotency_key VARCHAR(64) UNIQUE,
+    INDEX ix_transactions_ad_id_status (ad_id, status),
     FOREIGN KEY (ad_id) REFERENCES ads(ad_id),
     FOREIGN KEY (buyer_id) REFERENCES users(user_id),
     FOREIGN KEY (seller_id) REFERENCES users(user_id)
 );
 
+-- 10. MODERATION QUEUE (per-ad report aggregates, maintained on report create/delete)
+CREATE TABLE moderation_queue (
+    ad_id INT PRIMARY KEY,
+    report_count INT NOT NULL DEFAULT 0,
+    score FLOAT NOT NULL DEFAULT 0,
+    last_reported_at TIMESTAMP NULL,
+    INDEX ix_moderation_queue_priority (score, last_reported_at),
+    FOREIGN KEY (ad_id) REFERENCES ads(ad_id) ON DELETE CASCADE
+);
+
+-- 11. TRANSACTION DAILY ROLLUPS (per seller / category / location / marketplace, maintained on transaction writes)
+CREATE TABLE transaction_daily_rollups (
+    dimension VARCHAR(20) NOT NULL,
+    dimension_id INT NOT NULL,
+    day DATE NOT NULL,
+    gmv DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    completed_count INT NOT NULL DEFAULT 0,
+    cancelled_count INT NOT NULL DEFAULT 0,
+    pending_count INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (dimension, dimension_id, day)
+);
+
+-- 12. SAVED SEARCHES
+CREATE TABLE saved_searches (
+    search_id INT PRIMARY KEY AUTO_INCREMENT,
+    user_id INT NOT NULL,
+    keywords VARCHAR(255),
+    category_id INT,
+    location_id INT,
+    min_price DECIMAL(10, 2),
+    max_price DECIMAL(10, 2),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX ix_saved_searches_user_id (user_id),
+    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
+    FOREIGN KEY (category_id) REFERENCES categories(category_id) ON DELETE CASCADE,
+    FOREIGN KEY (location_id) REFERENCES locations(location_id) ON DELETE CASCADE
+);
+
+-- Reverse index used to find candidate saved searches for a new ad
+CREATE TABLE saved_search_keys (
+    `key` VARCHAR(120) NOT NULL,
+    search_id INT NOT NULL,
+    PRIMARY KEY (`key`, search_id),
+    FOREIGN KEY (search_id) REFERENCES saved_searches(search_id) ON DELETE CASCADE
+);
+
+-- Per-user "new results" feed
+CREATE TABLE saved_search_matches (
+    search_id INT NOT NULL,
+    ad_id INT NOT NULL,
+    user_id INT NOT NULL,
+    matched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    is_seen BOOLEAN NOT NULL DEFAULT FALSE,
+    PRIMARY KEY (search_id, ad_id),
+    INDEX ix_saved_search_matches_user_id_matched_at (user_id, matched_at),
+    FOREIGN KEY (search_id) REFERENCES saved_searches(search_id) ON DELETE CASCADE,
+    FOREIGN KEY (ad_id) REFERENCES ads(ad_id) ON DELETE CASCADE,
+    FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+);
+
+-- 13. TRENDING SNAPSHOTS (periodic copy of the in-memory trending lists)
+CREATE TABLE trending_snapshots (
+    scope VARCHAR(60) NOT NULL,
+    ad_id INT NOT NULL,
+    score FLOAT NOT NULL,
+    snapshot_at TIMESTAMP NULL,
+    PRIMARY KEY (scope, ad_id)
+);
+
+-- 14. ARCHIVE TABLES (cold copies of sold/expired ads and old messages; same columns, no foreign keys)
+CREATE TABLE ads_archive (
+    ad_id INT PRIMARY KEY,
+    user_id INT NOT NULL,
+    category_id INT NOT NULL,
+    location_id INT,
+    title VARCHAR(255) NOT NULL,
+    description TEXT NOT NULL,
+    price DECIMAL(10, 2) NOT NULL,
+    `condition` ENUM('New', 'Used') NOT NULL,
+    is_sold BOOLEAN,
+    primary_image_url VARCHAR(255),
+    minhash BLOB,
+    duplicate_of INT,
+    created_at TIMESTAMP NULL,
+    updated_at TIMESTAMP NULL,
+    deleted_at TIMESTAMP NULL,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX ix_ads_archive_user_id (user_id)
+);
+
+CREATE TABLE ad_images_archive (
+    image_id INT PRIMARY KEY,
+    ad_id INT,
+    image_url VARCHAR(255),
+    content_hash CHAR(64),
+    thumbnail_url VARCHAR(255),
+    medium_url VARCHAR(255),
+    position INT NOT NULL DEFAULT 0,
+    is_primary BOOLEAN NOT NULL DEFAULT FALSE,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX ix_ad_images_archive_ad_id (ad_id)
+);
+
+CREATE TABLE favorites_archive (
+    user_id INT,
+    ad_id INT,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, ad_id)
+);
+
+CREATE TABLE messages_archive (
+    message_id INT PRIMARY KEY,
+    sender_id INT NOT NULL,
+    receiver_id INT NOT NULL,
+    ad_id INT NOT NULL,
+    message TEXT NOT NULL,
+    sent_at TIMESTAMP NULL,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX ix_messages_archive_ad_id_sent_at (ad_id, sent_at)
+);
+
+CREATE TABLE reports_archive (
+    report_id INT PRIMARY KEY,
+    ad_id INT,
+    reported_by INT,
+    reason TEXT,
+    reported_at TIMESTAMP NULL,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX ix_reports_archive_ad_id (ad_id)
+);
+
+CREATE TABLE transactions_archive (
+    transaction_id INT PRIMARY KEY,
+    ad_id INT,
+    buyer_id INT,
+    seller_id INT,
+    amount DECIMAL(10, 2),
+    status ENUM('Pending', 'Completed', 'Cancelled'),
+    transaction_date TIMESTAMP NULL,
+    idempotency_key VARCHAR(64),
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX ix_transactions_archive_ad_id (ad_id),
+    INDEX ix_transactions_archive_buyer_id (buyer_id),
+    INDEX ix_transactions_archive_seller_id (seller_id)
+);
+
+-- 15. PURGE JOBS (background removal of soft-deleted users and ads; progress is committed with each batch)
+CREATE TABLE purge_jobs (
+    job_id INT PRIMARY KEY AUTO_INCREMENT,
+    target_type VARCHAR(10) NOT NULL,
+    target_id INT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    step VARCHAR(40),
+    rows_deleted INT NOT NULL DEFAULT 0,
+    attempts INT NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    completed_at TIMESTAMP NULL,
+    INDEX ix_purge_jobs_status (status, job_id)
+);
+
+-- 16. OUTBOX EVENTS (written with each entity change, delivered to in-process handlers by the outbox dispatcher)
+CREATE TABLE outbox_events (
+    event_id INT PRIMARY KEY AUTO_INCREMENT,
+    event_type VARCHAR(50) NOT NULL,
+    aggregate_id INT NOT NULL,
+    payload TEXT,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INT NOT NULL DEFAULT 0,
+    available_at TIMESTAMP NULL,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    dispatched_at TIMESTAMP NULL,
+    INDEX ix_outbox_events_status_available_at (status, available_at)
+);
+
+-- 17. AD LSH BUCKETS (MinHash band buckets for near-duplicate detection, scoped by seller and category)
+CREATE TABLE ad_lsh_buckets (
+    user_id INT NOT NULL,
+    category_id INT NOT NULL,
+    band INT NOT NULL,
+    bucket BIGINT NOT NULL,
+    ad_id INT NOT NULL,
+    PRIMARY KEY (user_id, category_id, band, bucket, ad_id),
+    INDEX ix_ad_lsh_buckets_ad_id (ad_id),
+    FOREIGN KEY (ad_id) REFERENCES ads(ad_id) ON DELETE CASCADE
+);
+
+-- 18. SHARED EVENT STATE (written by outbox handlers so every worker process sees the same data)
+CREATE TABLE trending_events (
+    event_id INT PRIMARY KEY AUTO_INCREMENT,
+    ad_id INT NOT NULL,
+    category_id INT,
+    location_id INT,
+    weight FLOAT NOT NULL,
+    occurred_at TIMESTAMP NOT NULL,
+    INDEX ix_trending_events_occurred_at (occurred_at)
+);
+
+CREATE TABLE similar_ads_dirty (
+    ad_id INT PRIMARY KEY,
+    mark_count INT NOT NULL DEFAULT 1,
+    marked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- 19. JOB RUNS (status of the latest archival / backfill run, shared by all worker processes)
+CREATE TABLE job_runs (
+    job VARCHAR(40) PRIMARY KEY,
+    status VARCHAR(20) NOT NULL,
+    progress TEXT,
+    error TEXT,
+    started_at TIMESTAMP NULL,
+    finished_at TIMESTAMP NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
+
 -- SAMPLE DATA INSERTS
 
 -- Users
@@ -134,11 +367,15 @@ VALUES
 (3, 5, 1, 'Haier Air Conditioner 1.5 Ton', 'Brand new AC with warranty.', 75000, 'New');
 
 -- Ad Images
-INSERT INTO ad_images (ad_id, image_url)
+INSERT INTO ad_images (ad_id, image_url, position, is_primary)
 VALUES
-(1, 'iphone13.jpg'),
-(2, 'civic2020.jpg'),
-(3, 'haier_ac.jpg');
+(1, 'iphone13.jpg', 0, TRUE),
+(2, 'civic2020.jpg', 0, TRUE),
+(3, 'haier_ac.jpg', 0, TRUE);
+
+UPDATE ads
+JOIN ad_images ON ad_images.ad_id = ads.ad_id AND ad_images.is_primary
+SET ads.primary_image_url = ad_images.image_url;
 
 -- Favorites
 INSERT INTO favorites (user_id, ad_id)
@@ -160,8 +397,45 @@ VALUES
 (2, 1, 'Misleading price'),
 (3, 2, 'Duplicate post');
 
+-- Moderation queue (weights: misleading = 2, duplicate = 1.5)
+INSERT INTO moderation_queue (ad_id, report_count, score, last_reported_at)
+SELECT ad_id, COUNT(*), SUM(CASE
+        WHEN reason LIKE '%misleading%' THEN 2
+        WHEN reason LIKE '%duplicate%' THEN 1.5
+        ELSE 1
+    END), MAX(reported_at)
+FROM reports
+GROUP BY ad_id;
+
 -- Transactions
 INSERT INTO transactions (ad_id, buyer_id, seller_id, amount, status)
 VALUES
 (1, 2, 1, 195000, 'Completed'),
 (3, 1, 3, 75000, 'Pending');
+
+-- Transaction rollups (call POST /analytics/rebuild after bulk-loading transactions)
+INSERT INTO transaction_daily_rollups (dimension, dimension_id, day, gmv, completed_count, cancelled_count, pending_count)
+SELECT 'seller', t.seller_id, DATE(t.transaction_date),
+    SUM(CASE WHEN t.status = 'Completed' THEN t.amount ELSE 0 END),
+    SUM(t.status = 'Completed'), SUM(t.status = 'Cancelled'), SUM(t.status = 'Pending')
+FROM transactions t
+GROUP BY t.seller_id, DATE(t.transaction_date)
+UNION ALL
+SELECT 'category', a.category_id, DATE(t.transaction_date),
+    SUM(CASE WHEN t.status = 'Completed' THEN t.amount ELSE 0 END),
+    SUM(t.status = 'Completed'), SUM(t.status = 'Cancelled'), SUM(t.status = 'Pending')
+FROM transactions t JOIN ads a ON a.ad_id = t.ad_id
+GROUP BY a.category_id, DATE(t.transaction_date)
+UNION ALL
+SELECT 'location', a.location_id, DATE(t.transaction_date),
+    SUM(CASE WHEN t.status = 'Completed' THEN t.amount ELSE 0 END),
+    SUM(t.status = 'Completed'), SUM(t.status = 'Cancelled'), SUM(t.status = 'Pending')
+FROM transactions t JOIN ads a ON a.ad_id = t.ad_id
+WHERE a.location_id IS NOT NULL
+GROUP BY a.location_id, DATE(t.transaction_date)
+UNION ALL
+SELECT 'marketplace', 0, DATE(t.transaction_date),
+    SUM(CASE WHEN t.status = 'Completed' THEN t.amount ELSE 0 END),
+    SUM(t.status = 'Completed'), SUM(t.status = 'Cancelled'), SUM(t.status = 'Pending')
+FROM transactions t
+GROUP BY DATE(t.transaction_date);
@@ -0,0 +1,178 @@
+import hashlib
+import logging
+import re
+import threading
+import unicodedata
+import zlib
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import and_, tuple_
+from sqlalchemy.orm import Session
+
+import jobs
+import models
+
+logger = logging.getLogger(__name__)
+
+# 64 MinHash permutations split into 16 LSH bands of 4 rows: ads whose estimated
+# Jaccard similarity is above ~0.5 share at least one band bucket with high probability
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 3
+# Estimated Jaccard similarity at which an ad counts as a near-duplicate
+DUPLICATE_THRESHOLD = 0.8
+
+_PRIME = np.uint64((1 << 31) - 1)
+_rng = np.random.default_rng(0xD3D0)
+_A = _rng.integers(1, int(_PRIME), size=NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, int(_PRIME), size=NUM_PERM, dtype=np.uint64)
+_EMPTY = np.full(NUM_PERM, int(_PRIME), dtype=np.uint32)
+
+BACKFILL_JOB = "duplicate_backfill"
+# Keeps a second backfill in this process from starting; progress is shared through job_runs
+_backfill_lock = threading.Lock()
+
+
+def normalize(text: Optional[str]) -> List[str]:
+    # Accent- and case-insensitive word tokens
+    text = unicodedata.normalize("NFKD", text or "").encode("ascii", "ignore").decode("ascii")
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+def shingles(title: Optional[str], description: Optional[str]) -> List[str]:
+    words = normalize(title) + normalize(description)
+    if len(words) < SHINGLE_SIZE:
+        return [" ".join(words)] if words else []
+    return [" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)]
+
+
+def signature(title: Optional[str], description: Optional[str]) -> np.ndarray:
+    """MinHash signature (NUM_PERM uint32 values) of the ad's word shingles."""
+    values = {zlib.crc32(shingle.encode()) for shingle in shingles(title, description)}
+    if not values:
+        return _EMPTY.copy()
+    hashes = np.fromiter(values, dtype=np.uint64, count=len(values)) % _PRIME
+    # (a * x + b) mod p for every shingle and permutation, then the minimum per permutation
+    return ((hashes[:, None] * _A[None, :] + _B[None, :]) % _PRIME).min(axis=0).astype(np.uint32)
+
+
+def band_buckets(sig: np.ndarray) -> List[Tuple[int, int]]:
+    buckets = []
+    for band in range(BANDS):
+        digest = hashlib.blake2b(sig[band * ROWS:(band + 1) * ROWS].tobytes(), digest_size=8).digest()
+        buckets.append((band, int.from_bytes(digest, "big", signed=True)))
+    return buckets
+
+
+def similarity(first: np.ndarray, second: np.ndarray) -> float:
+    return float(np.count_nonzero(first == second)) / NUM_PERM
+
+
+def find_duplicate(db: Session, user_id: int, category_id: int, sig: np.ndarray,
+                   exclude_ad_id: Optional[int] = None) -> Optional[Tuple[int, float]]:
+    """Most similar live ad by the same seller in the same category, if above the threshold.
+
+    Only ads sharing a band bucket are compared, via the primary key of ad_lsh_buckets.
+    """
+    if np.array_equal(sig, _EMPTY):
+        return None
+    bucket = models.AdLshBucket
+    candidate_ids = {
+        ad_id for (ad_id,) in db.query(bucket.ad_id).filter(
+            and_(
+                bucket.user_id == user_id,
+                bucket.category_id == category_id,
+                tuple_(bucket.band, bucket.bucket).in_(band_buckets(sig))
+            )
+        ).distinct()
+    }
+    candidate_ids.discard(exclude_ad_id)
+    if not candidate_ids:
+        return None
+    candidates = db.query(models.Ad.ad_id, models.Ad.minhash).filter(
+        and_(models.Ad.ad_id.in_(candidate_ids), models.Ad.deleted_at.is_(None))
+    ).all()
+    best = None
+    for ad_id, minhash in candidates:
+        if minhash is None:
+            continue
+        score = similarity(sig, np.frombuffer(minhash, dtype=np.uint32))
+        if score >= DUPLICATE_THRESHOLD and (best is None or score > best[1]):
+            best = (ad_id, score)
+    return best
+
+
+def index_ad(db: Session, db_ad: models.Ad, sig: np.ndarray):
+    """Store the ad's signature and (re)file it under its band buckets."""
+    db_ad.minhash = sig.tobytes()
+    db.query(models.AdLshBucket).filter(models.AdLshBucket.ad_id == db_ad.ad_id).delete(synchronize_session=False)
+    if np.array_equal(sig, _EMPTY):
+        return
+    db.add_all([
+        models.AdLshBucket(user_id=db_ad.user_id, category_id=db_ad.category_id, band=band, bucket=bucket_hash,
+                           ad_id=db_ad.ad_id)
+        for band, bucket_hash in band_buckets(sig)
+    ])
+
+
+def backfill_chunk(db: Session, after_ad_id: int, chunk_size: int) -> Tuple[int, int, int]:
+    """Index the next chunk of ads in ad_id order; each ad is checked against the ones before it.
+
+    Returns (last ad_id, ads indexed, ads flagged).
+    """
+    ads = db.query(models.Ad).filter(
+        and_(models.Ad.ad_id > after_ad_id, models.Ad.deleted_at.is_(None))
+    ).order_by(models.Ad.ad_id).limit(chunk_size).all()
+    flagged = 0
+    for db_ad in ads:
+        sig = signature(db_ad.title, db_ad.description)
+        duplicate = find_duplicate(db, db_ad.user_id, db_ad.category_id, sig, exclude_ad_id=db_ad.ad_id)
+        if duplicate is not None and duplicate[0] < db_ad.ad_id:
+            db_ad.duplicate_of = duplicate[0]
+            flagged += 1
+        index_ad(db, db_ad, sig)
+        db.flush()
+    db.commit()
+    return (ads[-1].ad_id if ads else after_ad_id), len(ads), flagged
+
+
+def run_backfill(session_factory: Callable, chunk_size: int = 500):
+    """Build signatures and LSH buckets for every existing ad, one committed chunk at a time."""
+    if not _backfill_lock.acquire(blocking=False):
+        logger.info("Duplicate index backfill already running")
+        return None
+    started_at = datetime.now()
+    progress = {"indexed": 0, "flagged": 0, "last_ad_id": 0}
+    status, error = jobs.FAILED, None
+    db = session_factory()
+    try:
+        jobs.save(db, BACKFILL_JOB, jobs.RUNNING, started_at, progress)
+        while True:
+            last_ad_id, indexed, flagged = backfill_chunk(db, progress["last_ad_id"], chunk_size)
+            if not indexed:
+                break
+            progress["last_ad_id"] = last_ad_id
+            progress["indexed"] += indexed
+            progress["flagged"] += flagged
+            jobs.save(db, BACKFILL_JOB, jobs.RUNNING, started_at, progress)
+        status = jobs.COMPLETED
+    except Exception as e:
+        db.rollback()
+        logger.exception("Duplicate index backfill failed")
+        error = str(e)
+    finally:
+        try:
+            jobs.save(db, BACKFILL_JOB, status, started_at, progress, finished_at=datetime.now(), error=error)
+        finally:
+            db.close()
+            _backfill_lock.release()
+    return {"status": status, **progress}
+
+
+if __name__ == "__main__":
+    from main import SessionLocal
+
+    print(run_backfill(SessionLocal))
@@ -0,0 +1,34 @@
+import json
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.orm import Session
+
+import models
+
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+
+def save(db: Session, job: str, status: str, started_at: datetime, progress: dict,
+         finished_at: Optional[datetime] = None, error: Optional[str] = None):
+    """Overwrite the job's status row and commit it, so every worker process reports the same run."""
+    values = dict(status=status, started_at=started_at, finished_at=finished_at, error=error,
+                  progress=json.dumps(progress))
+    insert = mysql_insert(models.JobRun.__table__).values(job=job, **values)
+    db.execute(insert.on_duplicate_key_update(**values))
+    db.commit()
+
+
+def status(db: Session, job: str) -> dict:
+    run = db.query(models.JobRun).filter(models.JobRun.job == job).first()
+    if run is None:
+        return {"status": "idle"}
+    result = {"status": run.status, "started_at": run.started_at, **run.data}
+    if run.finished_at is not None:
+        result["finished_at"] = run.finished_at
+    if run.error:
+        result["error"] = run.error
+    return result
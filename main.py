@@ -1,15 +1,62 @@
-from fastapi import FastAPI, Depends, HTTPException, Query
+from fastapi import FastAPI, Depends, HTTPException, Query, UploadFile, File, Header, BackgroundTasks, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.staticfiles import StaticFiles
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, Session
-from typing import List, Optional
+from typing import Dict, List, Optional
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import models
 import schemas
 import crud
+import storage
+import recommendations
+import trending
+import archive
+import purge
+import admission
+import outbox
+import dedupe
+import refdata
+import typeahead
+import jobs
 
 # Database configuration - credentials directly in main file
 DATABASE_URL = "mysql+pymysql://root:@localhost/olx_clone"
 
+# Media storage - uploaded ad images are stored on local disk and served under MEDIA_URL
+MEDIA_ROOT = "media"
+MEDIA_URL = "/media"
+MAX_IMAGE_UPLOAD_SIZE = 15 * 1024 * 1024
+
+# Precomputed similar-ads index (build with `python recommendations.py`)
+RECOMMENDATIONS_PATH = "data/similar_ads"
+
+# Memory-mapped snapshot of locations and categories shared by all worker processes
+REFERENCE_DATA_PATH = "data/reference"
+
+# Near-duplicate ads (same seller and category) are flagged via duplicate_of; set to True to reject them with 409
+REJECT_DUPLICATE_ADS = False
+
+# Server-enforced page sizes; reference data (locations, categories) is small and fetched whole
+MAX_PAGE_SIZE = 100
+MAX_REFERENCE_PAGE_SIZE = 1000
+MAX_IMAGE_BATCH_IDS = 100
+
+# Admission control: concurrent requests per route prefix (most specific prefix wins) and their
+# priority. Lower priorities get a shorter queue budget and are shed first under load.
+ROUTE_LIMITS = [
+    admission.RouteLimit("/transactions", max_concurrent=16, priority=admission.HIGH),
+    admission.RouteLimit("/messages", max_concurrent=16, priority=admission.HIGH),
+    admission.RouteLimit("/ads/search", max_concurrent=8, priority=admission.LOW),
+    admission.RouteLimit("/analytics", max_concurrent=4, priority=admission.LOW),
+    admission.RouteLimit("/recommendations", max_concurrent=1, priority=admission.LOW),
+    admission.RouteLimit("/archive", max_concurrent=1, priority=admission.LOW),
+    admission.RouteLimit("/moderation/queue/rebuild", max_concurrent=1, priority=admission.LOW),
+    admission.RouteLimit("/moderation/duplicates/backfill", max_concurrent=1, priority=admission.LOW),
+    admission.RouteLimit("/", max_concurrent=32, priority=admission.NORMAL),
+]
+
 # Create database engine
 engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -24,6 +71,18 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# Admission control runs inside CORS so rejections still carry CORS headers
+app.add_middleware(
+    admission.AdmissionMiddleware,
+    route_limits=ROUTE_LIMITS,
+    store=admission.InMemoryBucketStore(),
+    ip_rate=20.0,
+    ip_burst=40,
+    user_rate=10.0,
+    user_burst=20,
+    max_in_flight=64,
+)
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -33,6 +92,52 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Image storage and background rendition workers
+image_storage = storage.LocalStorage(MEDIA_ROOT, MEDIA_URL)
+rendition_worker = storage.RenditionWorker(image_storage, SessionLocal)
+app.mount(MEDIA_URL, StaticFiles(directory=image_storage.root), name="media")
+
+# In-memory trending counters fed by views, favorites and messages
+trending_ads = trending.TrendingAggregator()
+TRENDING_SNAPSHOT_INTERVAL = 300
+
+# Side effects of writes (saved-search matching, similar-ads refresh marks, trending counters)
+# are recorded in the outbox by crud and applied by this dispatcher after the request returns
+outbox_dispatcher = outbox.OutboxDispatcher(SessionLocal, poll_interval=0.5)
+
+# Deleted users and ads are hidden immediately and removed by this worker in small batches
+purge_worker = purge.PurgeWorker(SessionLocal)
+
+# Reference data reads are served from the shared snapshot; writes rebuild it for every worker
+reference_data = refdata.ReferenceData(REFERENCE_DATA_PATH)
+
+# Location/category pickers are answered from an in-memory prefix index over the snapshot
+suggestions = typeahead.Typeahead(reference_data)
+
+# Similar ads are answered from memory-mapped arrays; writes only mark ads for the next refresh
+similar_ads = recommendations.SimilarAdsIndex(RECOMMENDATIONS_PATH)
+
+@app.on_event("startup")
+def load_indexes():
+    similar_ads.load()
+    similar_ads.start(SessionLocal)
+    run_with_session(reference_data.ensure)
+    suggestions.start(SessionLocal)
+    run_with_session(trending_ads.restore)
+    trending_ads.start(SessionLocal, interval=TRENDING_SNAPSHOT_INTERVAL)
+    purge_worker.start()
+    outbox_dispatcher.start()
+
+@app.on_event("shutdown")
+def shutdown_workers():
+    trending_ads.stop(SessionLocal)
+    purge_worker.stop()
+    outbox_dispatcher.stop()
+    suggestions.stop()
+    similar_ads.stop()
+    rendition_worker.shutdown()
+    query_executor.shutdown(wait=False)
+
 # Dependency to get database session
 def get_db():
     db = SessionLocal()
@@ -41,6 +146,26 @@ def get_db():
     finally:
         db.close()
 
+# Runs independent queries of composite endpoints in parallel, each with its own session
+query_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="queries")
+
+def run_with_session(func, *args, **kwargs):
+    db = SessionLocal()
+    try:
+        return func(db, *args, **kwargs)
+    finally:
+        db.close()
+
+# Rows pointing at soft-deleted users or ads would be written after their purge step ran
+def _require_users(db: Session, *user_ids: int):
+    for user_id in user_ids:
+        if crud.get_user(db, user_id=user_id) is None:
+            raise HTTPException(status_code=404, detail="User not found")
+
+def _require_ad(db: Session, ad_id: int):
+    if crud.get_ad(db, ad_id=ad_id) is None:
+        raise HTTPException(status_code=404, detail="Ad not found")
+
 # Root endpoint
 @app.get("/")
 def read_root():
@@ -55,7 +180,7 @@ def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
     return crud.create_user(db=db, user=user)
 
 @app.get("/users/", response_model=List[schemas.UserResponse], tags=["Users"])
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def read_users(skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE), db: Session = Depends(get_db)):
     users = crud.get_users(db, skip=skip, limit=limit)
     return users
 
@@ -75,24 +200,43 @@ def update_user(user_id: int, user_update: schemas.UserUpdate, db: Session = Dep
 
 @app.delete("/users/{user_id}", tags=["Users"])
 def delete_user(user_id: int, db: Session = Depends(get_db)):
-    db_user = crud.delete_user(db, user_id=user_id)
-    if db_user is None:
+    purge_job = crud.delete_user(db, user_id=user_id)
+    if purge_job is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return {"message": "User deleted successfully"}
+    purge_worker.wake()
+    return {"message": "User deleted successfully", "purge_job_id": purge_job.job_id}
+
+def _json(body: bytes) -> Response:
+    return Response(content=body, media_type="application/json")
 
 # LOCATION ENDPOINTS
 @app.post("/locations/", response_model=schemas.Location, tags=["Locations"])
 def create_location(location: schemas.LocationCreate, db: Session = Depends(get_db)):
-    return crud.create_location(db=db, location=location)
+    db_location = crud.create_location(db=db, location=location)
+    reference_data.rebuild(db)
+    return db_location
 
 @app.get("/locations/", response_model=List[schemas.Location], tags=["Locations"])
-def read_locations(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def read_locations(skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_REFERENCE_PAGE_SIZE), db: Session = Depends(get_db)):
+    body = reference_data.page(refdata.LOCATIONS, skip=skip, limit=limit)
+    if body is not None:
+        return _json(body)
     locations = crud.get_locations(db, skip=skip, limit=limit)
     return locations
 
+@app.get("/locations/suggest", response_model=List[schemas.LocationSuggestion], tags=["Locations"])
+def suggest_locations(q: str = Query(..., min_length=1, max_length=100), limit: int = Query(10, ge=1, le=typeahead.MAX_SUGGESTIONS)):
+    return [
+        schemas.LocationSuggestion(**location, ad_count=ad_count)
+        for location, ad_count in suggestions.suggest_locations(q, limit=limit)
+    ]
+
 @app.get("/locations/{location_id}", response_model=schemas.Location, tags=["Locations"])
 def read_location(location_id: int, db: Session = Depends(get_db)):
-    db_location = crud.get_location(db, location_id=location_id)
+    available, body = reference_data.get(refdata.LOCATIONS, location_id)
+    if body is not None:
+        return _json(body)
+    db_location = crud.get_location(db, location_id=location_id) if not available else None
     if db_location is None:
         raise HTTPException(status_code=404, detail="Location not found")
     return db_location
@@ -102,6 +246,7 @@ def update_location(location_id: int, location_update: schemas.LocationUpdate, d
     db_location = crud.update_location(db, location_id=location_id, location_update=location_update)
     if db_location is None:
         raise HTTPException(status_code=404, detail="Location not found")
+    reference_data.rebuild(db)
     return db_location
 
 @app.delete("/locations/{location_id}", tags=["Locations"])
@@ -109,31 +254,53 @@ def delete_location(location_id: int, db: Session = Depends(get_db)):
     db_location = crud.delete_location(db, location_id=location_id)
     if db_location is None:
         raise HTTPException(status_code=404, detail="Location not found")
+    reference_data.rebuild(db)
     return {"message": "Location deleted successfully"}
 
 # CATEGORY ENDPOINTS
 @app.post("/categories/", response_model=schemas.Category, tags=["Categories"])
 def create_category(category: schemas.CategoryCreate, db: Session = Depends(get_db)):
-    return crud.create_category(db=db, category=category)
+    db_category = crud.create_category(db=db, category=category)
+    reference_data.rebuild(db)
+    return db_category
 
 @app.get("/categories/", response_model=List[schemas.Category], tags=["Categories"])
-def read_categories(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def read_categories(skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_REFERENCE_PAGE_SIZE), db: Session = Depends(get_db)):
+    body = reference_data.page(refdata.CATEGORIES, skip=skip, limit=limit)
+    if body is not None:
+        return _json(body)
     categories = crud.get_categories(db, skip=skip, limit=limit)
     return categories
 
 @app.get("/categories/parent", response_model=List[schemas.Category], tags=["Categories"])
 def read_parent_categories(db: Session = Depends(get_db)):
+    body = reference_data.page(refdata.PARENT_CATEGORIES)
+    if body is not None:
+        return _json(body)
     categories = crud.get_parent_categories(db)
     return categories
 
+@app.get("/categories/suggest", response_model=List[schemas.CategorySuggestion], tags=["Categories"])
+def suggest_categories(q: str = Query(..., min_length=1, max_length=100), limit: int = Query(10, ge=1, le=typeahead.MAX_SUGGESTIONS)):
+    return [
+        schemas.CategorySuggestion(**category, ad_count=ad_count)
+        for category, ad_count in suggestions.suggest_categories(q, limit=limit)
+    ]
+
 @app.get("/categories/{category_id}/subcategories", response_model=List[schemas.Category], tags=["Categories"])
 def read_subcategories(category_id: int, db: Session = Depends(get_db)):
+    body = reference_data.page(refdata.subcategories_section(category_id))
+    if body is not None:
+        return _json(body)
     categories = crud.get_subcategories(db, parent_id=category_id)
     return categories
 
 @app.get("/categories/{category_id}", response_model=schemas.Category, tags=["Categories"])
 def read_category(category_id: int, db: Session = Depends(get_db)):
-    db_category = crud.get_category(db, category_id=category_id)
+    available, body = reference_data.get(refdata.CATEGORIES, category_id)
+    if body is not None:
+        return _json(body)
+    db_category = crud.get_category(db, category_id=category_id) if not available else None
     if db_category is None:
         raise HTTPException(status_code=404, detail="Category not found")
     return db_category
@@ -143,6 +310,7 @@ def update_category(category_id: int, category_update: schemas.CategoryUpdate, d
     db_category = crud.update_category(db, category_id=category_id, category_update=category_update)
     if db_category is None:
         raise HTTPException(status_code=404, detail="Category not found")
+    reference_data.rebuild(db)
     return db_category
 
 @app.delete("/categories/{category_id}", tags=["Categories"])
@@ -150,69 +318,170 @@ def delete_category(category_id: int, db: Session = Depends(get_db)):
     db_category = crud.delete_category(db, category_id=category_id)
     if db_category is None:
         raise HTTPException(status_code=404, detail="Category not found")
+    reference_data.rebuild(db)
     return {"message": "Category deleted successfully"}
 
 # AD ENDPOINTS
 @app.post("/ads/", response_model=schemas.AdResponse, tags=["Ads"])
 def create_ad(ad: schemas.AdCreate, db: Session = Depends(get_db)):
-    return crud.create_ad(db=db, ad=ad)
+    _require_users(db, ad.user_id)
+    try:
+        return crud.create_ad(db=db, ad=ad, reject_duplicates=REJECT_DUPLICATE_ADS)
+    except crud.DuplicateAdError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
 @app.get("/ads/", response_model=List[schemas.AdResponse], tags=["Ads"])
-def read_ads(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def read_ads(skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE), db: Session = Depends(get_db)):
     ads = crud.get_ads(db, skip=skip, limit=limit)
     return ads
 
 @app.get("/ads/search", response_model=List[schemas.AdResponse], tags=["Ads"])
-def search_ads(q: str = Query(..., description="Search query"), skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def search_ads(q: str = Query(..., description="Search query"), skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE), db: Session = Depends(get_db)):
     ads = crud.search_ads(db, query=q, skip=skip, limit=limit)
     return ads
 
+@app.get("/ads/trending", response_model=List[schemas.TrendingAd], tags=["Ads"])
+async def read_trending_ads(category_id: Optional[int] = None, location_id: Optional[int] = None, limit: int = Query(20, ge=1, le=100)):
+    ads = trending_ads.top(category_id=category_id, location_id=location_id, limit=limit)
+    return [schemas.TrendingAd(ad_id=ad_id, score=score) for ad_id, score in ads]
+
+@app.get("/ads/images", response_model=Dict[int, List[schemas.AdImage]], tags=["Ad Images"])
+def read_images_for_ads(ids: str = Query(..., description="Comma-separated ad IDs"), primary_only: bool = False, db: Session = Depends(get_db)):
+    try:
+        ad_ids = [int(ad_id) for ad_id in ids.split(",") if ad_id.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be a comma-separated list of integers")
+    if len(ad_ids) > MAX_IMAGE_BATCH_IDS:
+        raise HTTPException(status_code=422, detail=f"At most {MAX_IMAGE_BATCH_IDS} ids per request")
+    images = {ad_id: [] for ad_id in ad_ids}
+    for image in crud.get_images_for_ads(db, ad_ids=ad_ids, primary_only=primary_only):
+        images[image.ad_id].append(image)
+    return images
+
 @app.get("/ads/user/{user_id}", response_model=List[schemas.AdResponse], tags=["Ads"])
-def read_user_ads(user_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    ads = crud.get_ads_by_user(db, user_id=user_id, skip=skip, limit=limit)
+def read_user_ads(user_id: int, skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE), include_archived: bool = False, db: Session = Depends(get_db)):
+    ads = crud.get_ads_by_user(db, user_id=user_id, skip=skip, limit=limit, include_archived=include_archived)
     return ads
 
 @app.get("/ads/category/{category_id}", response_model=List[schemas.AdResponse], tags=["Ads"])
-def read_ads_by_category(category_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def read_ads_by_category(category_id: int, skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE), db: Session = Depends(get_db)):
     ads = crud.get_ads_by_category(db, category_id=category_id, skip=skip, limit=limit)
     return ads
 
 @app.get("/ads/location/{location_id}", response_model=List[schemas.AdResponse], tags=["Ads"])
-def read_ads_by_location(location_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def read_ads_by_location(location_id: int, skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE), db: Session = Depends(get_db)):
     ads = crud.get_ads_by_location(db, location_id=location_id, skip=skip, limit=limit)
     return ads
 
 @app.get("/ads/{ad_id}", response_model=schemas.AdResponse, tags=["Ads"])
-def read_ad(ad_id: int, db: Session = Depends(get_db)):
+def read_ad(ad_id: int, include_archived: bool = False, db: Session = Depends(get_db)):
     db_ad = crud.get_ad(db, ad_id=ad_id)
+    if db_ad is None and include_archived:
+        db_ad = crud.get_archived_ad(db, ad_id=ad_id)
+        if db_ad is not None:
+            return db_ad
     if db_ad is None:
         raise HTTPException(status_code=404, detail="Ad not found")
+    trending_ads.buffer(db_ad.ad_id, db_ad.category_id, db_ad.location_id, trending.VIEW_WEIGHT)
     return db_ad
 
+AD_PAGE_INCLUDES = ("seller", "images", "seller_ads", "favorite")
+
+def _load_page_ad(db: Session, ad_id: int, with_seller: bool, with_images: bool):
+    db_ad = crud.get_ad_for_page(db, ad_id=ad_id, with_seller=with_seller, with_images=with_images)
+    if db_ad is None:
+        return None
+    trending_ads.buffer(db_ad.ad_id, db_ad.category_id, db_ad.location_id, trending.VIEW_WEIGHT)
+    return schemas.AdResponse.model_validate(db_ad)
+
+def _load_page_seller_ads(db: Session, ad_id: int, limit: int):
+    return [schemas.AdSummary.model_validate(ad) for ad in crud.get_more_ads_from_seller(db, ad_id=ad_id, limit=limit)]
+
+@app.get("/ads/{ad_id}/page", response_model=schemas.AdPage, tags=["Ads"])
+def read_ad_page(
+    ad_id: int,
+    include: str = Query(",".join(AD_PAGE_INCLUDES), description="Comma-separated parts: " + ", ".join(AD_PAGE_INCLUDES)),
+    user_id: Optional[int] = Query(None, description="Viewing user, required for the favorite flag"),
+    seller_ads_limit: int = Query(6, ge=1, le=24)
+):
+    parts = {part.strip() for part in include.split(",") if part.strip()}
+    unknown = parts.difference(AD_PAGE_INCLUDES)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown include: {', '.join(sorted(unknown))}")
+    ad_future = query_executor.submit(run_with_session, _load_page_ad, ad_id, "seller" in parts, "images" in parts)
+    seller_ads_future = None
+    if "seller_ads" in parts:
+        seller_ads_future = query_executor.submit(run_with_session, _load_page_seller_ads, ad_id, seller_ads_limit)
+    favorite_future = None
+    if "favorite" in parts and user_id is not None:
+        favorite_future = query_executor.submit(run_with_session, crud.is_favorite, user_id=user_id, ad_id=ad_id)
+    ad = ad_future.result()
+    if ad is None:
+        raise HTTPException(status_code=404, detail="Ad not found")
+    return schemas.AdPage(
+        ad=ad,
+        more_from_seller=seller_ads_future.result() if seller_ads_future else None,
+        is_favorite=favorite_future.result() if favorite_future else None
+    )
+
+@app.get("/ads/{ad_id}/similar", response_model=List[schemas.SimilarAd], tags=["Recommendations"])
+async def read_similar_ads(ad_id: int, limit: int = Query(10, ge=1, le=recommendations.TOP_K)):
+    return [schemas.SimilarAd(ad_id=similar_id, score=score) for similar_id, score in similar_ads.similar(ad_id, limit)]
+
 @app.put("/ads/{ad_id}", response_model=schemas.AdResponse, tags=["Ads"])
 def update_ad(ad_id: int, ad_update: schemas.AdUpdate, db: Session = Depends(get_db)):
-    db_ad = crud.update_ad(db, ad_id=ad_id, ad_update=ad_update)
+    try:
+        db_ad = crud.update_ad(db, ad_id=ad_id, ad_update=ad_update, reject_duplicates=REJECT_DUPLICATE_ADS)
+    except crud.DuplicateAdError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     if db_ad is None:
         raise HTTPException(status_code=404, detail="Ad not found")
     return db_ad
 
 @app.delete("/ads/{ad_id}", tags=["Ads"])
 def delete_ad(ad_id: int, db: Session = Depends(get_db)):
-    db_ad = crud.delete_ad(db, ad_id=ad_id)
-    if db_ad is None:
+    purge_job = crud.delete_ad(db, ad_id=ad_id)
+    if purge_job is None:
         raise HTTPException(status_code=404, detail="Ad not found")
-    return {"message": "Ad deleted successfully"}
+    purge_worker.wake()
+    return {"message": "Ad deleted successfully", "purge_job_id": purge_job.job_id}
 
 # AD IMAGE ENDPOINTS
 @app.post("/ad-images/", response_model=schemas.AdImage, tags=["Ad Images"])
 def create_ad_image(ad_image: schemas.AdImageCreate, db: Session = Depends(get_db)):
+    _require_ad(db, ad_image.ad_id)
     return crud.create_ad_image(db=db, ad_image=ad_image)
 
+@app.post("/ads/{ad_id}/images/upload", response_model=schemas.AdImage, tags=["Ad Images"])
+def upload_ad_image(ad_id: int, file: UploadFile = File(...), db: Session = Depends(get_db)):
+    _require_ad(db, ad_id)
+    extension = storage.ALLOWED_CONTENT_TYPES.get(file.content_type)
+    if extension is None:
+        raise HTTPException(status_code=400, detail="Unsupported image type")
+    try:
+        content_hash, key = storage.store_upload(image_storage, file.file, extension, max_bytes=MAX_IMAGE_UPLOAD_SIZE)
+    except ValueError:
+        raise HTTPException(status_code=413, detail="Image too large")
+    db_image = crud.get_ad_image_by_hash(db, ad_id=ad_id, content_hash=content_hash)
+    if db_image:
+        return db_image
+    db_image = crud.create_uploaded_ad_image(db, ad_id=ad_id, image_url=image_storage.url(key), content_hash=content_hash)
+    if db_image.thumbnail_url is None:
+        rendition_worker.submit(db_image.image_id, content_hash, key)
+    return db_image
+
 @app.get("/ads/{ad_id}/images", response_model=List[schemas.AdImage], tags=["Ad Images"])
 def read_ad_images(ad_id: int, db: Session = Depends(get_db)):
     images = crud.get_ad_images(db, ad_id=ad_id)
     return images
 
+@app.put("/ad-images/{image_id}/primary", response_model=schemas.AdImage, tags=["Ad Images"])
+def set_primary_ad_image(image_id: int, db: Session = Depends(get_db)):
+    db_image = crud.set_primary_ad_image(db, image_id=image_id)
+    if db_image is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return db_image
+
 @app.delete("/ad-images/{image_id}", tags=["Ad Images"])
 def delete_ad_image(image_id: int, db: Session = Depends(get_db)):
     db_image = crud.delete_ad_image(db, image_id=image_id)
@@ -220,13 +489,43 @@ def delete_ad_image(image_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Image not found")
     return {"message": "Image deleted successfully"}
 
+# SAVED SEARCH ENDPOINTS
+@app.post("/saved-searches/", response_model=schemas.SavedSearch, tags=["Saved Searches"])
+def create_saved_search(saved_search: schemas.SavedSearchCreate, db: Session = Depends(get_db)):
+    _require_users(db, saved_search.user_id)
+    if not (crud.tokenize(saved_search.keywords) or saved_search.category_id is not None or saved_search.location_id is not None):
+        raise HTTPException(status_code=400, detail="A saved search needs keywords, a category or a location")
+    return crud.create_saved_search(db=db, saved_search=saved_search)
+
+@app.get("/users/{user_id}/saved-searches", response_model=List[schemas.SavedSearch], tags=["Saved Searches"])
+def read_user_saved_searches(user_id: int, db: Session = Depends(get_db)):
+    return crud.get_user_saved_searches(db, user_id=user_id)
+
+@app.delete("/saved-searches/{search_id}", tags=["Saved Searches"])
+def delete_saved_search(search_id: int, db: Session = Depends(get_db)):
+    db_search = crud.delete_saved_search(db, search_id=search_id)
+    if db_search is None:
+        raise HTTPException(status_code=404, detail="Saved search not found")
+    return {"message": "Saved search deleted successfully"}
+
+@app.get("/users/{user_id}/search-feed", response_model=List[schemas.SearchFeedItem], tags=["Saved Searches"])
+def read_search_feed(user_id: int, unseen_only: bool = False, skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE), db: Session = Depends(get_db)):
+    return crud.get_search_feed(db, user_id=user_id, unseen_only=unseen_only, skip=skip, limit=limit)
+
+@app.post("/users/{user_id}/search-feed/seen", tags=["Saved Searches"])
+def mark_search_feed_seen(user_id: int, db: Session = Depends(get_db)):
+    updated = crud.mark_search_feed_seen(db, user_id=user_id)
+    return {"message": "Search feed marked as seen", "updated": updated}
+
 # FAVORITE ENDPOINTS
 @app.post("/favorites/", response_model=schemas.Favorite, tags=["Favorites"])
 def create_favorite(favorite: schemas.FavoriteCreate, db: Session = Depends(get_db)):
+    _require_users(db, favorite.user_id)
+    _require_ad(db, favorite.ad_id)
     return crud.create_favorite(db=db, favorite=favorite)
 
 @app.get("/users/{user_id}/favorites", response_model=List[schemas.Favorite], tags=["Favorites"])
-def read_user_favorites(user_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def read_user_favorites(user_id: int, skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE), db: Session = Depends(get_db)):
     favorites = crud.get_user_favorites(db, user_id=user_id, skip=skip, limit=limit)
     return favorites
 
@@ -245,20 +544,22 @@ def check_favorite(user_id: int, ad_id: int, db: Session = Depends(get_db)):
 # MESSAGE ENDPOINTS
 @app.post("/messages/", response_model=schemas.Message, tags=["Messages"])
 def create_message(message: schemas.MessageCreate, db: Session = Depends(get_db)):
+    _require_users(db, message.sender_id, message.receiver_id)
+    _require_ad(db, message.ad_id)
     return crud.create_message(db=db, message=message)
 
 @app.get("/ads/{ad_id}/messages", response_model=List[schemas.Message], tags=["Messages"])
-def read_ad_messages(ad_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def read_ad_messages(ad_id: int, skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE), db: Session = Depends(get_db)):
     messages = crud.get_messages_for_ad(db, ad_id=ad_id, skip=skip, limit=limit)
     return messages
 
 @app.get("/conversations/{user1_id}/{user2_id}/{ad_id}", response_model=List[schemas.Message], tags=["Messages"])
-def read_conversation(user1_id: int, user2_id: int, ad_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    messages = crud.get_conversation(db, user1_id=user1_id, user2_id=user2_id, ad_id=ad_id, skip=skip, limit=limit)
+def read_conversation(user1_id: int, user2_id: int, ad_id: int, skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE), include_archived: bool = False, db: Session = Depends(get_db)):
+    messages = crud.get_conversation(db, user1_id=user1_id, user2_id=user2_id, ad_id=ad_id, skip=skip, limit=limit, include_archived=include_archived)
     return messages
 
 @app.get("/users/{user_id}/messages", response_model=List[schemas.Message], tags=["Messages"])
-def read_user_messages(user_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def read_user_messages(user_id: int, skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE), db: Session = Depends(get_db)):
     messages = crud.get_user_messages(db, user_id=user_id, skip=skip, limit=limit)
     return messages
 
@@ -279,10 +580,12 @@ def delete_message(message_id: int, db: Session = Depends(get_db)):
 # REPORT ENDPOINTS
 @app.post("/reports/", response_model=schemas.Report, tags=["Reports"])
 def create_report(report: schemas.ReportCreate, db: Session = Depends(get_db)):
+    _require_users(db, report.reported_by)
+    _require_ad(db, report.ad_id)
     return crud.create_report(db=db, report=report)
 
 @app.get("/reports/", response_model=List[schemas.Report], tags=["Reports"])
-def read_reports(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def read_reports(skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE), db: Session = Depends(get_db)):
     reports = crud.get_reports(db, skip=skip, limit=limit)
     return reports
 
@@ -298,13 +601,48 @@ def delete_report(report_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Report not found")
     return {"message": "Report deleted successfully"}
 
+# MODERATION ENDPOINTS
+@app.get("/moderation/queue", response_model=List[schemas.ModerationQueueItem], tags=["Moderation"])
+def read_moderation_queue(skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE), db: Session = Depends(get_db)):
+    return crud.get_moderation_queue(db, skip=skip, limit=limit)
+
+@app.post("/moderation/queue/rebuild", tags=["Moderation"])
+def rebuild_moderation_queue(db: Session = Depends(get_db)):
+    ads = crud.rebuild_moderation_queue(db)
+    return {"message": "Moderation queue rebuilt", "ads": ads}
+
+@app.get("/moderation/duplicates", response_model=List[schemas.AdResponse], tags=["Moderation"])
+def read_duplicate_ads(skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE), db: Session = Depends(get_db)):
+    return crud.get_duplicate_ads(db, skip=skip, limit=limit)
+
+@app.post("/moderation/duplicates/backfill", tags=["Moderation"])
+def backfill_duplicate_index(background_tasks: BackgroundTasks, chunk_size: int = Query(500, ge=1, le=5000)):
+    background_tasks.add_task(dedupe.run_backfill, SessionLocal, chunk_size=chunk_size)
+    return {"message": "Duplicate index backfill started"}
+
+@app.get("/moderation/duplicates/backfill", tags=["Moderation"])
+def read_duplicate_backfill_status(db: Session = Depends(get_db)):
+    return jobs.status(db, dedupe.BACKFILL_JOB)
+
 # TRANSACTION ENDPOINTS
 @app.post("/transactions/", response_model=schemas.Transaction, tags=["Transactions"])
-def create_transaction(transaction: schemas.TransactionCreate, db: Session = Depends(get_db)):
-    return crud.create_transaction(db=db, transaction=transaction)
+@app.post("/transactions/reserve", response_model=schemas.Transaction, tags=["Transactions"])
+def create_transaction(
+    transaction: schemas.TransactionCreate,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=64),
+    db: Session = Depends(get_db)
+):
+    _require_users(db, transaction.buyer_id)
+    try:
+        db_transaction = crud.create_transaction(db=db, transaction=transaction, idempotency_key=idempotency_key)
+    except crud.TransactionStateError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if db_transaction is None:
+        raise HTTPException(status_code=404, detail="Ad not found")
+    return db_transaction
 
 @app.get("/transactions/", response_model=List[schemas.Transaction], tags=["Transactions"])
-def read_transactions(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def read_transactions(skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE), db: Session = Depends(get_db)):
     transactions = crud.get_transactions(db, skip=skip, limit=limit)
     return transactions
 
@@ -316,18 +654,41 @@ def read_transaction(transaction_id: int, db: Session = Depends(get_db)):
     return db_transaction
 
 @app.get("/users/{user_id}/transactions/buyer", response_model=List[schemas.Transaction], tags=["Transactions"])
-def read_user_buyer_transactions(user_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    transactions = crud.get_user_transactions_as_buyer(db, user_id=user_id, skip=skip, limit=limit)
+def read_user_buyer_transactions(user_id: int, skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE), include_archived: bool = False, db: Session = Depends(get_db)):
+    transactions = crud.get_user_transactions_as_buyer(db, user_id=user_id, skip=skip, limit=limit, include_archived=include_archived)
     return transactions
 
 @app.get("/users/{user_id}/transactions/seller", response_model=List[schemas.Transaction], tags=["Transactions"])
-def read_user_seller_transactions(user_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    transactions = crud.get_user_transactions_as_seller(db, user_id=user_id, skip=skip, limit=limit)
+def read_user_seller_transactions(user_id: int, skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE), include_archived: bool = False, db: Session = Depends(get_db)):
+    transactions = crud.get_user_transactions_as_seller(db, user_id=user_id, skip=skip, limit=limit, include_archived=include_archived)
     return transactions
 
 @app.put("/transactions/{transaction_id}", response_model=schemas.Transaction, tags=["Transactions"])
 def update_transaction(transaction_id: int, transaction_update: schemas.TransactionUpdate, db: Session = Depends(get_db)):
-    db_transaction = crud.update_transaction(db, transaction_id=transaction_id, transaction_update=transaction_update)
+    try:
+        db_transaction = crud.update_transaction(db, transaction_id=transaction_id, transaction_update=transaction_update)
+    except crud.TransactionStateError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if db_transaction is None:
+        raise HTTPException(status_code=404, detail="Transaction not found")
+    return db_transaction
+
+@app.post("/transactions/{transaction_id}/complete", response_model=schemas.Transaction, tags=["Transactions"])
+def complete_transaction(transaction_id: int, db: Session = Depends(get_db)):
+    try:
+        db_transaction = crud.complete_transaction(db, transaction_id=transaction_id)
+    except crud.TransactionStateError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if db_transaction is None:
+        raise HTTPException(status_code=404, detail="Transaction not found")
+    return db_transaction
+
+@app.post("/transactions/{transaction_id}/cancel", response_model=schemas.Transaction, tags=["Transactions"])
+def cancel_transaction(transaction_id: int, db: Session = Depends(get_db)):
+    try:
+        db_transaction = crud.cancel_transaction(db, transaction_id=transaction_id)
+    except crud.TransactionStateError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     if db_transaction is None:
         raise HTTPException(status_code=404, detail="Transaction not found")
     return db_transaction
@@ -339,6 +700,143 @@ def delete_transaction(transaction_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Transaction not found")
     return {"message": "Transaction deleted successfully"}
 
+# RECOMMENDATION ENDPOINTS
+def _update_similar_ads(update, *args):
+    run_with_session(update, RECOMMENDATIONS_PATH, *args)
+    similar_ads.load()
+
+@app.post("/recommendations/rebuild", tags=["Recommendations"])
+def rebuild_recommendations(background_tasks: BackgroundTasks):
+    background_tasks.add_task(_update_similar_ads, recommendations.build_index)
+    return {"message": "Similar ads rebuild started"}
+
+@app.post("/recommendations/refresh", tags=["Recommendations"])
+def refresh_recommendations(background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+    changed = recommendations.dirty_marks(db)
+    if changed:
+        background_tasks.add_task(_update_similar_ads, recommendations.refresh_dirty)
+    return {"message": "Similar ads refresh started", "changed_ads": len(changed)}
+
+# ARCHIVE ENDPOINTS
+@app.post("/archive/run", tags=["Archive"])
+def run_archive(
+    background_tasks: BackgroundTasks,
+    sold_after_days: int = Query(30, ge=0, description="Archive sold ads untouched for this many days"),
+    expire_after_days: Optional[int] = Query(None, ge=1, description="Also archive any ad older than this"),
+    message_after_days: Optional[int] = Query(365, ge=1, description="Archive messages older than this"),
+    chunk_size: int = Query(500, ge=1, le=5000)
+):
+    background_tasks.add_task(
+        archive.run_archival, SessionLocal,
+        sold_after_days=sold_after_days,
+        expire_after_days=expire_after_days,
+        message_after_days=message_after_days,
+        chunk_size=chunk_size
+    )
+    return {"message": "Archival started"}
+
+@app.get("/archive/status", tags=["Archive"])
+def read_archive_status(db: Session = Depends(get_db)):
+    return jobs.status(db, archive.ARCHIVE_JOB)
+
+# OUTBOX HANDLERS
+@outbox.handler(crud.AD_CREATED)
+def match_new_ad_to_saved_searches(db: Session, event: models.OutboxEvent):
+    db_ad = crud.get_ad(db, ad_id=event.aggregate_id)
+    if db_ad is not None:
+        crud.match_saved_searches(db, db_ad)
+
+outbox.register(crud.TRANSACTION_ROLLUP, crud.apply_rollup_event)
+
+@outbox.handler(crud.FAVORITE_CREATED)
+@outbox.handler(crud.FAVORITE_DELETED)
+@outbox.handler(crud.MESSAGE_CREATED)
+@outbox.handler(crud.AD_DELETED)
+def mark_similar_ads_dirty(db: Session, event: models.OutboxEvent):
+    recommendations.mark_dirty(db, event.aggregate_id)
+
+TRENDING_EVENT_WEIGHTS = {
+    crud.FAVORITE_CREATED: trending.FAVORITE_WEIGHT,
+    crud.MESSAGE_CREATED: trending.MESSAGE_WEIGHT,
+}
+
+@outbox.handler(crud.FAVORITE_CREATED)
+@outbox.handler(crud.MESSAGE_CREATED)
+def record_trending_interaction(db: Session, event: models.OutboxEvent):
+    db_ad = crud.get_ad(db, ad_id=event.aggregate_id)
+    if db_ad is not None:
+        # Counted at the time of the write, not of delivery; the row commits with the dispatch
+        trending.add_event(db, db_ad.ad_id, db_ad.category_id, db_ad.location_id,
+                           TRENDING_EVENT_WEIGHTS[event.event_type], occurred_at=event.created_at)
+
+@app.get("/outbox/metrics", tags=["Outbox"])
+def read_outbox_metrics(db: Session = Depends(get_db)):
+    return outbox_dispatcher.metrics(db)
+
+# ADMISSION CONTROL
+@app.get("/admission/metrics", tags=["Admission"])
+async def read_admission_metrics():
+    return admission.current_metrics()
+
+# PURGE JOB ENDPOINTS
+@app.get("/purge-jobs/", response_model=List[schemas.PurgeJob], tags=["Purge Jobs"])
+def read_purge_jobs(status: Optional[str] = None, skip: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE), db: Session = Depends(get_db)):
+    return crud.get_purge_jobs(db, status=status, skip=skip, limit=limit)
+
+@app.get("/purge-jobs/{job_id}", response_model=schemas.PurgeJob, tags=["Purge Jobs"])
+def read_purge_job(job_id: int, db: Session = Depends(get_db)):
+    purge_job = crud.get_purge_job(db, job_id=job_id)
+    if purge_job is None:
+        raise HTTPException(status_code=404, detail="Purge job not found")
+    return purge_job
+
+# ANALYTICS ENDPOINTS
+ANALYTICS_DEFAULT_DAYS = 30
+
+def analytics_range(start: Optional[date] = None, end: Optional[date] = None):
+    end = end or date.today()
+    start = start or end - timedelta(days=ANALYTICS_DEFAULT_DAYS - 1)
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+    return start, end
+
+@app.get("/analytics/sellers/{seller_id}/daily", response_model=List[schemas.DailyTransactionRollup], tags=["Analytics"])
+def read_seller_daily_rollups(seller_id: int, date_range: tuple = Depends(analytics_range), db: Session = Depends(get_db)):
+    return crud.get_daily_rollups(db, crud.ROLLUP_SELLER, seller_id, *date_range)
+
+@app.get("/analytics/sellers/{seller_id}/summary", response_model=schemas.TransactionRollup, tags=["Analytics"])
+def read_seller_summary(seller_id: int, date_range: tuple = Depends(analytics_range), db: Session = Depends(get_db)):
+    return crud.get_rollup_summary(db, crud.ROLLUP_SELLER, seller_id, *date_range)
+
+@app.get("/analytics/categories/{category_id}/daily", response_model=List[schemas.DailyTransactionRollup], tags=["Analytics"])
+def read_category_daily_rollups(category_id: int, date_range: tuple = Depends(analytics_range), db: Session = Depends(get_db)):
+    return crud.get_daily_rollups(db, crud.ROLLUP_CATEGORY, category_id, *date_range)
+
+@app.get("/analytics/locations/{location_id}/daily", response_model=List[schemas.DailyTransactionRollup], tags=["Analytics"])
+def read_location_daily_rollups(location_id: int, date_range: tuple = Depends(analytics_range), db: Session = Depends(get_db)):
+    return crud.get_daily_rollups(db, crud.ROLLUP_LOCATION, location_id, *date_range)
+
+@app.get("/analytics/marketplace/daily", response_model=List[schemas.DailyTransactionRollup], tags=["Analytics"])
+def read_marketplace_daily_rollups(date_range: tuple = Depends(analytics_range), db: Session = Depends(get_db)):
+    return crud.get_daily_rollups(db, crud.ROLLUP_MARKETPLACE, 0, *date_range)
+
+@app.get("/analytics/marketplace/summary", response_model=schemas.TransactionRollup, tags=["Analytics"])
+def read_marketplace_summary(date_range: tuple = Depends(analytics_range), db: Session = Depends(get_db)):
+    return crud.get_rollup_summary(db, crud.ROLLUP_MARKETPLACE, 0, *date_range)
+
+@app.post("/analytics/rebuild", tags=["Analytics"])
+def rebuild_analytics(db: Session = Depends(get_db)):
+    rollups = crud.rebuild_transaction_rollups(db)
+    return {"message": "Transaction rollups rebuilt", "rollups": rollups}
+
+def preload_for_workers():
+    # Runs once in the launcher before the workers are forked
+    run_with_session(reference_data.rebuild)
+    # Pooled connections must not be shared between forked workers
+    engine.dispose()
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
\ No newline at end of file
+    import os
+    import serve
+    serve.run(app, host="0.0.0.0", port=8000, workers=int(os.environ.get("WEB_CONCURRENCY", 1)),
+              preload=preload_for_workers) 
\ No newline at end of file
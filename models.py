@@ -1,8 +1,9 @@
-from sqlalchemy import Column, Integer, String, Text, DECIMAL, Boolean, TIMESTAMP, Enum, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, DECIMAL, Boolean, TIMESTAMP, Enum, ForeignKey, Index, Float, Date, Table, LargeBinary, BigInteger
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 import enum
+import json
 
 Base = declarative_base()
 
@@ -25,6 +26,7 @@ class User(Base):
     password = Column(String(255), nullable=False)
     profile_picture = Column(String(255))
     created_at = Column(TIMESTAMP, default=func.current_timestamp())
+    deleted_at = Column(TIMESTAMP, nullable=True)
     
     # Relationships
     ads = relationship("Ad", back_populates="user")
@@ -69,14 +71,19 @@ class Ad(Base):
     price = Column(DECIMAL(10, 2), nullable=False)
     condition = Column(Enum(ConditionEnum), nullable=False)
     is_sold = Column(Boolean, default=False)
+    primary_image_url = Column(String(255))
+    # MinHash signature of title + description (see dedupe.py) and the ad it near-duplicates, if any
+    minhash = Column(LargeBinary(256))
+    duplicate_of = Column(Integer, ForeignKey("ads.ad_id", ondelete="SET NULL"))
     created_at = Column(TIMESTAMP, default=func.current_timestamp())
     updated_at = Column(TIMESTAMP, default=func.current_timestamp(), onupdate=func.current_timestamp())
+    deleted_at = Column(TIMESTAMP, nullable=True)
     
     # Relationships
     user = relationship("User", back_populates="ads")
     category = relationship("Category", back_populates="ads")
     location = relationship("Location", back_populates="ads")
-    images = relationship("AdImage", back_populates="ad")
+    images = relationship("AdImage", back_populates="ad", order_by="AdImage.position")
     favorites = relationship("Favorite", back_populates="ad")
     messages = relationship("Message", back_populates="ad")
     reports = relationship("Report", back_populates="ad")
@@ -84,10 +91,18 @@ class Ad(Base):
 
 class AdImage(Base):
     __tablename__ = "ad_images"
+    __table_args__ = (
+        Index("ix_ad_images_ad_id_position", "ad_id", "position"),
+    )
     
     image_id = Column(Integer, primary_key=True, autoincrement=True)
     ad_id = Column(Integer, ForeignKey("ads.ad_id", ondelete="CASCADE"))
     image_url = Column(String(255))
+    content_hash = Column(String(64), index=True)
+    thumbnail_url = Column(String(255))
+    medium_url = Column(String(255))
+    position = Column(Integer, nullable=False, default=0)
+    is_primary = Column(Boolean, nullable=False, default=False)
     
     # Relationships
     ad = relationship("Ad", back_populates="images")
@@ -119,6 +134,9 @@ class Message(Base):
 
 class Report(Base):
     __tablename__ = "reports"
+    __table_args__ = (
+        Index("ix_reports_ad_id_reported_at", "ad_id", "reported_at"),
+    )
     
     report_id = Column(Integer, primary_key=True, autoincrement=True)
     ad_id = Column(Integer, ForeignKey("ads.ad_id"))
@@ -130,8 +148,25 @@ class Report(Base):
     ad = relationship("Ad", back_populates="reports")
     reporter = relationship("User", back_populates="reports")
 
+class ModerationQueueEntry(Base):
+    __tablename__ = "moderation_queue"
+    __table_args__ = (
+        Index("ix_moderation_queue_priority", "score", "last_reported_at"),
+    )
+    
+    ad_id = Column(Integer, ForeignKey("ads.ad_id", ondelete="CASCADE"), primary_key=True)
+    report_count = Column(Integer, nullable=False, default=0)
+    score = Column(Float, nullable=False, default=0)
+    last_reported_at = Column(TIMESTAMP)
+    
+    # Relationships
+    ad = relationship("Ad")
+
 class Transaction(Base):
     __tablename__ = "transactions"
+    __table_args__ = (
+        Index("ix_transactions_ad_id_status", "ad_id", "status"),
+    )
     
     transaction_id = Column(Integer, primary_key=True, autoincrement=True)
     ad_id = Column(Integer, ForeignKey("ads.ad_id"))
@@ -140,8 +175,218 @@ class Transaction(Base):
     amount = Column(DECIMAL(10, 2))
     status = Column(Enum(TransactionStatusEnum), default=TransactionStatusEnum.PENDING)
     transaction_date = Column(TIMESTAMP, default=func.current_timestamp())
+    idempotency_key = Column(String(64), unique=True)
     
     # Relationships
     ad = relationship("Ad", back_populates="transactions")
     buyer = relationship("User", foreign_keys=[buyer_id], back_populates="buyer_transactions")
-    seller = relationship("User", foreign_keys=[seller_id], back_populates="seller_transactions") 
\ No newline at end of file
+    seller = relationship("User", foreign_keys=[seller_id], back_populates="seller_transactions")
+
+class TransactionDailyRollup(Base):
+    __tablename__ = "transaction_daily_rollups"
+    
+    # dimension is one of "seller", "category", "location" or "marketplace" (dimension_id 0)
+    dimension = Column(String(20), primary_key=True)
+    dimension_id = Column(Integer, primary_key=True, autoincrement=False)
+    day = Column(Date, primary_key=True)
+    gmv = Column(DECIMAL(14, 2), nullable=False, default=0)
+    completed_count = Column(Integer, nullable=False, default=0)
+    cancelled_count = Column(Integer, nullable=False, default=0)
+    pending_count = Column(Integer, nullable=False, default=0)
+    
+    @property
+    def average_price(self):
+        if not self.completed_count:
+            return None
+        return round(self.gmv / self.completed_count, 2)
+
+class SavedSearch(Base):
+    __tablename__ = "saved_searches"
+    
+    search_id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False, index=True)
+    keywords = Column(String(255))
+    category_id = Column(Integer, ForeignKey("categories.category_id", ondelete="CASCADE"))
+    location_id = Column(Integer, ForeignKey("locations.location_id", ondelete="CASCADE"))
+    min_price = Column(DECIMAL(10, 2))
+    max_price = Column(DECIMAL(10, 2))
+    created_at = Column(TIMESTAMP, default=func.current_timestamp())
+
+class SavedSearchKey(Base):
+    # Reverse index: each saved search is filed under its most selective key
+    # ("t:<term>", "c:<category_id>" or "l:<location_id>")
+    __tablename__ = "saved_search_keys"
+    
+    key = Column(String(120), primary_key=True)
+    search_id = Column(Integer, ForeignKey("saved_searches.search_id", ondelete="CASCADE"), primary_key=True)
+
+class SavedSearchMatch(Base):
+    __tablename__ = "saved_search_matches"
+    __table_args__ = (
+        Index("ix_saved_search_matches_user_id_matched_at", "user_id", "matched_at"),
+    )
+    
+    search_id = Column(Integer, ForeignKey("saved_searches.search_id", ondelete="CASCADE"), primary_key=True)
+    ad_id = Column(Integer, ForeignKey("ads.ad_id", ondelete="CASCADE"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), nullable=False)
+    matched_at = Column(TIMESTAMP, default=func.current_timestamp())
+    is_seen = Column(Boolean, nullable=False, default=False)
+    
+    # Relationships
+    ad = relationship("Ad")
+
+class TrendingSnapshot(Base):
+    # Periodic copy of the in-memory trending top-k lists, used to warm up after a restart
+    __tablename__ = "trending_snapshots"
+    
+    scope = Column(String(60), primary_key=True)
+    ad_id = Column(Integer, primary_key=True, autoincrement=False)
+    score = Column(Float, nullable=False)
+    snapshot_at = Column(TIMESTAMP)
+
+class TrendingEvent(Base):
+    # Trending interactions shared by all worker processes; each worker tails this table by event_id
+    __tablename__ = "trending_events"
+    __table_args__ = (
+        Index("ix_trending_events_occurred_at", "occurred_at"),
+    )
+    
+    event_id = Column(Integer, primary_key=True, autoincrement=True)
+    ad_id = Column(Integer, nullable=False)
+    category_id = Column(Integer)
+    location_id = Column(Integer)
+    weight = Column(Float, nullable=False)
+    occurred_at = Column(TIMESTAMP, nullable=False)
+
+class SimilarAdDirty(Base):
+    # Ads whose similar-ads rows need recomputing on the next refresh; mark_count
+    # changes on every mark so a refresh only clears the marks it has seen
+    __tablename__ = "similar_ads_dirty"
+    
+    ad_id = Column(Integer, primary_key=True, autoincrement=False)
+    mark_count = Column(Integer, nullable=False, default=1)
+    marked_at = Column(TIMESTAMP, default=func.current_timestamp())
+
+class AdLshBucket(Base):
+    # MinHash LSH band buckets, scoped to one seller and category so a lookup
+    # is a primary-key range scan over that seller's ads only
+    __tablename__ = "ad_lsh_buckets"
+    
+    user_id = Column(Integer, primary_key=True, autoincrement=False)
+    category_id = Column(Integer, primary_key=True, autoincrement=False)
+    band = Column(Integer, primary_key=True, autoincrement=False)
+    bucket = Column(BigInteger, primary_key=True, autoincrement=False)
+    ad_id = Column(Integer, ForeignKey("ads.ad_id", ondelete="CASCADE"), primary_key=True, index=True)
+
+class PurgeJob(Base):
+    # Background removal of a soft-deleted user or ad. step and rows_deleted are
+    # committed together with each deleted batch, so a restarted worker resumes where it stopped.
+    __tablename__ = "purge_jobs"
+    __table_args__ = (
+        Index("ix_purge_jobs_status", "status", "job_id"),
+    )
+    
+    job_id = Column(Integer, primary_key=True, autoincrement=True)
+    target_type = Column(String(10), nullable=False)
+    target_id = Column(Integer, nullable=False)
+    status = Column(String(20), nullable=False, default="pending")
+    step = Column(String(40))
+    rows_deleted = Column(Integer, nullable=False, default=0)
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(Text)
+    created_at = Column(TIMESTAMP, default=func.current_timestamp())
+    updated_at = Column(TIMESTAMP, default=func.current_timestamp(), onupdate=func.current_timestamp())
+    completed_at = Column(TIMESTAMP)
+
+class JobRun(Base):
+    # Latest run of a singleton background job (archival, duplicate index backfill),
+    # kept in the database so every worker process reports the same status
+    __tablename__ = "job_runs"
+    
+    job = Column(String(40), primary_key=True)
+    status = Column(String(20), nullable=False)
+    progress = Column(Text)
+    error = Column(Text)
+    started_at = Column(TIMESTAMP, nullable=True)
+    finished_at = Column(TIMESTAMP, nullable=True)
+    updated_at = Column(TIMESTAMP, default=func.current_timestamp(), onupdate=func.current_timestamp())
+    
+    @property
+    def data(self):
+        return json.loads(self.progress) if self.progress else {}
+
+class OutboxEvent(Base):
+    # Written in the same transaction as the change it describes and delivered
+    # to in-process handlers by the outbox dispatcher
+    __tablename__ = "outbox_events"
+    __table_args__ = (
+        Index("ix_outbox_events_status_available_at", "status", "available_at"),
+    )
+    
+    event_id = Column(Integer, primary_key=True, autoincrement=True)
+    event_type = Column(String(50), nullable=False)
+    aggregate_id = Column(Integer, nullable=False)
+    payload = Column(Text)
+    status = Column(String(20), nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    available_at = Column(TIMESTAMP, nullable=True)
+    last_error = Column(Text)
+    created_at = Column(TIMESTAMP, default=func.current_timestamp())
+    dispatched_at = Column(TIMESTAMP, nullable=True)
+    
+    @property
+    def data(self):
+        return json.loads(self.payload) if self.payload else {}
+
+# Archive tables mirror the hot tables column for column (without foreign keys)
+# so rows can be moved with INSERT ... SELECT and read back with the same schemas
+def _archive_table(name, source, *extra):
+    columns = [
+        Column(column.name, column.type, primary_key=column.primary_key, autoincrement=False)
+        for column in source.columns
+    ]
+    return Table(
+        name, Base.metadata, *columns,
+        Column("archived_at", TIMESTAMP, default=func.current_timestamp()),
+        *extra
+    )
+
+class ArchivedAd(Base):
+    __table__ = _archive_table("ads_archive", Ad.__table__, Index("ix_ads_archive_user_id", "user_id"))
+    
+    # Relationships
+    user = relationship("User", primaryjoin="foreign(ArchivedAd.user_id) == User.user_id", viewonly=True)
+    category = relationship("Category", primaryjoin="foreign(ArchivedAd.category_id) == Category.category_id", viewonly=True)
+    location = relationship("Location", primaryjoin="foreign(ArchivedAd.location_id) == Location.location_id", viewonly=True)
+    images = relationship(
+        "ArchivedAdImage", primaryjoin="foreign(ArchivedAdImage.ad_id) == ArchivedAd.ad_id",
+        order_by="ArchivedAdImage.position", viewonly=True
+    )
+
+class ArchivedAdImage(Base):
+    __table__ = _archive_table("ad_images_archive", AdImage.__table__, Index("ix_ad_images_archive_ad_id", "ad_id"))
+
+class ArchivedFavorite(Base):
+    __table__ = _archive_table("favorites_archive", Favorite.__table__)
+
+class ArchivedMessage(Base):
+    __table__ = _archive_table(
+        "messages_archive", Message.__table__,
+        Index("ix_messages_archive_ad_id_sent_at", "ad_id", "sent_at")
+    )
+
+class ArchivedReport(Base):
+    __table__ = _archive_table("reports_archive", Report.__table__, Index("ix_reports_archive_ad_id", "ad_id"))
+
+class ArchivedTransaction(Base):
+    __table__ = _archive_table(
+        "transactions_archive", Transaction.__table__,
+        Index("ix_transactions_archive_ad_id", "ad_id"),
+        Index("ix_transactions_archive_buyer_id", "buyer_id"),
+        Index("ix_transactions_archive_seller_id", "seller_id")
+    )
+    
+    # Relationships
+    ad = relationship("ArchivedAd", primaryjoin="foreign(ArchivedTransaction.ad_id) == ArchivedAd.ad_id", viewonly=True)
+    buyer = relationship("User", primaryjoin="foreign(ArchivedTransaction.buyer_id) == User.user_id", viewonly=True)
+    seller = relationship("User", primaryjoin="foreign(ArchivedTransaction.seller_id) == User.user_id", viewonly=True)
@@ -0,0 +1,195 @@
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm import Session
+
+import models
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+DISPATCHED = "dispatched"
+DEAD = "dead"
+
+# event_type -> handlers, each called as handler(db, event) inside the dispatcher's transaction
+_handlers: Dict[str, List[Callable]] = defaultdict(list)
+
+
+def register(event_type: str, event_handler: Callable):
+    _handlers[event_type].append(event_handler)
+
+
+def handler(event_type: str):
+    def decorator(event_handler: Callable):
+        register(event_type, event_handler)
+        return event_handler
+    return decorator
+
+
+def retry_delay(attempts: int) -> float:
+    # Exponential backoff: 2s, 4s, 8s, ... capped at 5 minutes
+    return min(2.0 ** attempts, 300.0)
+
+
+class OutboxDispatcher:
+    """Delivers outbox events to the registered handlers from a background thread.
+
+    Events are claimed in batches with ``SKIP LOCKED`` and leased for
+    ``lease_seconds``, so several dispatchers (one per worker process) never
+    work on the same event at once, and events held by a crashed dispatcher are
+    picked up again when the lease runs out. Each event is locked while its
+    handlers run, and they run only if it is still pending under this
+    dispatcher's lease; the event is marked dispatched in the same commit, so
+    a handler that outlives its lease cannot be applied a second time.
+    """
+
+    def __init__(self, session_factory: Callable, batch_size: int = 100, poll_interval: float = 1.0,
+                 lease_seconds: float = 60.0, max_attempts: int = 10, retention: timedelta = timedelta(days=1)):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self.dispatched = 0
+        self.retried = 0
+        self.dead = 0
+        self.last_lag: Optional[float] = None
+        self.max_lag: Optional[float] = None
+        self.last_dispatch_at: Optional[datetime] = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="outbox-dispatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            db = self.session_factory()
+            try:
+                handled = self.dispatch_batch(db)
+                if not handled:
+                    self.delete_dispatched(db)
+            except Exception:
+                logger.exception("Outbox dispatcher error")
+                db.rollback()
+                handled = 0
+            finally:
+                db.close()
+            if handled < self.batch_size:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def claim(self, db: Session) -> List[Tuple[int, datetime]]:
+        now = datetime.now()
+        events = db.query(models.OutboxEvent).filter(
+            and_(
+                models.OutboxEvent.status == PENDING,
+                or_(models.OutboxEvent.available_at.is_(None), models.OutboxEvent.available_at <= now)
+            )
+        ).order_by(models.OutboxEvent.event_id).limit(self.batch_size).with_for_update(skip_locked=True).all()
+        # Whole seconds, so the lease reads back unchanged from a TIMESTAMP column
+        lease_until = (now + timedelta(seconds=self.lease_seconds)).replace(microsecond=0)
+        for event in events:
+            event.available_at = lease_until
+        db.commit()
+        return [(event.event_id, lease_until) for event in events]
+
+    def dispatch_batch(self, db: Session) -> int:
+        claimed = self.claim(db)
+        for event_id, lease_until in claimed:
+            self.dispatch(db, event_id, lease_until)
+        return len(claimed)
+
+    def dispatch(self, db: Session, event_id: int, lease_until: Optional[datetime] = None):
+        # The row lock is held until the commit below, so no other dispatcher can claim the event meanwhile
+        event = db.query(models.OutboxEvent).filter(
+            models.OutboxEvent.event_id == event_id
+        ).with_for_update().first()
+        if event is None or event.status != PENDING:
+            db.rollback()
+            return
+        if lease_until is not None and event.available_at != lease_until:
+            # The lease ran out before the lock was taken and another dispatcher claimed the event
+            db.rollback()
+            return
+        event_type, created_at = event.event_type, event.created_at
+        try:
+            for event_handler in _handlers.get(event_type, []):
+                event_handler(db, event)
+            now = datetime.now()
+            event.status = DISPATCHED
+            event.dispatched_at = now
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.exception("Outbox handler failed for event %s (%s)", event_id, event_type)
+            self._fail(db, event_id, e)
+            return
+        self.dispatched += 1
+        self.last_dispatch_at = now
+        if created_at is not None:
+            self.last_lag = max((now - created_at).total_seconds(), 0.0)
+            self.max_lag = self.last_lag if self.max_lag is None else max(self.max_lag, self.last_lag)
+
+    def _fail(self, db: Session, event_id: int, error: Exception):
+        event = db.query(models.OutboxEvent).filter(models.OutboxEvent.event_id == event_id).first()
+        event.attempts += 1
+        event.last_error = str(error)[:1000]
+        if event.attempts >= self.max_attempts:
+            event.status = DEAD
+            self.dead += 1
+        else:
+            event.available_at = datetime.now() + timedelta(seconds=retry_delay(event.attempts))
+            self.retried += 1
+        db.commit()
+
+    def delete_dispatched(self, db: Session) -> int:
+        cutoff = datetime.now() - self.retention
+        event_ids = [
+            event_id for (event_id,) in db.query(models.OutboxEvent.event_id).filter(
+                and_(models.OutboxEvent.status == DISPATCHED, models.OutboxEvent.dispatched_at < cutoff)
+            ).limit(self.batch_size).all()
+        ]
+        if not event_ids:
+            return 0
+        deleted = db.query(models.OutboxEvent).filter(
+            models.OutboxEvent.event_id.in_(event_ids)
+        ).delete(synchronize_session=False)
+        db.commit()
+        return deleted
+
+    def metrics(self, db: Session) -> dict:
+        pending, oldest = db.query(
+            func.count(models.OutboxEvent.event_id), func.min(models.OutboxEvent.created_at)
+        ).filter(models.OutboxEvent.status == PENDING).one()
+        dead = db.query(func.count(models.OutboxEvent.event_id)).filter(
+            models.OutboxEvent.status == DEAD
+        ).scalar()
+        return {
+            "pending": pending,
+            "dead": dead,
+            "oldest_pending_age_seconds": (datetime.now() - oldest).total_seconds() if oldest else 0.0,
+            "dispatched": self.dispatched,
+            "retried": self.retried,
+            "dead_lettered": self.dead,
+            "last_lag_seconds": self.last_lag,
+            "max_lag_seconds": self.max_lag,
+            "last_dispatch_at": self.last_dispatch_at,
+        }
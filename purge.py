@@ -0,0 +1,260 @@
+import logging
+import threading
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import or_, select, tuple_
+from sqlalchemy.orm import Session
+
+import crud
+import models
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+MAX_ATTEMPTS = 5
+
+
+def _unqueue_reports(db: Session, reports: List[models.Report]):
+    for report in reports:
+        crud._unqueue_report(db, report.ad_id, report.reason)
+
+
+def _unroll_transactions(db: Session, transactions: List[models.Transaction]):
+    for db_transaction in transactions:
+        crud._apply_transaction_rollup(db, db_transaction, sign=-1)
+
+
+def _user_ads(user_id: int):
+    return select(models.Ad.ad_id).where(models.Ad.user_id == user_id)
+
+
+def _user_archived_ads(user_id: int):
+    return select(models.ArchivedAd.ad_id).where(models.ArchivedAd.user_id == user_id)
+
+
+def _of_user_ads(ad_id_column, user_id: int):
+    return or_(ad_id_column.in_(_user_ads(user_id)), ad_id_column.in_(_user_archived_ads(user_id)))
+
+
+def _user_searches(user_id: int):
+    return select(models.SavedSearch.search_id).where(models.SavedSearch.user_id == user_id)
+
+
+# Ordered steps per target type: (name, model, condition for a target id, hook run on each deleted batch).
+# Children go first so every step only removes rows nothing else points at.
+PURGE_STEPS: Dict[str, List[Tuple[str, type, Callable, Optional[Callable]]]] = {
+    crud.PURGE_AD: [
+        ("messages", models.Message, lambda ad_id: models.Message.ad_id == ad_id, None),
+        ("favorites", models.Favorite, lambda ad_id: models.Favorite.ad_id == ad_id, None),
+        ("reports", models.Report, lambda ad_id: models.Report.ad_id == ad_id, None),
+        ("moderation_queue", models.ModerationQueueEntry, lambda ad_id: models.ModerationQueueEntry.ad_id == ad_id, None),
+        ("transactions", models.Transaction, lambda ad_id: models.Transaction.ad_id == ad_id, _unroll_transactions),
+        ("saved_search_matches", models.SavedSearchMatch, lambda ad_id: models.SavedSearchMatch.ad_id == ad_id, None),
+        ("trending_snapshots", models.TrendingSnapshot, lambda ad_id: models.TrendingSnapshot.ad_id == ad_id, None),
+        ("ad_images", models.AdImage, lambda ad_id: models.AdImage.ad_id == ad_id, None),
+        ("ad_lsh_buckets", models.AdLshBucket, lambda ad_id: models.AdLshBucket.ad_id == ad_id, None),
+        # Archived children of the ad (e.g. old messages) would otherwise outlive it
+        ("messages_archive", models.ArchivedMessage, lambda ad_id: models.ArchivedMessage.ad_id == ad_id, None),
+        ("favorites_archive", models.ArchivedFavorite, lambda ad_id: models.ArchivedFavorite.ad_id == ad_id, None),
+        ("reports_archive", models.ArchivedReport, lambda ad_id: models.ArchivedReport.ad_id == ad_id, None),
+        ("transactions_archive", models.ArchivedTransaction,
+         lambda ad_id: models.ArchivedTransaction.ad_id == ad_id, _unroll_transactions),
+        ("ad_images_archive", models.ArchivedAdImage, lambda ad_id: models.ArchivedAdImage.ad_id == ad_id, None),
+        ("ads_archive", models.ArchivedAd, lambda ad_id: models.ArchivedAd.ad_id == ad_id, None),
+        ("ads", models.Ad, lambda ad_id: models.Ad.ad_id == ad_id, None),
+    ],
+    crud.PURGE_USER: [
+        ("messages", models.Message, lambda user_id: or_(
+            models.Message.sender_id == user_id,
+            models.Message.receiver_id == user_id,
+            models.Message.ad_id.in_(_user_ads(user_id))
+        ), None),
+        ("favorites", models.Favorite, lambda user_id: or_(
+            models.Favorite.user_id == user_id,
+            models.Favorite.ad_id.in_(_user_ads(user_id))
+        ), None),
+        ("reports", models.Report, lambda user_id: or_(
+            models.Report.reported_by == user_id,
+            models.Report.ad_id.in_(_user_ads(user_id))
+        ), _unqueue_reports),
+        ("moderation_queue", models.ModerationQueueEntry,
+         lambda user_id: models.ModerationQueueEntry.ad_id.in_(_user_ads(user_id)), None),
+        ("transactions", models.Transaction, lambda user_id: or_(
+            models.Transaction.buyer_id == user_id,
+            models.Transaction.seller_id == user_id,
+            models.Transaction.ad_id.in_(_user_ads(user_id))
+        ), _unroll_transactions),
+        ("saved_search_matches", models.SavedSearchMatch, lambda user_id: or_(
+            models.SavedSearchMatch.user_id == user_id,
+            models.SavedSearchMatch.ad_id.in_(_user_ads(user_id))
+        ), None),
+        ("saved_search_keys", models.SavedSearchKey,
+         lambda user_id: models.SavedSearchKey.search_id.in_(_user_searches(user_id)), None),
+        ("saved_searches", models.SavedSearch, lambda user_id: models.SavedSearch.user_id == user_id, None),
+        ("trending_snapshots", models.TrendingSnapshot,
+         lambda user_id: models.TrendingSnapshot.ad_id.in_(_user_ads(user_id)), None),
+        ("ad_images", models.AdImage, lambda user_id: models.AdImage.ad_id.in_(_user_ads(user_id)), None),
+        ("ad_lsh_buckets", models.AdLshBucket, lambda user_id: models.AdLshBucket.user_id == user_id, None),
+        # Archive rows are not hidden once the user row is gone, so they have to go too
+        ("messages_archive", models.ArchivedMessage, lambda user_id: or_(
+            models.ArchivedMessage.sender_id == user_id,
+            models.ArchivedMessage.receiver_id == user_id,
+            _of_user_ads(models.ArchivedMessage.ad_id, user_id)
+        ), None),
+        ("favorites_archive", models.ArchivedFavorite, lambda user_id: or_(
+            models.ArchivedFavorite.user_id == user_id,
+            _of_user_ads(models.ArchivedFavorite.ad_id, user_id)
+        ), None),
+        ("reports_archive", models.ArchivedReport, lambda user_id: or_(
+            models.ArchivedReport.reported_by == user_id,
+            _of_user_ads(models.ArchivedReport.ad_id, user_id)
+        ), None),
+        ("transactions_archive", models.ArchivedTransaction, lambda user_id: or_(
+            models.ArchivedTransaction.buyer_id == user_id,
+            models.ArchivedTransaction.seller_id == user_id,
+            _of_user_ads(models.ArchivedTransaction.ad_id, user_id)
+        ), _unroll_transactions),
+        ("ad_images_archive", models.ArchivedAdImage,
+         lambda user_id: _of_user_ads(models.ArchivedAdImage.ad_id, user_id), None),
+        ("ads_archive", models.ArchivedAd, lambda user_id: models.ArchivedAd.user_id == user_id, None),
+        ("ads", models.Ad, lambda user_id: models.Ad.user_id == user_id, None),
+        ("users", models.User, lambda user_id: models.User.user_id == user_id, None),
+    ],
+}
+
+
+def delete_batch(db: Session, model, condition, batch_size: int, on_delete: Optional[Callable] = None) -> int:
+    """Delete at most ``batch_size`` rows of ``model`` matching ``condition``.
+
+    Rows are picked by primary key first, so the DELETE only locks the rows it removes.
+    """
+    primary_key = model.__mapper__.primary_key
+    if on_delete is not None:
+        rows = db.query(model).filter(condition).limit(batch_size).all()
+        keys = [tuple(getattr(row, column.key) for column in primary_key) for row in rows]
+    else:
+        rows = None
+        keys = [tuple(key) for key in db.query(*primary_key).filter(condition).limit(batch_size).all()]
+    if not keys:
+        return 0
+    if len(primary_key) == 1:
+        key_filter = primary_key[0].in_([key[0] for key in keys])
+    else:
+        key_filter = tuple_(*primary_key).in_(keys)
+    deleted = db.query(model).filter(key_filter).delete(synchronize_session=False)
+    if on_delete is not None:
+        on_delete(db, rows)
+    return deleted
+
+
+def purge_next_batch(db: Session, batch_size: int = BATCH_SIZE) -> bool:
+    """Delete one batch for the oldest unfinished job. Returns False when there is nothing to do."""
+    purge_job = db.query(models.PurgeJob).filter(
+        models.PurgeJob.status.in_([crud.PURGE_PENDING, crud.PURGE_RUNNING])
+    ).order_by(models.PurgeJob.job_id).with_for_update(skip_locked=True).first()
+    if purge_job is None:
+        db.rollback()
+        return False
+    job_id = purge_job.job_id
+    try:
+        steps = PURGE_STEPS[purge_job.target_type]
+        names = [name for name, _, _, _ in steps]
+        index = names.index(purge_job.step) if purge_job.step in names else 0
+        purge_job.status = crud.PURGE_RUNNING
+        for name, model, condition, on_delete in steps[index:]:
+            purge_job.step = name
+            deleted = 0
+            if name == names[-1]:
+                # Rows written by requests that raced the soft delete may have appeared after their
+                # step ran; sweep them in the same transaction so the root delete never hits an FK
+                for _, child_model, child_condition, child_on_delete in steps[:-1]:
+                    while True:
+                        swept = delete_batch(db, child_model, child_condition(purge_job.target_id), batch_size, child_on_delete)
+                        if not swept:
+                            break
+                        deleted += swept
+            deleted += delete_batch(db, model, condition(purge_job.target_id), batch_size, on_delete)
+            if deleted:
+                # Progress is committed with the batch itself
+                purge_job.rows_deleted += deleted
+                db.commit()
+                return True
+        purge_job.status = crud.PURGE_COMPLETED
+        purge_job.step = None
+        purge_job.completed_at = datetime.now()
+        db.commit()
+        return True
+    except Exception as e:
+        db.rollback()
+        logger.exception("Purge job %s failed", job_id)
+        purge_job = crud.get_purge_job(db, job_id=job_id)
+        purge_job.attempts += 1
+        purge_job.error = str(e)
+        if purge_job.attempts >= MAX_ATTEMPTS:
+            purge_job.status = crud.PURGE_FAILED
+        db.commit()
+        return False
+
+
+class PurgeWorker:
+    """Background thread that drains purge jobs one short transaction at a time.
+
+    A small pause between batches leaves room for request traffic on the same
+    tables; unfinished jobs (including ones interrupted by a crash) are picked
+    up again on the next poll.
+    """
+
+    def __init__(self, session_factory: Callable, batch_size: int = BATCH_SIZE,
+                 poll_interval: float = 5.0, pause: float = 0.05):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.pause = pause
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="purge-worker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            db = self.session_factory()
+            try:
+                worked = purge_next_batch(db, self.batch_size)
+            except Exception:
+                logger.exception("Purge worker error")
+                db.rollback()
+                worked = False
+            finally:
+                db.close()
+            if worked:
+                self._stop.wait(self.pause)
+            else:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+
+if __name__ == "__main__":
+    from main import SessionLocal
+
+    db = SessionLocal()
+    try:
+        batches = 0
+        while purge_next_batch(db):
+            batches += 1
+        print(f"Purge finished ({batches} batches)")
+    finally:
+        db.close()
@@ -0,0 +1,362 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.orm import Session
+
+import models
+
+logger = logging.getLogger(__name__)
+
+# Interaction weights: messaging a seller is a stronger signal than saving an ad
+FAVORITE_WEIGHT = 1.0
+MESSAGE_WEIGHT = 2.0
+# Added to the co-interaction cosine when a candidate shares the ad's category / location
+CATEGORY_BONUS = 0.1
+LOCATION_BONUS = 0.05
+TOP_K = 20
+
+CURRENT_FILE = "CURRENT"
+KEEP_VERSIONS = 2
+# Neighbours sold or deleted since the version was built; rewritten next to its arrays
+TOMBSTONES_FILE = "tombstones.npy"
+TOMBSTONE_INTERVAL = 30.0
+TOMBSTONE_CHUNK = 1000
+
+
+def load_interactions(db: Session) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    favorites = db.query(models.Favorite.user_id, models.Favorite.ad_id).all()
+    # Only buyer-side messages; a seller replying on their own ad is not interest
+    messages = db.query(models.Message.sender_id, models.Message.ad_id).join(
+        models.Ad, models.Ad.ad_id == models.Message.ad_id
+    ).filter(models.Message.sender_id != models.Ad.user_id).distinct().all()
+    users = np.fromiter((u for u, _ in favorites), dtype=np.int64, count=len(favorites))
+    ads = np.fromiter((a for _, a in favorites), dtype=np.int64, count=len(favorites))
+    users = np.concatenate([users, np.fromiter((u for u, _ in messages), dtype=np.int64, count=len(messages))])
+    ads = np.concatenate([ads, np.fromiter((a for _, a in messages), dtype=np.int64, count=len(messages))])
+    weights = np.concatenate([
+        np.full(len(favorites), FAVORITE_WEIGHT, dtype=np.float32),
+        np.full(len(messages), MESSAGE_WEIGHT, dtype=np.float32),
+    ])
+    return users, ads, weights
+
+
+def load_ad_attributes(db: Session, ad_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Category, location (-1 when unset) and availability (not sold or deleted) aligned with the sorted ad_ids
+    categories = np.full(len(ad_ids), -1, dtype=np.int64)
+    locations = np.full(len(ad_ids), -1, dtype=np.int64)
+    available = np.zeros(len(ad_ids), dtype=bool)
+    rows = db.query(
+        models.Ad.ad_id, models.Ad.category_id, models.Ad.location_id, models.Ad.is_sold, models.Ad.deleted_at
+    ).filter(models.Ad.ad_id.in_(ad_ids.tolist())).all() if len(ad_ids) else []
+    for ad_id, category_id, location_id, is_sold, deleted_at in rows:
+        i = np.searchsorted(ad_ids, ad_id)
+        categories[i] = category_id if category_id is not None else -1
+        locations[i] = location_id if location_id is not None else -1
+        available[i] = not is_sold and deleted_at is None
+    return categories, locations, available
+
+
+def _normalized_item_matrix(users, ads, weights):
+    ad_ids, item_index = np.unique(ads, return_inverse=True)
+    _, user_index = np.unique(users, return_inverse=True)
+    matrix = sparse.csr_matrix(
+        (weights, (user_index, item_index)),
+        shape=(int(user_index.max()) + 1 if len(users) else 0, len(ad_ids)),
+        dtype=np.float32,
+    )
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0))).ravel()
+    norms[norms == 0] = 1.0
+    return ad_ids, sparse.csc_matrix(matrix @ sparse.diags(1.0 / norms))
+
+
+def _top_k_rows(normalized, rows, categories, locations, available, top_k):
+    # Item-item cosine similarity for the requested rows only: X[:, rows]^T X
+    similarity = (normalized[:, rows].T @ normalized).tocsr()
+    neighbors = np.full((len(rows), top_k), -1, dtype=np.int64)
+    scores = np.zeros((len(rows), top_k), dtype=np.float32)
+    for n, row in enumerate(rows):
+        start, end = similarity.indptr[n], similarity.indptr[n + 1]
+        columns = similarity.indices[start:end]
+        values = similarity.data[start:end].astype(np.float32)
+        keep = (columns != row) & available[columns]
+        columns, values = columns[keep], values[keep]
+        if not len(columns):
+            continue
+        values += CATEGORY_BONUS * (categories[columns] == categories[row])
+        values += LOCATION_BONUS * ((locations[columns] == locations[row]) & (locations[row] >= 0))
+        count = min(top_k, len(columns))
+        best = np.argpartition(-values, count - 1)[:count]
+        best = best[np.argsort(-values[best], kind="stable")]
+        neighbors[n, :count] = columns[best]
+        scores[n, :count] = values[best]
+    return neighbors, scores
+
+
+def _write_index(path: str, ad_ids, neighbors, scores, top_k: int):
+    os.makedirs(path, exist_ok=True)
+    version = f"v{time.time_ns()}"
+    version_path = os.path.join(path, version)
+    os.makedirs(version_path)
+    np.save(os.path.join(version_path, "ad_ids.npy"), ad_ids)
+    np.save(os.path.join(version_path, "neighbors.npy"), neighbors)
+    np.save(os.path.join(version_path, "scores.npy"), scores)
+    with open(os.path.join(version_path, "manifest.json"), "w") as f:
+        json.dump({"built_at": time.time(), "ads": int(len(ad_ids)), "top_k": top_k}, f)
+    tmp = os.path.join(path, CURRENT_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        f.write(version)
+    os.replace(tmp, os.path.join(path, CURRENT_FILE))
+    # Readers that still map an older version keep their pages until they reload
+    versions = sorted(name for name in os.listdir(path) if name.startswith("v"))
+    for old in versions[:-KEEP_VERSIONS]:
+        shutil.rmtree(os.path.join(path, old), ignore_errors=True)
+    return version
+
+
+def build_index(db: Session, path: str, top_k: int = TOP_K) -> int:
+    users, ads, weights = load_interactions(db)
+    if not len(ads):
+        _write_index(path, np.zeros(0, dtype=np.int64), np.zeros((0, top_k), dtype=np.int64),
+                     np.zeros((0, top_k), dtype=np.float32), top_k)
+        return 0
+    ad_ids, normalized = _normalized_item_matrix(users, ads, weights)
+    categories, locations, available = load_ad_attributes(db, ad_ids)
+    neighbor_index, scores = _top_k_rows(
+        normalized, np.arange(len(ad_ids)), categories, locations, available, top_k
+    )
+    neighbors = np.where(neighbor_index >= 0, ad_ids[np.maximum(neighbor_index, 0)], -1)
+    _write_index(path, ad_ids, neighbors, scores, top_k)
+    return len(ad_ids)
+
+
+def refresh_index(db: Session, path: str, changed_ad_ids: Iterable[int], top_k: int = TOP_K) -> int:
+    """Recompute only the rows affected by interactions on ``changed_ad_ids``.
+
+    Affected rows are the changed ads plus every ad that shares an interacting
+    user with them (before or after the change), since only those similarities move.
+    """
+    index = SimilarAdsIndex(path)
+    if not index.load():
+        return build_index(db, path, top_k=top_k)
+    current = index.current
+    users, ads, weights = load_interactions(db)
+    if not len(ads):
+        return build_index(db, path, top_k=top_k)
+    ad_ids, normalized = _normalized_item_matrix(users, ads, weights)
+    changed = np.asarray(sorted(set(changed_ad_ids)), dtype=np.int64)
+    changed_rows = np.flatnonzero(np.isin(ad_ids, changed))
+    affected = set(changed.tolist())
+    if len(changed_rows):
+        co_occurring = (normalized[:, changed_rows].T @ normalized).tocsr()
+        affected.update(ad_ids[co_occurring.indices].tolist())
+    for ad_id in changed.tolist():
+        affected.update(ad for ad, _ in current.similar(ad_id, top_k))
+
+    old_ids = np.asarray(current.ad_ids)
+    old_neighbors = np.asarray(current.neighbors)
+    old_scores = np.asarray(current.scores)
+    # Rows for ads that lost all interactions disappear; new ads get fresh rows
+    keep_old = ~np.isin(old_ids, list(affected)) & np.isin(old_ids, ad_ids)
+    rows = np.flatnonzero(np.isin(ad_ids, list(affected)) | ~np.isin(ad_ids, old_ids))
+    categories, locations, available = load_ad_attributes(db, ad_ids)
+    neighbor_index, new_scores = _top_k_rows(normalized, rows, categories, locations, available, top_k)
+    new_neighbors = np.where(neighbor_index >= 0, ad_ids[np.maximum(neighbor_index, 0)], -1)
+
+    merged_ids = np.concatenate([old_ids[keep_old], ad_ids[rows]])
+    order = np.argsort(merged_ids, kind="stable")
+    merged_neighbors = np.concatenate([_fit_width(old_neighbors[keep_old], top_k, -1), new_neighbors])[order]
+    merged_scores = np.concatenate([_fit_width(old_scores[keep_old], top_k, 0), new_scores])[order]
+    _write_index(path, merged_ids[order], merged_neighbors, merged_scores, top_k)
+    return len(rows)
+
+
+def mark_dirty(db: Session, ad_id: int):
+    # Idempotent upsert, safe for redelivered outbox events; marks live in the database
+    # so every worker process and a restart see the same set
+    dirty = models.SimilarAdDirty.__table__
+    insert = mysql_insert(dirty).values(ad_id=ad_id, mark_count=1)
+    db.execute(insert.on_duplicate_key_update(mark_count=dirty.c.mark_count + 1))
+
+
+def dirty_marks(db: Session) -> Dict[int, int]:
+    return dict(db.query(models.SimilarAdDirty.ad_id, models.SimilarAdDirty.mark_count).all())
+
+
+def refresh_dirty(db: Session, path: str, top_k: int = TOP_K) -> int:
+    """Refresh the rows of every marked ad, then clear exactly the marks that were read.
+
+    An ad marked again while the refresh runs keeps its (newer) mark for the next one.
+    """
+    marks = dirty_marks(db)
+    if not marks:
+        return 0
+    rows = refresh_index(db, path, marks.keys(), top_k=top_k)
+    db.query(models.SimilarAdDirty).filter(
+        tuple_(models.SimilarAdDirty.ad_id, models.SimilarAdDirty.mark_count).in_(list(marks.items()))
+    ).delete(synchronize_session=False)
+    db.commit()
+    return rows
+
+
+def _fit_width(array, width, fill):
+    if array.shape[1] >= width:
+        return array[:, :width]
+    padded = np.full((array.shape[0], width), fill, dtype=array.dtype)
+    padded[:, :array.shape[1]] = array
+    return padded
+
+
+def write_tombstones(db: Session, path: str, min_interval: float = 0.0) -> Optional[int]:
+    """Record which neighbours in the current version are no longer available.
+
+    Lookups drop these ids without a database round trip; the next refresh or
+    rebuild removes them from the arrays themselves. Returns the number of
+    tombstones, or None when there is no index or another worker wrote them recently.
+    """
+    index = SimilarAdsIndex(path)
+    if not index.load():
+        return None
+    current = index.current
+    tombstones_path = os.path.join(path, current.version, TOMBSTONES_FILE)
+    try:
+        if time.time() - os.path.getmtime(tombstones_path) < min_interval:
+            return None
+    except FileNotFoundError:
+        pass
+    referenced = np.unique(np.asarray(current.neighbors))
+    referenced = referenced[referenced >= 0].tolist()
+    live = set()
+    for start in range(0, len(referenced), TOMBSTONE_CHUNK):
+        live.update(ad_id for ad_id, in db.query(models.Ad.ad_id).filter(
+            models.Ad.ad_id.in_(referenced[start:start + TOMBSTONE_CHUNK]),
+            models.Ad.deleted_at.is_(None),
+            models.Ad.is_sold.is_(False)
+        ))
+    # Archived and purged ads are gone from the table, so anything not found live is dead
+    dead = np.asarray([ad_id for ad_id in referenced if ad_id not in live], dtype=np.int64)
+    tmp = tombstones_path + ".tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, dead)
+    os.replace(tmp, tombstones_path)
+    return len(dead)
+
+
+class _IndexVersion:
+    """One version's arrays plus its tombstones, swapped in as a single reference."""
+
+    def __init__(self, version: Optional[str], ad_ids, neighbors, scores, tombstones, tombstones_mtime=None):
+        self.version = version
+        self.ad_ids = ad_ids
+        self.neighbors = neighbors
+        self.scores = scores
+        self.tombstones = tombstones
+        self.tombstones_mtime = tombstones_mtime
+
+    def similar(self, ad_id: int, limit: int) -> List[Tuple[int, float]]:
+        i = int(np.searchsorted(self.ad_ids, ad_id))
+        if i >= len(self.ad_ids) or self.ad_ids[i] != ad_id:
+            return []
+        neighbors, scores = self.neighbors[i], self.scores[i]
+        keep = (neighbors >= 0) & ~np.isin(neighbors, self.tombstones, assume_unique=True)
+        return [(int(neighbor), float(score)) for neighbor, score in zip(neighbors[keep][:limit], scores[keep][:limit])]
+
+
+_EMPTY_VERSION = _IndexVersion(
+    None, np.zeros(0, dtype=np.int64), np.zeros((0, 0), dtype=np.int64),
+    np.zeros((0, 0), dtype=np.float32), np.zeros(0, dtype=np.int64)
+)
+
+
+def _mtime(file_path: str) -> Optional[int]:
+    try:
+        return os.stat(file_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class SimilarAdsIndex:
+    """Read side of the similarity index.
+
+    Arrays are memory-mapped read-only, so every worker process shares the
+    same page-cache copy and lookups never touch the database. A background
+    thread keeps the tombstones current and picks up new versions.
+    """
+
+    def __init__(self, path: str, reload_interval: float = 30.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.current = _EMPTY_VERSION
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def load(self) -> bool:
+        try:
+            with open(os.path.join(self.path, CURRENT_FILE)) as f:
+                version = f.read().strip()
+        except FileNotFoundError:
+            return False
+        current = self.current
+        version_path = os.path.join(self.path, version)
+        tombstones_path = os.path.join(version_path, TOMBSTONES_FILE)
+        tombstones_mtime = _mtime(tombstones_path)
+        if version == current.version and tombstones_mtime == current.tombstones_mtime:
+            return True
+        if version == current.version:
+            ad_ids, neighbors, scores = current.ad_ids, current.neighbors, current.scores
+        else:
+            ad_ids = np.load(os.path.join(version_path, "ad_ids.npy"), mmap_mode="r")
+            neighbors = np.load(os.path.join(version_path, "neighbors.npy"), mmap_mode="r")
+            scores = np.load(os.path.join(version_path, "scores.npy"), mmap_mode="r")
+        tombstones = np.load(tombstones_path) if tombstones_mtime is not None else _EMPTY_VERSION.tombstones
+        # One reference swap, so a concurrent lookup sees either the old version or the new one
+        self.current = _IndexVersion(version, ad_ids, neighbors, scores, tombstones, tombstones_mtime)
+        return True
+
+    def similar(self, ad_id: int, limit: int = 10) -> List[Tuple[int, float]]:
+        return self.current.similar(ad_id, limit)
+
+    def start(self, session_factory: Callable):
+        def run():
+            while not self._stop.wait(self.reload_interval):
+                db = session_factory()
+                try:
+                    write_tombstones(db, self.path, min_interval=TOMBSTONE_INTERVAL)
+                    self.load()
+                except Exception:
+                    logger.exception("Failed to reload similar ads index from %s", self.path)
+                finally:
+                    db.close()
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=run, name="similar-ads-reload", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+if __name__ == "__main__":
+    import sys
+
+    from main import SessionLocal, RECOMMENDATIONS_PATH
+
+    db = SessionLocal()
+    try:
+        if len(sys.argv) > 2 and sys.argv[1] == "refresh":
+            rows = refresh_index(db, RECOMMENDATIONS_PATH, [int(ad_id) for ad_id in sys.argv[2:]])
+        else:
+            rows = build_index(db, RECOMMENDATIONS_PATH)
+        print(f"Similar ads index written to {RECOMMENDATIONS_PATH} ({rows} ads computed)")
+    finally:
+        db.close()
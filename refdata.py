@@ -0,0 +1,219 @@
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+import models
+import schemas
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = "reference.snapshot"
+LOCK_FILE = "reference.lock"
+_HEADER_SIZE = struct.Struct("<Q")
+
+LOCATIONS = "locations"
+CATEGORIES = "categories"
+PARENT_CATEGORIES = "parent_categories"
+
+
+def subcategories_section(parent_id: int) -> str:
+    return f"subcategories:{parent_id}"
+
+
+def _render(records: List[Tuple[int, bytes]]) -> Tuple[bytes, np.ndarray, np.ndarray]:
+    # Records are stored as one comma-separated run, so any [skip, skip + limit)
+    # page is a single contiguous slice of the file
+    ids = np.fromiter((record_id for record_id, _ in records), dtype=np.int64, count=len(records))
+    ends = np.zeros(len(records), dtype=np.int64)
+    position = -1
+    for i, (_, body) in enumerate(records):
+        position += len(body) + 1
+        ends[i] = position
+    return b",".join(body for _, body in records), ids, ends
+
+
+def build_sections(db: Session) -> Dict[str, List[Tuple[int, bytes]]]:
+    locations = db.query(models.Location).order_by(models.Location.location_id).all()
+    categories = db.query(models.Category).order_by(models.Category.category_id).all()
+    rendered = [
+        (category, schemas.Category.model_validate(category).model_dump_json().encode())
+        for category in categories
+    ]
+    sections = {
+        LOCATIONS: [
+            (location.location_id, schemas.Location.model_validate(location).model_dump_json().encode())
+            for location in locations
+        ],
+        CATEGORIES: [(category.category_id, body) for category, body in rendered],
+        PARENT_CATEGORIES: [(category.category_id, body) for category, body in rendered if category.parent_id is None],
+    }
+    for category, body in rendered:
+        if category.parent_id is not None:
+            sections.setdefault(subcategories_section(category.parent_id), []).append((category.category_id, body))
+    return sections
+
+
+def write_snapshot(path: str, sections: Dict[str, List[Tuple[int, bytes]]], generation: int):
+    """Write all sections into one file and atomically swap it in.
+
+    Layout: 8-byte header length, JSON header with section offsets, then for
+    each section its id array, end-offset array and JSON records.
+    """
+    blobs = []
+    header = {"generation": generation, "built_at": time.time(), "sections": {}}
+    offset = 0
+    for name, records in sections.items():
+        data, ids, ends = _render(records)
+        header["sections"][name] = {
+            "count": len(records),
+            "ids": offset,
+            "ends": offset + ids.nbytes,
+            "data": offset + ids.nbytes + ends.nbytes,
+            "length": len(data),
+        }
+        blobs.extend([ids.tobytes(), ends.tobytes(), data])
+        offset += ids.nbytes + ends.nbytes + len(data)
+    header_bytes = json.dumps(header).encode()
+    fd, tmp_path = tempfile.mkstemp(dir=path, prefix=".snapshot-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_HEADER_SIZE.pack(len(header_bytes)))
+            f.write(header_bytes)
+            for blob in blobs:
+                f.write(blob)
+        os.replace(tmp_path, os.path.join(path, SNAPSHOT_FILE))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class _Mapping:
+    def __init__(self, file_path: str):
+        with open(file_path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime_ns)
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (header_size,) = _HEADER_SIZE.unpack_from(self.buffer, 0)
+        header = json.loads(self.buffer[_HEADER_SIZE.size:_HEADER_SIZE.size + header_size])
+        self.generation = header["generation"]
+        self.base = _HEADER_SIZE.size + header_size
+        self.sections = header["sections"]
+
+    def _arrays(self, section):
+        count = section["count"]
+        ids = np.frombuffer(self.buffer, dtype=np.int64, count=count, offset=self.base + section["ids"])
+        ends = np.frombuffer(self.buffer, dtype=np.int64, count=count, offset=self.base + section["ends"])
+        return ids, ends
+
+    def page(self, name: str, skip: int, limit: int) -> bytes:
+        section = self.sections.get(name)
+        if section is None or skip >= section["count"] or limit <= 0:
+            return b"[]"
+        _, ends = self._arrays(section)
+        last = min(skip + limit, section["count"]) - 1
+        start = self.base + section["data"] + (int(ends[skip - 1]) + 1 if skip else 0)
+        end = self.base + section["data"] + int(ends[last])
+        return b"[" + self.buffer[start:end] + b"]"
+
+    def get(self, name: str, record_id: int) -> Optional[bytes]:
+        section = self.sections.get(name)
+        if section is None or not section["count"]:
+            return None
+        ids, ends = self._arrays(section)
+        i = int(np.searchsorted(ids, record_id))
+        if i >= len(ids) or ids[i] != record_id:
+            return None
+        start = self.base + section["data"] + (int(ends[i - 1]) + 1 if i else 0)
+        return self.buffer[start:self.base + section["data"] + int(ends[i])]
+
+
+class ReferenceData:
+    """Locations and categories pre-rendered as JSON in one memory-mapped file.
+
+    Every worker process maps the same file, so the data lives once in the page
+    cache. A write rebuilds the file under an exclusive lock and swaps it in with
+    os.replace; readers notice the new file with one stat() per lookup and remap.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file_path = os.path.join(path, SNAPSHOT_FILE)
+        self._mapping: Optional[_Mapping] = None
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self) -> Optional[int]:
+        mapping = self._current()
+        return mapping.generation if mapping is not None else None
+
+    def rebuild(self, db: Session) -> int:
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, LOCK_FILE), "a") as lock:
+            # Serializes rebuilds across processes. The session's read view may predate a
+            # concurrent writer's commit, so end it once the lock is held and read afresh
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                db.commit()
+                current = self._current()
+                generation = (current.generation if current is not None else 0) + 1
+                write_snapshot(self.path, build_sections(db), generation)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self._current()
+        return generation
+
+    def ensure(self, db: Session):
+        if not os.path.exists(self.file_path):
+            self.rebuild(db)
+
+    def _current(self) -> Optional[_Mapping]:
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            return None
+        mapping = self._mapping
+        if mapping is not None and mapping.identity == (stat.st_ino, stat.st_mtime_ns):
+            return mapping
+        with self._lock:
+            if self._mapping is None or self._mapping.identity != (stat.st_ino, stat.st_mtime_ns):
+                try:
+                    self._mapping = _Mapping(self.file_path)
+                except (OSError, ValueError):
+                    logger.exception("Failed to map reference snapshot %s", self.file_path)
+                    return self._mapping
+            return self._mapping
+
+    def page(self, name: str, skip: int = 0, limit: Optional[int] = None) -> Optional[bytes]:
+        """JSON array for a section page, or None when no snapshot is available."""
+        mapping = self._current()
+        if mapping is None:
+            return None
+        return mapping.page(name, skip, limit if limit is not None else 1 << 62)
+
+    def get(self, name: str, record_id: int) -> Tuple[bool, Optional[bytes]]:
+        """(snapshot available, JSON object or None if the id is unknown)."""
+        mapping = self._current()
+        if mapping is None:
+            return False, None
+        return True, mapping.get(name, record_id)
+
+
+if __name__ == "__main__":
+    from main import SessionLocal, REFERENCE_DATA_PATH
+
+    db = SessionLocal()
+    try:
+        print(f"Reference snapshot generation {ReferenceData(REFERENCE_DATA_PATH).rebuild(db)} written")
+    finally:
+        db.close()
@@ -1,6 +1,6 @@
 from pydantic import BaseModel, EmailStr
 from typing import Optional, List
-from datetime import datetime
+from datetime import datetime, date
 from decimal import Decimal
 from enum import Enum
 
@@ -57,6 +57,9 @@ class Location(LocationBase):
     class Config:
         from_attributes = True
 
+class LocationSuggestion(Location):
+    ad_count: int = 0
+
 # Category Schemas
 class CategoryBase(BaseModel):
     name: str
@@ -75,6 +78,9 @@ class Category(CategoryBase):
     class Config:
         from_attributes = True
 
+class CategorySuggestion(Category):
+    ad_count: int = 0
+
 # Ad Image Schemas
 class AdImageBase(BaseModel):
     image_url: str
@@ -85,6 +91,10 @@ class AdImageCreate(AdImageBase):
 class AdImage(AdImageBase):
     image_id: int
     ad_id: int
+    thumbnail_url: Optional[str] = None
+    medium_url: Optional[str] = None
+    position: int = 0
+    is_primary: bool = False
     
     class Config:
         from_attributes = True
@@ -114,6 +124,8 @@ class Ad(AdBase):
     ad_id: int
     user_id: int
     is_sold: bool
+    primary_image_url: Optional[str] = None
+    duplicate_of: Optional[int] = None
     created_at: datetime
     updated_at: datetime
     user: Optional[User] = None
@@ -124,6 +136,56 @@ class Ad(AdBase):
     class Config:
         from_attributes = True
 
+class AdSummary(BaseModel):
+    ad_id: int
+    user_id: int
+    category_id: int
+    location_id: Optional[int] = None
+    title: str
+    price: Decimal
+    is_sold: bool
+    primary_image_url: Optional[str] = None
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+class SimilarAd(BaseModel):
+    ad_id: int
+    score: float
+
+class TrendingAd(BaseModel):
+    ad_id: int
+    score: float
+
+# Saved Search Schemas
+class SavedSearchBase(BaseModel):
+    keywords: Optional[str] = None
+    category_id: Optional[int] = None
+    location_id: Optional[int] = None
+    min_price: Optional[Decimal] = None
+    max_price: Optional[Decimal] = None
+
+class SavedSearchCreate(SavedSearchBase):
+    user_id: int
+
+class SavedSearch(SavedSearchBase):
+    search_id: int
+    user_id: int
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+class SearchFeedItem(BaseModel):
+    search_id: int
+    matched_at: datetime
+    is_seen: bool
+    ad: AdSummary
+    
+    class Config:
+        from_attributes = True
+
 # Favorite Schemas
 class FavoriteBase(BaseModel):
     user_id: int
@@ -181,6 +243,17 @@ class Report(ReportBase):
     class Config:
         from_attributes = True
 
+# Moderation Schemas
+class ModerationQueueItem(BaseModel):
+    ad_id: int
+    report_count: int
+    score: float
+    last_reported_at: Optional[datetime] = None
+    ad: Optional[AdSummary] = None
+    
+    class Config:
+        from_attributes = True
+
 # Transaction Schemas
 class TransactionBase(BaseModel):
     amount: Decimal
@@ -208,6 +281,36 @@ class Transaction(TransactionBase):
     class Config:
         from_attributes = True
 
+# Analytics Schemas
+class TransactionRollup(BaseModel):
+    gmv: Decimal
+    completed_count: int
+    cancelled_count: int
+    pending_count: int
+    average_price: Optional[Decimal] = None
+
+class DailyTransactionRollup(TransactionRollup):
+    day: date
+    
+    class Config:
+        from_attributes = True
+
+class PurgeJob(BaseModel):
+    job_id: int
+    target_type: str
+    target_id: int
+    status: str
+    step: Optional[str] = None
+    rows_deleted: int
+    attempts: int
+    error: Optional[str] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+    completed_at: Optional[datetime] = None
+    
+    class Config:
+        from_attributes = True
+
 # Response Models
 class UserResponse(BaseModel):
     user_id: int
@@ -227,6 +330,8 @@ class AdResponse(BaseModel):
     price: Decimal
     condition: ConditionEnum
     is_sold: bool
+    primary_image_url: Optional[str] = None
+    duplicate_of: Optional[int] = None
     created_at: datetime
     updated_at: datetime
     user: Optional[UserResponse] = None
@@ -235,4 +340,9 @@ class AdResponse(BaseModel):
     images: List[AdImage] = []
     
     class Config:
-        from_attributes = True 
\ No newline at end of file
+        from_attributes = True
+
+class AdPage(BaseModel):
+    ad: AdResponse
+    more_from_seller: Optional[List[AdSummary]] = None
+    is_favorite: Optional[bool] = None
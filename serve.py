@@ -0,0 +1,142 @@
+import logging
+import os
+import signal
+import socket
+import time
+from typing import Callable, Dict, Optional
+
+import uvicorn
+
+logger = logging.getLogger(__name__)
+
+# A worker that dies sooner than this after starting is restarted with a delay
+MIN_UPTIME = 5.0
+RESTART_DELAY = 1.0
+GRACEFUL_TIMEOUT = 30
+
+
+def bind_socket(host: str, port: int, backlog: int = 2048) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Supervisor:
+    """Pre-fork process manager: keeps ``workers`` children running ``target``.
+
+    Everything imported before the fork (the app, numpy, models, the mapped
+    reference snapshot) is shared copy-on-write with the children. SIGTERM and
+    SIGINT are forwarded to the workers, and any worker still alive after
+    GRACEFUL_TIMEOUT seconds is killed.
+    """
+
+    def __init__(self, target: Callable[[], None], workers: int):
+        self.target = target
+        self.workers = workers
+        self.children: Dict[int, float] = {}
+        self.stopping = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            code = 0
+            try:
+                self.target()
+            except BaseException:
+                logger.exception("Worker %s crashed", os.getpid())
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = time.monotonic()
+        logger.info("Started worker %s", pid)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGALRM, self._kill)
+        for _ in range(self.workers):
+            self.spawn()
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started_at = self.children.pop(pid, None)
+            if self.stopping or started_at is None:
+                continue
+            logger.warning("Worker %s exited with status %s, restarting", pid, status)
+            if time.monotonic() - started_at < MIN_UPTIME:
+                time.sleep(RESTART_DELAY)
+            if not self.stopping:
+                self.spawn()
+        logger.info("All workers stopped")
+
+    def _stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info("Stopping %d workers", len(self.children))
+        for pid in list(self.children):
+            _signal(pid, signal.SIGTERM)
+        signal.alarm(GRACEFUL_TIMEOUT)
+
+    def _kill(self, signum, frame):
+        for pid in list(self.children):
+            logger.warning("Worker %s did not stop in time, killing it", pid)
+            _signal(pid, signal.SIGKILL)
+
+
+def _signal(pid: int, signum: int):
+    try:
+        os.kill(pid, signum)
+    except ProcessLookupError:
+        pass
+
+
+def run(app, host: str = "0.0.0.0", port: int = 8000, workers: Optional[int] = None,
+        preload: Optional[Callable[[], None]] = None, log_level: str = "info", **uvicorn_options):
+    """Serve ``app`` from ``workers`` forked processes sharing one listening socket.
+
+    ``preload`` runs once in the parent before forking (build shared data, close
+    pooled DB connections so no socket is shared between processes). Startup and
+    shutdown events still run in every worker.
+    """
+    workers = workers or os.cpu_count() or 1
+    if preload is not None:
+        preload()
+    if workers == 1 or not hasattr(os, "fork"):
+        uvicorn.run(app, host=host, port=port, log_level=log_level, **uvicorn_options)
+        return
+    logging.basicConfig(level=log_level.upper(), format="%(asctime)s [%(process)d] %(levelname)s %(message)s")
+    sock = bind_socket(host, port)
+
+    def serve_worker():
+        config = uvicorn.Config(app, log_level=log_level, **uvicorn_options)
+        uvicorn.Server(config).run(sockets=[sock])
+
+    logger.info("Listening on %s:%d with %d workers", host, port, workers)
+    try:
+        Supervisor(serve_worker, workers).run()
+    finally:
+        sock.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from main import app, preload_for_workers
+
+    parser = argparse.ArgumentParser(description="Run the API in pre-fork multi-process mode")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=None, help="Defaults to the number of CPUs")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+    run(app, host=args.host, port=args.port, workers=args.workers, preload=preload_for_workers, log_level=args.log_level)
@@ -0,0 +1,176 @@
+import hashlib
+import logging
+import os
+import tempfile
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Callable, Dict, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+import crud
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+# Rendition name -> bounding box (width, height)
+RENDITIONS: Dict[str, Tuple[int, int]] = {
+    "thumbnail": (320, 320),
+    "medium": (1024, 1024),
+}
+
+ALLOWED_CONTENT_TYPES = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/webp": "webp",
+    "image/gif": "gif",
+}
+
+
+class StorageBackend(ABC):
+    """Interface for content-addressed blob storage.
+
+    Keys are relative paths such as ``ab/abcdef....jpg``; backends decide
+    where the bytes live and how they are exposed over HTTP.
+    """
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        ...
+
+    @abstractmethod
+    def save_file(self, key: str, path: str) -> None:
+        ...
+
+    @abstractmethod
+    def open(self, key: str) -> BinaryIO:
+        ...
+
+    @abstractmethod
+    def url(self, key: str) -> str:
+        ...
+
+    def temp_dir(self) -> Optional[str]:
+        return None
+
+
+class LocalStorage(StorageBackend):
+    def __init__(self, root: str, base_url: str):
+        self.root = os.path.abspath(root)
+        self.base_url = base_url.rstrip("/")
+        os.makedirs(os.path.join(self.root, ".tmp"), exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def save_file(self, key: str, path: str) -> None:
+        target = self._path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Same filesystem as temp_dir(), so this is an atomic rename
+        os.replace(path, target)
+
+    def open(self, key: str) -> BinaryIO:
+        return open(self._path(key), "rb")
+
+    def url(self, key: str) -> str:
+        return f"{self.base_url}/{key}"
+
+    def temp_dir(self) -> Optional[str]:
+        return os.path.join(self.root, ".tmp")
+
+
+def content_key(content_hash: str, extension: str, suffix: str = "") -> str:
+    return f"{content_hash[:2]}/{content_hash}{suffix}.{extension}"
+
+
+def store_upload(storage: StorageBackend, source: BinaryIO, extension: str,
+                 max_bytes: Optional[int] = None) -> Tuple[str, str]:
+    """Stream ``source`` into storage in fixed-size chunks.
+
+    Returns ``(content_hash, key)``. Identical content is stored only once.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=storage.temp_dir())
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise ValueError("File too large")
+                digest.update(chunk)
+                tmp.write(chunk)
+        content_hash = digest.hexdigest()
+        key = content_key(content_hash, extension)
+        if storage.exists(key):
+            os.remove(tmp_path)
+        else:
+            storage.save_file(key, tmp_path)
+        return content_hash, key
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def render_renditions(storage: StorageBackend, content_hash: str, key: str) -> Dict[str, str]:
+    """Create resized JPEG renditions of an original and return their URLs."""
+    urls = {}
+    with storage.open(key) as original:
+        image = Image.open(original)
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        for name, size in RENDITIONS.items():
+            rendition_key = content_key(content_hash, "jpg", suffix=f"_{name}")
+            if not storage.exists(rendition_key):
+                resized = image.copy()
+                resized.thumbnail(size, Image.LANCZOS)
+                fd, tmp_path = tempfile.mkstemp(dir=storage.temp_dir())
+                with os.fdopen(fd, "wb") as tmp:
+                    resized.save(tmp, format="JPEG", quality=82, optimize=True, progressive=True)
+                storage.save_file(rendition_key, tmp_path)
+            urls[name] = storage.url(rendition_key)
+    return urls
+
+
+class RenditionWorker:
+    """Background pool that resizes uploaded images off the request path.
+
+    Pillow releases the GIL while decoding and resampling, so a small
+    thread pool keeps cores busy without the cost of process pickling.
+    """
+
+    def __init__(self, storage: StorageBackend, session_factory: Callable, max_workers: int = 2):
+        self.storage = storage
+        self.session_factory = session_factory
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="renditions")
+
+    def submit(self, image_id: int, content_hash: str, key: str):
+        return self.executor.submit(self._process, image_id, content_hash, key)
+
+    def _process(self, image_id: int, content_hash: str, key: str):
+        try:
+            urls = render_renditions(self.storage, content_hash, key)
+        except Exception:
+            logger.exception("Failed to render image %s", image_id)
+            return
+        db = self.session_factory()
+        try:
+            crud.update_ad_image_renditions(
+                db, image_id=image_id,
+                thumbnail_url=urls.get("thumbnail"),
+                medium_url=urls.get("medium"),
+            )
+        finally:
+            db.close()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
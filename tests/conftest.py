@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+# The application modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    # In-memory SQLite is enough for the queries these modules run; MySQL-only upserts are not exercised
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def add_ad(db, ad_id, user_id=1, category_id=1, location_id=None, title="Ad", description="Ad",
+           is_sold=False, deleted_at=None):
+    db_ad = models.Ad(ad_id=ad_id, user_id=user_id, category_id=category_id, location_id=location_id,
+                      title=title, description=description, price=1, condition=models.ConditionEnum.USED,
+                      is_sold=is_sold, deleted_at=deleted_at)
+    db.add(db_ad)
+    db.flush()
+    return db_ad
@@ -0,0 +1,72 @@
+from datetime import datetime
+
+import dedupe
+from conftest import add_ad
+
+TITLE = "Toyota Corolla 2015 GLi automatic for sale"
+DESCRIPTION = ("Single owner genuine paint complete service history from the dealership new tyres and battery "
+               "fitted last month no accidents token paid for this year")
+# One extra sentence: estimated similarity 0.91
+NEAR_DUPLICATE = DESCRIPTION + " price slightly negotiable"
+# Same title, different car: estimated similarity 0.11
+DIFFERENT = "Urgent sale, bumper repainted, AC not working, needs new clutch plate, documents clear"
+
+
+def _indexed_ad(db, ad_id, description, user_id=1, category_id=1, deleted_at=None):
+    db_ad = add_ad(db, ad_id, user_id=user_id, category_id=category_id, title=TITLE, description=description,
+                   deleted_at=deleted_at)
+    dedupe.index_ad(db, db_ad, dedupe.signature(db_ad.title, db_ad.description))
+    db.flush()
+    return db_ad
+
+
+def test_normalize_folds_case_accents_and_punctuation():
+    assert dedupe.normalize("Múltan, PUNJAB!") == ["multan", "punjab"]
+    assert dedupe.normalize(None) == []
+
+
+def test_shingles_are_word_trigrams():
+    assert dedupe.shingles("a b c", "d") == ["a b c", "b c d"]
+    assert dedupe.shingles("two words", None) == ["two words"]
+
+
+def test_identical_text_shares_signature_and_every_band():
+    first = dedupe.signature(TITLE, DESCRIPTION)
+    second = dedupe.signature(TITLE.upper(), DESCRIPTION + "!")
+    assert dedupe.similarity(first, second) == 1.0
+    assert dedupe.band_buckets(first) == dedupe.band_buckets(second)
+    assert len(dedupe.band_buckets(first)) == dedupe.BANDS
+
+
+def test_similarity_straddles_the_threshold():
+    base = dedupe.signature(TITLE, DESCRIPTION)
+    assert dedupe.similarity(base, dedupe.signature(TITLE, NEAR_DUPLICATE)) >= dedupe.DUPLICATE_THRESHOLD
+    assert dedupe.similarity(base, dedupe.signature(TITLE, DIFFERENT)) < dedupe.DUPLICATE_THRESHOLD
+
+
+def test_find_duplicate_flags_near_duplicate_by_same_seller(db):
+    _indexed_ad(db, 1, DESCRIPTION)
+    match = dedupe.find_duplicate(db, 1, 1, dedupe.signature(TITLE, NEAR_DUPLICATE))
+    assert match is not None
+    assert match[0] == 1
+    assert match[1] >= dedupe.DUPLICATE_THRESHOLD
+
+
+def test_find_duplicate_ignores_dissimilar_other_seller_and_deleted_ads(db):
+    _indexed_ad(db, 1, DESCRIPTION, user_id=2)
+    _indexed_ad(db, 2, DESCRIPTION, category_id=2)
+    _indexed_ad(db, 3, DESCRIPTION, deleted_at=datetime.now())
+    _indexed_ad(db, 4, DIFFERENT)
+    assert dedupe.find_duplicate(db, 1, 1, dedupe.signature(TITLE, NEAR_DUPLICATE)) is None
+
+
+def test_find_duplicate_excludes_the_ad_itself(db):
+    _indexed_ad(db, 1, DESCRIPTION)
+    assert dedupe.find_duplicate(db, 1, 1, dedupe.signature(TITLE, DESCRIPTION), exclude_ad_id=1) is None
+
+
+def test_empty_text_never_matches(db):
+    db_ad = add_ad(db, 1, title="", description="")
+    dedupe.index_ad(db, db_ad, dedupe.signature("", ""))
+    db.flush()
+    assert dedupe.find_duplicate(db, 1, 1, dedupe.signature("", "")) is None
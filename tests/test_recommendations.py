@@ -0,0 +1,108 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+import models
+import recommendations
+from conftest import add_ad
+
+
+def _matrix(pairs):
+    users = np.array([user for user, _ in pairs], dtype=np.int64)
+    ads = np.array([ad for _, ad in pairs], dtype=np.int64)
+    return recommendations._normalized_item_matrix(users, ads, np.ones(len(pairs), dtype=np.float32))
+
+
+def _neighbors(pairs, available=None, categories=None, top_k=5):
+    ad_ids, normalized = _matrix(pairs)
+    count = len(ad_ids)
+    categories = np.asarray(categories if categories is not None else [-1] * count, dtype=np.int64)
+    available = np.asarray(available if available is not None else [True] * count, dtype=bool)
+    neighbor_index, scores = recommendations._top_k_rows(
+        normalized, np.arange(count), categories, np.full(count, -1, dtype=np.int64), available, top_k
+    )
+    neighbors = np.where(neighbor_index >= 0, ad_ids[np.maximum(neighbor_index, 0)], -1)
+    return ad_ids, neighbors, scores
+
+
+def test_co_interacted_ads_rank_by_cosine():
+    # Ad 10 shares two users with 20 and one with 30; 40 shares none
+    pairs = [(1, 10), (1, 20), (2, 10), (2, 20), (3, 10), (3, 30), (4, 40)]
+    ad_ids, neighbors, scores = _neighbors(pairs)
+    row = int(np.searchsorted(ad_ids, 10))
+    assert [ad for ad in neighbors[row] if ad >= 0] == [20, 30]
+    assert scores[row, 0] > scores[row, 1] > 0
+    assert all(ad < 0 for ad in neighbors[int(np.searchsorted(ad_ids, 40))])
+
+
+def test_unavailable_ads_and_the_ad_itself_are_never_neighbours():
+    pairs = [(1, 10), (1, 20), (1, 30)]
+    ad_ids, neighbors, _ = _neighbors(pairs, available=[True, False, True])
+    assert [ad for ad in neighbors[0] if ad >= 0] == [30]
+
+
+def test_category_bonus_breaks_ties():
+    pairs = [(1, 10), (1, 20), (1, 30)]
+    ad_ids, neighbors, scores = _neighbors(pairs, categories=[1, 2, 1])
+    assert list(neighbors[0, :2]) == [30, 20]
+    assert scores[0, 0] - scores[0, 1] == pytest.approx(recommendations.CATEGORY_BONUS)
+
+
+def _write(path, ad_ids, neighbors, scores):
+    recommendations._write_index(str(path), np.asarray(ad_ids, dtype=np.int64),
+                                 np.asarray(neighbors, dtype=np.int64), np.asarray(scores, dtype=np.float32), 2)
+
+
+def test_index_round_trip_and_version_swap(tmp_path):
+    index = recommendations.SimilarAdsIndex(str(tmp_path))
+    assert not index.load()
+    assert index.similar(1) == []
+    _write(tmp_path, [1, 2], [[2, -1], [1, -1]], [[0.5, 0], [0.5, 0]])
+    assert index.load()
+    first = index.current
+    assert index.similar(1) == [(2, 0.5)]
+    assert index.similar(3) == []
+    time.sleep(0.001)
+    _write(tmp_path, [1, 2, 3], [[3, 2], [1, -1], [1, -1]], [[0.9, 0.5], [0.5, 0], [0.9, 0]])
+    index.load()
+    assert index.current is not first
+    assert first.similar(1, 10) == [(2, 0.5)]
+    assert index.similar(1, 1) == [(3, pytest.approx(0.9))]
+
+
+def test_tombstones_hide_sold_and_deleted_neighbours(tmp_path, db):
+    add_ad(db, 1)
+    add_ad(db, 2, is_sold=True)
+    add_ad(db, 3)
+    db.flush()
+    _write(tmp_path, [1, 2, 3], [[2, 3], [1, 3], [1, 2]], [[0.9, 0.5], [0.9, 0.5], [0.5, 0.5]])
+    index = recommendations.SimilarAdsIndex(str(tmp_path))
+    index.load()
+    assert [ad for ad, _ in index.similar(1)] == [2, 3]
+    assert recommendations.write_tombstones(db, str(tmp_path)) == 1
+    # Another worker wrote them moments ago
+    assert recommendations.write_tombstones(db, str(tmp_path), min_interval=60) is None
+    arrays = index.current.ad_ids
+    index.load()
+    assert index.current.ad_ids is arrays
+    assert [ad for ad, _ in index.similar(1)] == [3]
+    db.query(models.Ad).filter(models.Ad.ad_id == 3).delete()
+    db.flush()
+    os.utime(os.path.join(str(tmp_path), index.current.version, recommendations.TOMBSTONES_FILE), (0, 0))
+    recommendations.write_tombstones(db, str(tmp_path))
+    index.load()
+    assert index.similar(1) == []
+    assert index.similar(2) == [(1, pytest.approx(0.9))]
+
+
+def test_build_index_from_interactions(tmp_path, db):
+    for ad_id in (1, 2, 3):
+        add_ad(db, ad_id, user_id=9)
+    db.add_all([models.Favorite(user_id=user_id, ad_id=ad_id) for user_id, ad_id in [(1, 1), (1, 2), (2, 1), (2, 2), (2, 3)]])
+    db.flush()
+    assert recommendations.build_index(db, str(tmp_path)) == 3
+    index = recommendations.SimilarAdsIndex(str(tmp_path))
+    index.load()
+    assert [ad for ad, _ in index.similar(1)] == [2, 3]
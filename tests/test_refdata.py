@@ -0,0 +1,70 @@
+import json
+
+import refdata
+
+
+def _record(record_id, name):
+    return record_id, json.dumps({"id": record_id, "name": name}).encode()
+
+
+def _write(path, generation, names):
+    sections = {
+        refdata.LOCATIONS: [_record(i, name) for i, name in enumerate(names, start=1)],
+        refdata.CATEGORIES: [],
+    }
+    refdata.write_snapshot(str(path), sections, generation)
+
+
+def test_missing_snapshot_reads_as_unavailable(tmp_path):
+    reference_data = refdata.ReferenceData(str(tmp_path))
+    assert reference_data.generation is None
+    assert reference_data.page(refdata.LOCATIONS) is None
+    assert reference_data.get(refdata.LOCATIONS, 1) == (False, None)
+
+
+def test_pages_are_contiguous_json_slices(tmp_path):
+    names = ["Lahore", "Karachi", "Islamabad", "Multan", "Quetta"]
+    _write(tmp_path, 1, names)
+    reference_data = refdata.ReferenceData(str(tmp_path))
+    assert [row["name"] for row in json.loads(reference_data.page(refdata.LOCATIONS))] == names
+    assert [row["name"] for row in json.loads(reference_data.page(refdata.LOCATIONS, skip=1, limit=2))] == names[1:3]
+    assert [row["name"] for row in json.loads(reference_data.page(refdata.LOCATIONS, skip=4, limit=10))] == names[4:]
+    assert reference_data.page(refdata.LOCATIONS, skip=5) == b"[]"
+    assert reference_data.page(refdata.CATEGORIES) == b"[]"
+    assert reference_data.page("unknown") == b"[]"
+
+
+def test_get_finds_records_by_id(tmp_path):
+    _write(tmp_path, 1, ["Lahore", "Karachi"])
+    reference_data = refdata.ReferenceData(str(tmp_path))
+    available, body = reference_data.get(refdata.LOCATIONS, 2)
+    assert available
+    assert json.loads(body) == {"id": 2, "name": "Karachi"}
+    assert reference_data.get(refdata.LOCATIONS, 3) == (True, None)
+    assert reference_data.get(refdata.CATEGORIES, 1) == (True, None)
+
+
+def test_readers_remap_a_rewritten_snapshot(tmp_path):
+    _write(tmp_path, 1, ["Lahore"])
+    reference_data = refdata.ReferenceData(str(tmp_path))
+    assert reference_data.generation == 1
+    _write(tmp_path, 2, ["Lahore", "Karachi"])
+    assert reference_data.generation == 2
+    assert len(json.loads(reference_data.page(refdata.LOCATIONS))) == 2
+
+
+def test_build_sections_groups_subcategories(db):
+    import models
+
+    db.add_all([
+        models.Location(location_id=1, city="Lahore", state="Punjab"),
+        models.Category(category_id=1, name="Vehicles"),
+        models.Category(category_id=2, name="Cars", parent_id=1),
+        models.Category(category_id=3, name="Bikes", parent_id=1),
+    ])
+    db.flush()
+    sections = refdata.build_sections(db)
+    assert [record_id for record_id, _ in sections[refdata.CATEGORIES]] == [1, 2, 3]
+    assert [record_id for record_id, _ in sections[refdata.PARENT_CATEGORIES]] == [1]
+    assert [record_id for record_id, _ in sections[refdata.subcategories_section(1)]] == [2, 3]
+    assert json.loads(sections[refdata.LOCATIONS][0][1])["city"] == "Lahore"
@@ -0,0 +1,110 @@
+import math
+import time
+
+import pytest
+
+import trending
+
+
+def test_count_min_sketch_never_underestimates():
+    sketch = trending.CountMinSketch(width=64, depth=4)
+    counts = {key: float(key % 7 + 1) for key in range(500)}
+    for key, count in counts.items():
+        sketch.add(key, count)
+    assert all(sketch.estimate(key) >= count for key, count in counts.items())
+
+
+def test_count_min_sketch_is_exact_without_collisions_and_scales():
+    sketch = trending.CountMinSketch()
+    sketch.add(42, 2.0)
+    assert sketch.add(42, 3.0) == 5.0
+    sketch.scale(0.5)
+    assert sketch.estimate(42) == 2.5
+
+
+def test_top_k_keeps_the_highest_scores():
+    top = trending.TopK(capacity=3)
+    for ad_id, score in [(1, 1.0), (2, 5.0), (3, 2.0), (4, 0.5), (5, 4.0), (1, 6.0)]:
+        top.offer(ad_id, score)
+    assert top.top(10) == [(1, 6.0), (2, 5.0), (5, 4.0)]
+    top.scale(0.5)
+    assert top.top(1) == [(1, 3.0)]
+
+
+def test_scopes_cover_global_category_location_and_both():
+    aggregator = trending.TrendingAggregator(bucket_seconds=1)
+    aggregator.record(7, 3, 9, 1.0)
+    assert set(aggregator.scopes) == {
+        "global", "category:3", "location:9", "category:3:location:9"
+    }
+    assert aggregator.top(category_id=3)[0][0] == 7
+    assert aggregator.top(category_id=4) == []
+
+
+def test_scores_halve_every_half_life():
+    half_life = 3600.0
+    aggregator = trending.TrendingAggregator(half_life=half_life, bucket_seconds=1)
+    now = time.time()
+    aggregator.record(1, None, None, 1.0, timestamp=now - half_life)
+    aggregator.record(2, None, None, 1.0, timestamp=now - 2 * half_life)
+    scores = dict(aggregator.top())
+    assert scores[1] == pytest.approx(0.5, rel=1e-3)
+    assert scores[2] == pytest.approx(0.25, rel=1e-3)
+
+
+def test_recent_interest_outranks_older_heavier_interest():
+    half_life = 3600.0
+    aggregator = trending.TrendingAggregator(half_life=half_life, bucket_seconds=1)
+    now = time.time()
+    aggregator.record(1, None, None, 3.0, timestamp=now - 2 * half_life)
+    aggregator.record(2, None, None, 1.0, timestamp=now)
+    assert [ad_id for ad_id, _ in aggregator.top()] == [2, 1]
+
+
+def test_rescale_moves_the_landmark_and_keeps_relative_scores():
+    aggregator = trending.TrendingAggregator(half_life=1.0, bucket_seconds=1)
+    start = aggregator.landmark
+    aggregator.record(1, None, None, 2.0, timestamp=start)
+    later = start + 40
+    aggregator.record(2, None, None, 1.0, timestamp=later)
+    assert aggregator.landmark == later
+    scores = aggregator.scopes["global"].scores
+    # Growth is measured from the new landmark, so the newest event counts at face value
+    assert scores[2] == pytest.approx(1.0)
+    assert scores[1] == pytest.approx(2.0 * 2.0 ** -40)
+    assert aggregator.sketch.estimate(hash(("global", 2)) & trending._MASK64) == pytest.approx(1.0)
+
+
+def test_counters_stay_finite_over_many_half_lives():
+    aggregator = trending.TrendingAggregator(half_life=1.0, bucket_seconds=1)
+    start = aggregator.landmark
+    for step in range(1, 2001):
+        aggregator.record(step % 5, None, None, 1.0, timestamp=start + step)
+    scores = aggregator.scopes["global"].scores
+    assert all(math.isfinite(score) and score > 0 for score in scores.values())
+    assert aggregator.landmark > start + 1900
+    assert max(scores, key=scores.get) == 2000 % 5
+
+
+def test_buffered_views_are_merged_per_bucket():
+    aggregator = trending.TrendingAggregator(bucket_seconds=60)
+    bucket = aggregator._bucket(time.time())
+    aggregator.buffer(1, 2, 3, trending.VIEW_WEIGHT, timestamp=bucket + 1)
+    aggregator.buffer(1, 2, 3, trending.VIEW_WEIGHT, timestamp=bucket + 2)
+    assert aggregator._pending == {(1, 2, 3, bucket): 2 * trending.VIEW_WEIGHT}
+    # Buffered views only count once they have been read back from the shared table
+    assert aggregator.top() == []
+
+
+def test_every_worker_counts_the_same_shared_events(db):
+    writer = trending.TrendingAggregator(bucket_seconds=1)
+    writer.buffer(1, 2, 3, trending.VIEW_WEIGHT)
+    trending.add_event(db, 4, 2, None, trending.FAVORITE_WEIGHT)
+    db.commit()
+    assert writer.flush(db) == 1
+    readers = [trending.TrendingAggregator(bucket_seconds=1) for _ in range(2)]
+    for reader in readers:
+        assert reader.poll(db) == 2
+        assert reader.poll(db) == 0
+    tops = [[ad_id for ad_id, _ in reader.top(category_id=2)] for reader in readers]
+    assert tops[0] == tops[1] == [4, 1]
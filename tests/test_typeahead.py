@@ -0,0 +1,71 @@
+import json
+
+import refdata
+import typeahead
+
+
+def _location(location_id, city, state=None):
+    return {"location_id": location_id, "city": city, "state": state}
+
+
+def _category(category_id, name, parent_id=None):
+    return {"category_id": category_id, "name": name, "parent_id": parent_id}
+
+
+def _write(path, generation, locations, categories):
+    refdata.write_snapshot(str(path), {
+        refdata.LOCATIONS: [(row["location_id"], json.dumps(row).encode()) for row in locations],
+        refdata.CATEGORIES: [(row["category_id"], json.dumps(row).encode()) for row in categories],
+    }, generation)
+
+
+def test_normalize_matches_dedupe_tokens():
+    assert typeahead.normalize("  Múltan,  Punjab ") == "multan punjab"
+
+
+def test_prefix_matches_any_word_ignoring_accents():
+    index = typeahead.PrefixIndex()
+    index.upsert(1, "Multán Punjab", _location(1, "Multán", "Punjab"))
+    index.upsert(2, "Karachi Sindh", _location(2, "Karachi", "Sindh"))
+    assert [row["location_id"] for row, _ in index.suggest("mult")] == [1]
+    assert [row["location_id"] for row, _ in index.suggest("SIN")] == [2]
+    assert index.suggest("xyz") == []
+    assert index.suggest("  ") == []
+
+
+def test_ranking_is_by_ad_count_then_label():
+    index = typeahead.PrefixIndex()
+    for record_id, city in [(1, "Lahore"), (2, "Larkana"), (3, "Layyah")]:
+        index.upsert(record_id, city, _location(record_id, city))
+    index.set_counts({2: 5, 3: 5})
+    assert [(row["city"], count) for row, count in index.suggest("la")] == [
+        ("Larkana", 5), ("Layyah", 5), ("Lahore", 0)
+    ]
+    assert len(index.suggest("la", limit=1)) == 1
+
+
+def test_upsert_replaces_and_remove_drops_keys():
+    index = typeahead.PrefixIndex()
+    index.upsert(1, "Lyallpur", _location(1, "Lyallpur"))
+    index.upsert(1, "Faisalabad", _location(1, "Faisalabad"))
+    assert index.suggest("lyall") == []
+    assert [row["city"] for row, _ in index.suggest("fais")] == ["Faisalabad"]
+    index.remove(1)
+    assert index.suggest("fais") == []
+    assert len(index) == 0
+
+
+def test_parent_categories_count_their_subcategories():
+    categories = {1: _category(1, "Vehicles"), 2: _category(2, "Cars", 1), 3: _category(3, "Sedans", 2)}
+    assert typeahead._with_parent_counts({3: 2, 2: 1}, categories) == {3: 2, 2: 3, 1: 3}
+
+
+def test_sync_reindexes_only_when_the_snapshot_changes(tmp_path):
+    _write(tmp_path, 1, [_location(1, "Lahore", "Punjab")], [_category(1, "Mobiles")])
+    suggestions = typeahead.Typeahead(refdata.ReferenceData(str(tmp_path)))
+    assert [row["city"] for row, _ in suggestions.suggest_locations("lah")] == ["Lahore"]
+    assert [row["name"] for row, _ in suggestions.suggest_categories("mob")] == ["Mobiles"]
+    _write(tmp_path, 2, [_location(1, "Lahore", "Punjab"), _location(2, "Karachi", "Sindh")], [])
+    assert [row["city"] for row, _ in suggestions.suggest_locations("kar")] == ["Karachi"]
+    assert suggestions.suggest_categories("mob") == []
+    assert suggestions.generation == 2
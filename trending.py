@@ -0,0 +1,313 @@
+import heapq
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session
+
+import models
+
+logger = logging.getLogger(__name__)
+
+# Event weights fed by the API
+VIEW_WEIGHT = 1.0
+FAVORITE_WEIGHT = 3.0
+MESSAGE_WEIGHT = 5.0
+
+_MASK64 = (1 << 64) - 1
+
+# Shared trending_events rows are kept this long (restarts replay from the last snapshot)
+EVENT_RETENTION = timedelta(days=1)
+# An event_id skipped while tailing may belong to a transaction that has not committed yet;
+# it is looked up again for this many seconds
+GAP_TIMEOUT = 60.0
+MAX_TRACKED_GAP = 1000
+POLL_BATCH = 1000
+
+
+class CountMinSketch:
+    def __init__(self, width: int = 4096, depth: int = 4, seed: int = 0x5EED):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.float64)
+        rng = np.random.default_rng(seed)
+        self._salts = [int(salt) for salt in rng.integers(1, 1 << 62, size=depth)]
+        self._rows = np.arange(depth)
+
+    def _columns(self, key: int):
+        # Multiply-shift hashing of an integer key (high bits of the product), one salt per row
+        return [((((key ^ salt) * 0x9E3779B97F4A7C15) & _MASK64) >> 32) % self.width for salt in self._salts]
+
+    def add(self, key: int, amount: float) -> float:
+        columns = self._columns(key)
+        self.table[self._rows, columns] += amount
+        return float(self.table[self._rows, columns].min())
+
+    def estimate(self, key: int) -> float:
+        return float(self.table[self._rows, self._columns(key)].min())
+
+    def scale(self, factor: float):
+        self.table *= factor
+
+
+class TopK:
+    """Bounded set of the highest-scoring ads for one scope (min-heap with lazy deletion)."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.scores: Dict[int, float] = {}
+        self._heap: List[Tuple[float, int]] = []
+
+    def _min(self) -> Tuple[float, int]:
+        while self._heap and self.scores.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0]
+
+    def offer(self, ad_id: int, score: float):
+        if ad_id not in self.scores and len(self.scores) >= self.capacity:
+            lowest_score, lowest_ad = self._min()
+            if score <= lowest_score:
+                return
+            heapq.heappop(self._heap)
+            del self.scores[lowest_ad]
+        self.scores[ad_id] = score
+        heapq.heappush(self._heap, (score, ad_id))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(s, a) for a, s in self.scores.items()]
+            heapq.heapify(self._heap)
+
+    def scale(self, factor: float):
+        self.scores = {ad_id: score * factor for ad_id, score in self.scores.items()}
+        self._heap = [(s, a) for a, s in self.scores.items()]
+        heapq.heapify(self._heap)
+
+    def top(self, limit: int) -> List[Tuple[int, float]]:
+        return heapq.nlargest(limit, self.scores.items(), key=lambda item: item[1])
+
+
+def add_event(db: Session, ad_id: int, category_id: Optional[int], location_id: Optional[int],
+              weight: float, occurred_at: Optional[datetime] = None):
+    # Written in the caller's transaction; every worker picks it up on its next poll
+    db.add(models.TrendingEvent(ad_id=ad_id, category_id=category_id, location_id=location_id,
+                                weight=weight, occurred_at=occurred_at or datetime.now()))
+
+
+def scope_name(category_id: Optional[int] = None, location_id: Optional[int] = None) -> str:
+    if category_id is not None and location_id is not None:
+        return f"category:{category_id}:location:{location_id}"
+    if category_id is not None:
+        return f"category:{category_id}"
+    if location_id is not None:
+        return f"location:{location_id}"
+    return "global"
+
+
+class TrendingAggregator:
+    """Exponentially decaying per-ad interest counters held in memory.
+
+    Uses forward decay: an event at time t adds weight * 2^((t - landmark) / half_life),
+    and reads divide by the same factor for "now", so nothing has to be touched as
+    time passes. Event times are rounded to buckets, and counters are rescaled
+    before the growth factor gets large. Memory is bounded by the sketch size plus
+    ``capacity`` entries per scope.
+
+    Interactions go through the shared ``trending_events`` table (views are
+    buffered and written in batches) and every worker process tails it, so all
+    workers count the same traffic.
+    """
+
+    def __init__(self, half_life: float = 6 * 3600, bucket_seconds: float = 60,
+                 width: int = 4096, depth: int = 4, capacity: int = 100):
+        self.half_life = half_life
+        self.bucket_seconds = bucket_seconds
+        self.capacity = capacity
+        self.sketch = CountMinSketch(width=width, depth=depth)
+        self.scopes: Dict[str, TopK] = {}
+        self.landmark = self._bucket(time.time())
+        self.cursor = 0
+        self._gaps: Dict[int, float] = {}
+        self._pending: Dict[Tuple[int, Optional[int], Optional[int], float], float] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _bucket(self, timestamp: float) -> float:
+        return timestamp - timestamp % self.bucket_seconds
+
+    def _growth(self, timestamp: float) -> float:
+        return 2.0 ** ((timestamp - self.landmark) / self.half_life)
+
+    def _rescale_if_needed(self, timestamp: float):
+        # Keep forward-decay factors well inside float range
+        if timestamp - self.landmark > 32 * self.half_life:
+            factor = 1.0 / self._growth(timestamp)
+            self.sketch.scale(factor)
+            for top in self.scopes.values():
+                top.scale(factor)
+            self.landmark = timestamp
+
+    def record(self, ad_id: int, category_id: Optional[int], location_id: Optional[int],
+               weight: float, timestamp: Optional[float] = None):
+        timestamp = self._bucket(timestamp if timestamp is not None else time.time())
+        scopes = {scope_name(), scope_name(category_id=category_id), scope_name(location_id=location_id),
+                  scope_name(category_id=category_id, location_id=location_id)}
+        with self._lock:
+            self._rescale_if_needed(timestamp)
+            amount = weight * self._growth(timestamp)
+            for scope in scopes:
+                score = self.sketch.add(hash((scope, ad_id)) & _MASK64, amount)
+                top = self.scopes.get(scope)
+                if top is None:
+                    top = self.scopes[scope] = TopK(self.capacity)
+                top.offer(ad_id, score)
+
+    def buffer(self, ad_id: int, category_id: Optional[int], location_id: Optional[int],
+               weight: float, timestamp: Optional[float] = None):
+        """Queue an interaction for the shared table; it is counted once it has been read back."""
+        key = (ad_id, category_id, location_id, self._bucket(timestamp if timestamp is not None else time.time()))
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0.0) + weight
+
+    def flush(self, db: Session) -> int:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        db.add_all(
+            models.TrendingEvent(ad_id=ad_id, category_id=category_id, location_id=location_id,
+                                 weight=weight, occurred_at=datetime.fromtimestamp(bucket))
+            for (ad_id, category_id, location_id, bucket), weight in pending.items()
+        )
+        db.commit()
+        return len(pending)
+
+    def poll(self, db: Session, batch_size: int = POLL_BATCH) -> int:
+        """Apply shared events written since the last poll, including late commits of skipped ids."""
+        event = models.TrendingEvent
+        now = time.monotonic()
+        self._gaps = {event_id: seen for event_id, seen in self._gaps.items() if now - seen < GAP_TIMEOUT}
+        condition = event.event_id > self.cursor
+        if self._gaps:
+            condition = or_(condition, event.event_id.in_(list(self._gaps)))
+        rows = db.query(event).filter(condition).order_by(event.event_id).limit(batch_size).all()
+        for row in rows:
+            self._gaps.pop(row.event_id, None)
+            if row.event_id > self.cursor:
+                if row.event_id - self.cursor <= MAX_TRACKED_GAP:
+                    self._gaps.update(dict.fromkeys(range(self.cursor + 1, row.event_id), now))
+                self.cursor = row.event_id
+            self.record(row.ad_id, row.category_id, row.location_id, row.weight,
+                        timestamp=row.occurred_at.timestamp())
+        return len(rows)
+
+    def top(self, category_id: Optional[int] = None, location_id: Optional[int] = None,
+            limit: int = 20) -> List[Tuple[int, float]]:
+        with self._lock:
+            top = self.scopes.get(scope_name(category_id=category_id, location_id=location_id))
+            if top is None:
+                return []
+            decay = 1.0 / self._growth(time.time())
+            return [(ad_id, score * decay) for ad_id, score in top.top(limit)]
+
+    def snapshot(self, db: Session, min_interval: float = 0):
+        now = time.time()
+        # Every worker holds the same counters, so one recent snapshot is enough
+        latest = db.query(func.max(models.TrendingSnapshot.snapshot_at)).scalar()
+        if latest is not None and now - latest.timestamp() < min_interval:
+            return 0
+        with self._lock:
+            decay = 1.0 / self._growth(now)
+            rows = [
+                models.TrendingSnapshot(scope=scope, ad_id=ad_id, score=score * decay)
+                for scope, top in self.scopes.items()
+                for ad_id, score in top.scores.items()
+            ]
+        snapshot_at = datetime.fromtimestamp(now)
+        for row in rows:
+            row.snapshot_at = snapshot_at
+        db.query(models.TrendingSnapshot).delete(synchronize_session=False)
+        db.add_all(rows)
+        expired = [
+            event_id for (event_id,) in db.query(models.TrendingEvent.event_id).filter(
+                models.TrendingEvent.occurred_at < snapshot_at - EVENT_RETENTION
+            ).limit(10000).all()
+        ]
+        if expired:
+            db.query(models.TrendingEvent).filter(
+                models.TrendingEvent.event_id.in_(expired)
+            ).delete(synchronize_session=False)
+        db.commit()
+        return len(rows)
+
+    def restore(self, db: Session):
+        rows = db.query(models.TrendingSnapshot).all()
+        now = time.time()
+        with self._lock:
+            growth = self._growth(now)
+            for row in rows:
+                age = max(now - row.snapshot_at.timestamp(), 0) if row.snapshot_at else 0
+                amount = row.score * 2.0 ** (-age / self.half_life) * growth
+                if amount <= 0 or math.isinf(amount):
+                    continue
+                score = self.sketch.add(hash((row.scope, row.ad_id)) & _MASK64, amount)
+                top = self.scopes.get(row.scope)
+                if top is None:
+                    top = self.scopes[row.scope] = TopK(self.capacity)
+                top.offer(row.ad_id, score)
+        # Replay shared events newer than the snapshot (all retained ones without a snapshot)
+        snapshot_at = max((row.snapshot_at for row in rows if row.snapshot_at), default=None)
+        event = models.TrendingEvent
+        if snapshot_at is not None:
+            first = db.query(func.min(event.event_id)).filter(event.occurred_at >= snapshot_at).scalar()
+            self.cursor = first - 1 if first is not None else db.query(func.max(event.event_id)).scalar() or 0
+        else:
+            self.cursor = 0
+        while self.poll(db):
+            pass
+        return len(rows)
+
+    def start(self, session_factory: Callable, interval: float = 300, poll_interval: float = 1.0):
+        def run():
+            last_snapshot = time.monotonic()
+            while not self._stop.wait(poll_interval):
+                self._sync_with(session_factory)
+                if time.monotonic() - last_snapshot >= interval:
+                    last_snapshot = time.monotonic()
+                    self._snapshot_with(session_factory, min_interval=interval / 2)
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=run, name="trending-snapshots", daemon=True)
+        self._thread.start()
+
+    def stop(self, session_factory: Callable):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._sync_with(session_factory)
+
+    def _sync_with(self, session_factory: Callable):
+        db = session_factory()
+        try:
+            self.flush(db)
+            while self.poll(db) == POLL_BATCH:
+                pass
+        except Exception:
+            logger.exception("Failed to sync trending events")
+            db.rollback()
+        finally:
+            db.close()
+
+    def _snapshot_with(self, session_factory: Callable, min_interval: float = 0):
+        db = session_factory()
+        try:
+            self.snapshot(db, min_interval=min_interval)
+        except Exception:
+            logger.exception("Failed to persist trending snapshot")
+            db.rollback()
+        finally:
+            db.close()
@@ -0,0 +1,209 @@
+import bisect
+import json
+import logging
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+import dedupe
+import models
+import refdata
+
+logger = logging.getLogger(__name__)
+
+# Ad counts only rank suggestions; every worker recounts them from the database this often
+COUNT_REFRESH_INTERVAL = 300
+MAX_SUGGESTIONS = 20
+
+
+def normalize(text: Optional[str]) -> str:
+    # Same tokens as duplicate detection, joined by single spaces: "Múltan, Punjab" -> "multan punjab"
+    return " ".join(dedupe.normalize(text))
+
+
+def _word_suffixes(label: str) -> List[str]:
+    # Every suffix starting at a word, so "isl" and "capital" both match "islamabad capital territory"
+    words = label.split(" ")
+    return [" ".join(words[i:]) for i in range(len(words)) if words[i]]
+
+
+class PrefixIndex:
+    """Sorted (key, record id) pairs searched with bisect.
+
+    A query is answered by one binary search plus a scan over the keys that
+    start with it; matches are ranked by ad count, then label. Records are
+    upserted and removed one at a time, so an edit only touches that record's keys.
+    """
+
+    def __init__(self):
+        self._entries: List[Tuple[str, int]] = []
+        self._keys: Dict[int, List[str]] = {}
+        self._records: Dict[int, dict] = {}
+        self._labels: Dict[int, str] = {}
+        self._counts: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def upsert(self, record_id: int, label: str, record: dict):
+        normalized = normalize(label)
+        with self._lock:
+            self._remove(record_id)
+            keys = _word_suffixes(normalized)
+            for key in keys:
+                bisect.insort(self._entries, (key, record_id))
+            self._keys[record_id] = keys
+            self._records[record_id] = record
+            self._labels[record_id] = normalized
+
+    def remove(self, record_id: int):
+        with self._lock:
+            self._remove(record_id)
+
+    def _remove(self, record_id: int):
+        for key in self._keys.pop(record_id, []):
+            i = bisect.bisect_left(self._entries, (key, record_id))
+            if i < len(self._entries) and self._entries[i] == (key, record_id):
+                del self._entries[i]
+        self._records.pop(record_id, None)
+        self._labels.pop(record_id, None)
+
+    def set_counts(self, counts: Dict[int, int]):
+        self._counts = counts
+
+    def records(self) -> Dict[int, dict]:
+        return self._records
+
+    def suggest(self, query: str, limit: int = 10) -> List[Tuple[dict, int]]:
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        with self._lock:
+            matches = set()
+            i = bisect.bisect_left(self._entries, (prefix,))
+            while i < len(self._entries) and self._entries[i][0].startswith(prefix):
+                matches.add(self._entries[i][1])
+                i += 1
+            counts = self._counts
+            ranked = sorted(matches, key=lambda record_id: (-counts.get(record_id, 0), self._labels[record_id]))
+            return [(self._records[record_id], counts.get(record_id, 0)) for record_id in ranked[:limit]]
+
+
+def _location_label(location: dict) -> str:
+    return " ".join(part for part in (location["city"], location.get("state")) if part)
+
+
+def _category_label(category: dict) -> str:
+    return category["name"]
+
+
+class Typeahead:
+    """Location and category suggestions answered from memory.
+
+    Names come from the shared reference snapshot: when its generation changes
+    (a location or category was written by any worker) only the records that
+    differ are re-indexed, without touching the database. Ad counts are loaded
+    by a background refresher, so all workers converge on the same ranking.
+    """
+
+    def __init__(self, reference_data: refdata.ReferenceData):
+        self.reference_data = reference_data
+        self.locations = PrefixIndex()
+        self.categories = PrefixIndex()
+        self.generation: Optional[int] = None
+        self._sync_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def sync(self):
+        generation = self.reference_data.generation
+        if generation is None or generation == self.generation:
+            return
+        with self._sync_lock:
+            if generation == self.generation:
+                return
+            locations = self.reference_data.page(refdata.LOCATIONS)
+            categories = self.reference_data.page(refdata.CATEGORIES)
+            if locations is None or categories is None:
+                return
+            _apply(self.locations, json.loads(locations), "location_id", _location_label)
+            _apply(self.categories, json.loads(categories), "category_id", _category_label)
+            self.generation = generation
+
+    def refresh_counts(self, db: Session):
+        live_ads = models.Ad.deleted_at.is_(None)
+        location_counts = db.query(models.Ad.location_id, func.count(models.Ad.ad_id)).filter(
+            live_ads
+        ).group_by(models.Ad.location_id).all()
+        category_counts = db.query(models.Ad.category_id, func.count(models.Ad.ad_id)).filter(
+            live_ads
+        ).group_by(models.Ad.category_id).all()
+        self.locations.set_counts({location_id: count for location_id, count in location_counts if location_id is not None})
+        self.categories.set_counts(_with_parent_counts(dict(category_counts), self.categories.records()))
+
+    def suggest_locations(self, query: str, limit: int = 10) -> List[Tuple[dict, int]]:
+        self.sync()
+        return self.locations.suggest(query, limit)
+
+    def suggest_categories(self, query: str, limit: int = 10) -> List[Tuple[dict, int]]:
+        self.sync()
+        return self.categories.suggest(query, limit)
+
+    def start(self, session_factory: Callable, interval: float = COUNT_REFRESH_INTERVAL):
+        def refresh():
+            db = session_factory()
+            try:
+                self.sync()
+                self.refresh_counts(db)
+            except Exception:
+                logger.exception("Typeahead count refresh failed")
+            finally:
+                db.close()
+
+        def run():
+            refresh()
+            while not self._stop.wait(interval):
+                refresh()
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=run, name="typeahead-counts", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def _apply(index: PrefixIndex, records: Iterable[dict], id_field: str, label: Callable[[dict], str]):
+    # Re-index only added or changed records and drop the ones that disappeared
+    current = index.records()
+    seen = set()
+    for record in records:
+        record_id = record[id_field]
+        seen.add(record_id)
+        if current.get(record_id) != record:
+            index.upsert(record_id, label(record), record)
+    for record_id in [record_id for record_id in current if record_id not in seen]:
+        index.remove(record_id)
+
+
+def _category_chain(category_id: Optional[int], categories: Dict[int, dict]) -> List[int]:
+    # The category and its ancestors, so a parent ranks by the ads in all its subcategories
+    chain = []
+    while category_id is not None and category_id not in chain:
+        chain.append(category_id)
+        category = categories.get(category_id)
+        category_id = category.get("parent_id") if category else None
+    return chain
+
+
+def _with_parent_counts(counts: Dict[int, int], categories: Dict[int, dict]) -> Dict[int, int]:
+    totals: Dict[int, int] = {}
+    for category_id, count in counts.items():
+        for record_id in _category_chain(category_id, categories):
+            totals[record_id] = totals.get(record_id, 0) + count
+    return totals